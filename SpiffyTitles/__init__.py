@@ -55,10 +55,24 @@ __contributors__ = {}
 __url__ = "https://github.com/oddluck/limnoria-plugins/"
 
 from . import config
+from . import cache
+from . import domains
+from . import filters
+from . import metrics
+from . import ratelimit
+from . import store
+from . import titleparser
 from . import plugin
 from importlib import reload
 
 # In case we're being reloaded.
+reload(cache)
+reload(domains)
+reload(filters)
+reload(metrics)
+reload(ratelimit)
+reload(store)
+reload(titleparser)
 reload(plugin)
 reload(config)
 # Add more reloads here if you add third-party modules and want them to be
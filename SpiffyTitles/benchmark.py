@@ -0,0 +1,350 @@
+###
+# Copyright (c) 2015, butterscotchstallion
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+benchmark: replays channel messages through SpiffyTitles against a local stub
+server serving recorded HTTP responses, so no real site or API is touched.
+
+The corpus is a dict with a list of "messages" and the "responses" served by
+URL. A response has a "status", "headers" and either a "body" string, a
+"json" object or a "size" in bytes for generated binary content, plus an
+optional "delay" in seconds. Responses are looked up by full URL, then by
+URL without its query string.
+"""
+
+import collections
+import contextlib
+import http.server
+import json
+import resource
+import threading
+import time
+import tracemalloc
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+
+import supybot.conf as conf
+import supybot.ircmsgs as ircmsgs
+
+CHUNK_SIZE = 65536
+
+
+def get_default_corpus():
+    """
+    Returns a small corpus mixing chatter, YouTube and Reddit links, HTML
+    pages, shortlink redirects, dead links and large files.
+    """
+    now = time.time()
+    html = "text/html; charset=utf-8"
+    thread = {
+        "id": "abc123",
+        "title": "What is your favourite plugin?",
+        "subreddit": "limnoria",
+        "author": "someone",
+        "score": 42,
+        "upvote_ratio": 0.97,
+        "num_comments": 12,
+        "created_utc": now - 86400 * 3,
+        "is_self": False,
+        "url": "https://example.com/article/1",
+        "domain": "example.com",
+    }
+    responses = {
+        "https://www.googleapis.com/youtube/v3/videos": {
+            "json": {
+                "items": [
+                    {
+                        "snippet": {
+                            "title": "A video",
+                            "channelTitle": "A channel",
+                            "publishedAt": "2020-01-01T00:00:00Z",
+                        },
+                        "statistics": {
+                            "viewCount": "1234567",
+                            "likeCount": "1234",
+                            "commentCount": "56",
+                        },
+                        "contentDetails": {"duration": "PT4M41S", "contentRating": {}},
+                    }
+                ]
+            }
+        },
+        "https://www.reddit.com/r/limnoria/comments/abc123.json": {
+            "json": [{"data": {"children": [{"data": thread}]}}, {"data": {}}]
+        },
+        "https://www.reddit.com/user/someone/about.json": {
+            "json": {
+                "data": {
+                    "name": "someone",
+                    "created_utc": now - 86400 * 800,
+                    "link_karma": 1000,
+                    "comment_karma": 5000,
+                }
+            }
+        },
+        "https://t.co/short": {
+            "status": 301,
+            "headers": {"Location": "https://example.com/article/1"},
+        },
+        "https://bit.ly/short": {
+            "status": 302,
+            "headers": {"Location": "https://news.example.org/story"},
+        },
+        "https://news.example.org/story": {
+            "headers": {"Content-Type": html},
+            "body": "<html><head><meta property='og:title' content='A story'>"
+            "</head><body>%s</body></html>" % ("<p>text</p>" * 20000),
+        },
+        "https://files.example.com/video.mp4": {
+            "headers": {"Content-Type": "video/mp4"},
+            "size": 8 * 1024 * 1024,
+        },
+        "https://files.example.com/image.png": {
+            "headers": {"Content-Type": "image/png"},
+            "size": 300 * 1024,
+        },
+        "https://example.com/gone": {"status": 404, "body": "Not found"},
+    }
+    for i in range(1, 11):
+        responses["https://example.com/article/%s" % i] = {
+            "headers": {"Content-Type": html},
+            "body": "<html><head><meta charset='utf-8'><title>Article %s</title>"
+            "<script>%s</script></head><body>%s</body></html>"
+            % (i, "var x = 1;" * 500, "<p>words</p>" * 5000),
+        }
+    messages = [
+        "hello everyone",
+        "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+        "did you see https://example.com/article/1 ?",
+        "https://www.reddit.com/r/limnoria/comments/abc123/some_title/",
+        "lol",
+        "https://t.co/short",
+        "two links https://example.com/article/2 https://youtu.be/dQw4w9WgXcQ",
+        "https://www.reddit.com/user/someone",
+        "https://bit.ly/short",
+        "https://files.example.com/video.mp4",
+        "https://files.example.com/image.png",
+        "https://example.com/gone",
+        "no links in this one either",
+    ]
+    messages += ["https://example.com/article/%s" % i for i in range(3, 11)]
+    return {"messages": messages, "responses": responses}
+
+
+def load_corpus(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves corpus responses. The original URL is encoded in the request path
+    as /<scheme>/<netloc>/<path>.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, which Nagle's algorithm delays
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        scheme, netloc, path = (self.path.lstrip("/").split("/", 2) + ["", ""])[:3]
+        url = "%s://%s/%s" % (scheme, netloc, path)
+        responses = self.server.responses
+        self.server.hits[url] += 1
+        response = responses.get(url) or responses.get(url.split("?", 1)[0])
+        if response is None:
+            response = {"status": 404, "body": ""}
+        time.sleep(response.get("delay", self.server.latency))
+        if "json" in response:
+            body = json.dumps(response["json"]).encode()
+            headers = {"Content-Type": "application/json"}
+        else:
+            body = response.get("body", "").encode()
+            headers = {}
+        headers.update(response.get("headers", {}))
+        size = response.get("size", len(body))
+        self.send_response(response.get("status", 200))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        try:
+            if "size" in response:
+                chunk = b"\0" * CHUNK_SIZE
+                for offset in range(0, size, CHUNK_SIZE):
+                    self.wfile.write(chunk[: size - offset])
+            else:
+                self.wfile.write(body)
+        except ConnectionError:
+            # The plugin stops reading files once it has their headers
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, responses, latency=0):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.responses = responses
+        self.latency = latency
+        self.hits = collections.Counter()
+        self.base_url = "http://127.0.0.1:%s" % self.server_port
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def handle_error(self, request, client_address):
+        # Clients drop kept-alive connections whenever they like
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubAdapter(requests.adapters.HTTPAdapter):
+    """
+    Sends every request to the stub server instead of the real host, and
+    gives the response its original URL back so that redirects and domain
+    checks behave as they would on the network.
+    """
+
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        url = request.url
+        parts = urlsplit(url)
+        path = urlunsplit(("", "", parts.path.lstrip("/"), parts.query, ""))
+        request.url = "%s/%s/%s/%s" % (self.base_url, parts.scheme, parts.netloc, path)
+        kwargs["proxies"] = None
+        try:
+            response = super().send(request, **kwargs)
+        finally:
+            request.url = url
+        response.url = url
+        return response
+
+
+@contextlib.contextmanager
+def stubbed_session(session, base_url):
+    """
+    Routes all requests of session to the stub server while in the block
+    """
+    adapters = session.adapters.copy()
+    adapter = StubAdapter(base_url)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    try:
+        yield
+    finally:
+        session.adapters.clear()
+        session.adapters.update(adapters)
+        adapter.close()
+
+
+def run_benchmark(plugin, irc, corpus=None, rounds=3, latency=0, channel="#bench"):
+    """
+    Feeds the corpus messages to irc rounds times and returns a report. The
+    link cache starts empty, so the first round measures cold lookups and the
+    following ones mostly cache hits.
+    """
+    corpus = corpus or get_default_corpus()
+    plugin_conf = conf.supybot.plugins.SpiffyTitles
+    server = StubServer(corpus["responses"], latency)
+    report = {"rounds": [], "messages": len(corpus["messages"])}
+    with contextlib.ExitStack() as stack:
+        stack.callback(server.stop)
+        stack.enter_context(stubbed_session(plugin.session, server.base_url))
+        stack.enter_context(plugin_conf.youtube.developerKey.context("benchmark"))
+        for api in ("youtube", "twitch", "imgur", "imdb"):
+            api_conf = plugin_conf.get(api)
+            stack.enter_context(api_conf.requestsPerMinute.context(0))
+            stack.enter_context(api_conf.dailyQuota.context(0))
+        plugin.link_cache.clear()
+        plugin.redirect_cache.clear()
+        plugin.metrics.clear()
+        tracemalloc.start()
+        stack.callback(tracemalloc.stop)
+        for _ in range(rounds):
+            replies = 0
+            start = time.perf_counter()
+            for text in corpus["messages"]:
+                irc.feedMsg(ircmsgs.privmsg(channel, text, prefix="bench!b@bench"))
+                while irc.takeMsg():
+                    replies += 1
+            elapsed = time.perf_counter() - start
+            report["rounds"].append({"seconds": elapsed, "replies": replies})
+        report["peak_memory"] = tracemalloc.get_traced_memory()[1]
+    report["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    report["handlers"] = plugin.metrics.stats()
+    return report
+
+
+def format_report(report, get_size):
+    """
+    Returns the lines of a human readable report. get_size formats a number
+    of bytes.
+    """
+    lines = []
+    for number, result in enumerate(report["rounds"], 1):
+        lines.append(
+            "round %s: %s messages in %.3fs (%.1f messages/s), %s replies"
+            % (
+                number,
+                report["messages"],
+                result["seconds"],
+                report["messages"] / result["seconds"],
+                result["replies"],
+            )
+        )
+    for handler, metrics in report["handlers"].items():
+        latency = metrics["latency"]
+        lines.append(
+            "%s: %s lookups, %s cache hits, p50 %.1fms, p95 %.1fms, p99 %.1fms, %s"
+            % (
+                handler,
+                metrics["lookups"],
+                metrics["cache_hits"],
+                latency[0.5] * 1000,
+                latency[0.95] * 1000,
+                latency[0.99] * 1000,
+                get_size(metrics["bytes"]),
+            )
+        )
+    lines.append(
+        "peak traced memory: %s, max RSS: %s"
+        % (get_size(report["peak_memory"]), get_size(report["max_rss"]))
+    )
+    return lines
@@ -0,0 +1,333 @@
+###
+# Copyright (c) 2015, butterscotchstallion
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+cache: bounded in-memory link cache used by SpiffyTitles.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from urllib.parse import urlsplit, urlunsplit
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url):
+    """
+    Returns url with a lowercase scheme and host and without a default port
+    or an empty fragment, so equivalent links share cache entries.
+    """
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").rstrip(".")
+    if ":" in netloc:
+        netloc = "[%s]" % netloc
+    if port and port != DEFAULT_PORTS.get(scheme):
+        netloc = "%s:%s" % (netloc, port)
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo = "%s:%s" % (userinfo, parts.password)
+        netloc = "%s@%s" % (userinfo, netloc)
+    path = parts.path or "/"
+    return urlunsplit((scheme, netloc, path, parts.query, parts.fragment))
+
+
+class LinkCache:
+    """
+    LRU cache of link titles with TTL expiry. A link may carry its own
+    "lifetime" in seconds, otherwise the cache lifetime applies.
+
+    Every channel has its own OrderedDict keyed by URL, and all entries are
+    also kept in one global OrderedDict keyed by (channel, url). Both are
+    ordered from least to most recently used, so lookups, refreshes and
+    evictions are constant time no matter how many links are cached.
+    """
+
+    def __init__(self, lifetime=600, channel_size=500, size=5000, max_bytes=0):
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.bounds = None
+        self.configure(lifetime, channel_size, size, max_bytes)
+
+    def configure(self, lifetime, channel_size, size, max_bytes):
+        """
+        Updates the cache lifetime (in seconds) and bounds. A bound of 0
+        means unlimited. Shrinking a bound evicts entries right away.
+        """
+        with self.lock:
+            self.lifetime = lifetime
+            if (channel_size, size, max_bytes) == self.bounds:
+                return
+            self.bounds = (channel_size, size, max_bytes)
+            self.channel_size = channel_size
+            self.size = size
+            self.max_bytes = max_bytes
+            for channel in list(self.channels):
+                self._shrink_channel(channel)
+            self._shrink()
+
+    def get(self, channel, url):
+        """
+        Returns the cached link for url in channel, or None if there is no
+        fresh entry.
+        """
+        with self.lock:
+            links = self.channels.get(channel)
+            link = links.get(url) if links else None
+            if link is None:
+                self.misses += 1
+                return
+            if self._is_expired(link):
+                self._remove(channel, url)
+                self.expirations += 1
+                self.misses += 1
+                return
+            links.move_to_end(url)
+            self.entries.move_to_end((channel, url))
+            self.hits += 1
+            return link
+
+    def set(self, channel, url, link):
+        """
+        Adds or replaces the cached link for url in channel.
+        """
+        with self.lock:
+            if channel in self.channels and url in self.channels[channel]:
+                self._remove(channel, url)
+            link["size"] = self._get_size(url, link)
+            self.channels.setdefault(channel, OrderedDict())[url] = link
+            self.entries[(channel, url)] = link
+            self.bytes += link["size"]
+            self._purge_expired()
+            self._shrink_channel(channel)
+            self._shrink()
+
+    def clear(self):
+        with self.lock:
+            self.channels.clear()
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        Returns a dict with the cache size and hit/miss/eviction counters.
+        """
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "channels": len(self.channels),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def _get_size(self, url, link):
+        return len(url.encode()) + len(link.get("title", "").encode())
+
+    def _is_expired(self, link):
+        lifetime = link.get("lifetime", self.lifetime)
+        return time.time() - link["timestamp"] >= lifetime
+
+    def _remove(self, channel, url):
+        link = self.entries.pop((channel, url))
+        links = self.channels[channel]
+        del links[url]
+        if not links:
+            del self.channels[channel]
+        self.bytes -= link["size"]
+
+    def _evict(self, channel, url):
+        self._remove(channel, url)
+        self.evictions += 1
+
+    def _purge_expired(self):
+        """
+        Drops expired entries from the least recently used end. This only
+        looks at the head of the list, so it stays cheap on every insert.
+        """
+        while self.entries:
+            (channel, url), link = next(iter(self.entries.items()))
+            if not self._is_expired(link):
+                break
+            self._remove(channel, url)
+            self.expirations += 1
+
+    def _shrink_channel(self, channel):
+        links = self.channels.get(channel)
+        while links and self.channel_size > 0 and len(links) > self.channel_size:
+            self._evict(channel, next(iter(links)))
+
+    def _shrink(self):
+        while self.entries and (
+            (self.size > 0 and len(self.entries) > self.size)
+            or (self.max_bytes > 0 and self.bytes > self.max_bytes)
+        ):
+            channel, url = next(iter(self.entries))
+            self._evict(channel, url)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls made with the same key: the first caller runs
+    the function while later callers wait for it and share its result, or
+    its exception.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.shared = 0
+
+    def do(self, key, function, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+            else:
+                self.shared += 1
+        if not leader:
+            return call.result()
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class Batcher:
+    """
+    Coalesces lookups of single keys made by concurrent callers: keys asked
+    for within delay seconds, or until size of them are waiting, are looked
+    up together by one call of function. It takes a list of keys and returns
+    a dict of the values found, and callers get None for missing keys.
+    """
+
+    def __init__(self, function, delay=0.05, size=100):
+        self.function = function
+        self.delay = delay
+        self.size = size
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.timer = None
+        self.batches = 0
+
+    def submit(self, key):
+        """
+        Returns a Future for the value of key
+        """
+        with self.lock:
+            future = self.pending.get(key)
+            if future is not None:
+                return future
+            future = self.pending[key] = Future()
+            full = len(self.pending) >= self.size
+            if not full and self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+        return future
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not pending:
+                return
+            self.batches += 1
+        try:
+            values = self.function(list(pending))
+        except Exception as e:
+            for future in pending.values():
+                future.set_exception(e)
+            return
+        for key, future in pending.items():
+            future.set_result(values.get(key))
+
+
+class TTLCache:
+    """
+    Small LRU cache whose entries expire lifetime seconds after being set,
+    used for API objects that rarely change.
+    """
+
+    def __init__(self, lifetime=3600, size=1000):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.lifetime = lifetime
+        self.size = size
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            timestamp, value = entry
+            if time.monotonic() - timestamp >= self.lifetime:
+                del self.entries[key]
+                return
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -65,6 +65,120 @@ conf.registerGlobalValue(
     registry.Integer(10, _("""Maximum time in seconds to try and retrieve a link""")),
 )
 
+conf.registerGlobalValue(
+    SpiffyTitles,
+    "workers",
+    registry.PositiveInteger(
+        4,
+        _(
+            """
+            Number of URLs fetched at the same time when a message contains several
+            links. You must reload the plugin for this setting to take effect.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles,
+    "messageTimeout",
+    registry.NonNegativeInteger(
+        20,
+        _(
+            """
+            Maximum time in seconds to wait for all the titles of a message with
+            several links. Titles not retrieved by then are dropped. 0 to disable.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles,
+    "backgroundLookups",
+    registry.Boolean(
+        False,
+        _(
+            """
+            Whether to handle channel messages without waiting for their titles,
+            which are sent as they arrive. Links are still fetched on the workers
+            pool, and up to maxPendingLookups of them can wait for it.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles,
+    "maxPendingLookups",
+    registry.NonNegativeInteger(
+        20,
+        _(
+            """
+            Maximum number of links waiting for a title with backgroundLookups.
+            The links of messages beyond it are dropped. 0 to disable.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles,
+    "metricsInterval",
+    registry.NonNegativeInteger(
+        0,
+        _(
+            """
+            Number of seconds between writes of the handler metrics, in the
+            Prometheus text format, to SpiffyTitles.prom in the data directory. 0
+            to disable. You must reload the plugin for this setting to take effect.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles,
+    "poolConnections",
+    registry.PositiveInteger(
+        20,
+        _(
+            """
+            Number of hosts to keep alive connections for. You must reload the
+            plugin for this setting to take effect.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles,
+    "poolSize",
+    registry.PositiveInteger(
+        4,
+        _(
+            """
+            Maximum number of alive connections kept per host. You must reload the
+            plugin for this setting to take effect.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles,
+    "handlerHosts",
+    registry.SpaceSeparatedListOfStrings(
+        [],
+        _(
+            """
+            Space-separated list of domain=handler pairs adding domains to a
+            handler, e.g. youtube-nocookie.com=youtube. Subdomains are included.
+            """
+        ),
+    ),
+)
+
 # URL regex
 conf.registerChannelValue(
     SpiffyTitles,
@@ -142,6 +256,64 @@ conf.registerGlobalValue(
     ),
 )
 
+conf.registerGlobalValue(
+    SpiffyTitles,
+    "cacheChannelSize",
+    registry.NonNegativeInteger(
+        500, _("""Maximum number of links cached per channel (0 for no limit)""")
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles,
+    "cacheSize",
+    registry.NonNegativeInteger(
+        5000, _("""Maximum number of links cached in total (0 for no limit)""")
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles,
+    "cacheMaxBytes",
+    registry.NonNegativeInteger(
+        4194304,
+        _(
+            """
+            Maximum size in bytes of the URLs and titles held in the link cache
+            (0 for no limit).
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles,
+    "cacheNegativeLifetime",
+    registry.NonNegativeInteger(
+        120,
+        _(
+            """
+            Cache lifetime in seconds for links that could not be retrieved
+            (badLinkText), so dead links are not requested over and over.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles,
+    "cachePersistent",
+    registry.Boolean(
+        False,
+        _(
+            """
+            Also keep the link cache in SpiffyTitles.db in the data directory so
+            titles survive restarts and reloads.
+            """
+        ),
+    ),
+)
+
 conf.registerChannelValue(
     SpiffyTitles,
     "ignoredMessagePattern",
@@ -279,6 +451,20 @@ conf.registerChannelValue(
     ),
 )
 
+conf.registerGlobalValue(
+    SpiffyTitles.default,
+    "maxBytes",
+    registry.NonNegativeInteger(
+        262144,
+        _(
+            """
+            Maximum number of bytes of a page read while looking for its title
+            (0 for no limit). Reading stops earlier at </title> or </head>.
+            """
+        ),
+    ),
+)
+
 # default title template - show a warning if redirects to a different domain
 conf.registerChannelValue(
     SpiffyTitles.default,
@@ -444,6 +630,43 @@ conf.registerGlobalValue(
         "", _("""Youtube developer key - required for Youtube handler."""), private=True
     ),
 )
+
+# YouTube rate limits
+conf.registerGlobalValue(
+    SpiffyTitles.youtube,
+    "requestsPerMinute",
+    registry.NonNegativeInteger(
+        30,
+        _(
+            """
+            Average number of YouTube API requests allowed per minute. Links over the
+            limit use the default handler. 0 means unlimited.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles.youtube,
+    "requestBurst",
+    registry.PositiveInteger(
+        10,
+        _("""Number of YouTube API requests allowed in a quick burst"""),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles.youtube,
+    "dailyQuota",
+    registry.NonNegativeInteger(
+        10000,
+        _(
+            """
+            Number of YouTube API requests allowed per day (UTC). 0 means unlimited.
+            """
+        ),
+    ),
+)
 # YouTube Logo
 conf.registerChannelValue(
     SpiffyTitles.youtube,
@@ -486,6 +709,43 @@ conf.registerGlobalValue(
     registry.String("", _("""imgur client ID"""), private=True),
 )
 
+# imgur rate limits
+conf.registerGlobalValue(
+    SpiffyTitles.imgur,
+    "requestsPerMinute",
+    registry.NonNegativeInteger(
+        30,
+        _(
+            """
+            Average number of imgur API requests allowed per minute. Links over the
+            limit use the default handler. 0 means unlimited.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles.imgur,
+    "requestBurst",
+    registry.PositiveInteger(
+        10,
+        _("""Number of imgur API requests allowed in a quick burst"""),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles.imgur,
+    "dailyQuota",
+    registry.NonNegativeInteger(
+        12500,
+        _(
+            """
+            Number of imgur API requests allowed per day (UTC). 0 means unlimited.
+            """
+        ),
+    ),
+)
+
 conf.registerChannelValue(
     SpiffyTitles.imgur,
     "imageTemplate",
@@ -560,6 +820,67 @@ conf.registerGlobalValue(
     registry.String("", _("""Twitch API Access Token"""), private=True),
 )
 
+conf.registerGlobalValue(
+    SpiffyTitles.twitch,
+    "clientSecret",
+    registry.String(
+        "",
+        _(
+            """
+            Twitch API Client Secret, used to get an app access token when
+            accessToken is not set
+            """
+        ),
+        private=True,
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles.twitch,
+    "cacheLifetime",
+    registry.NonNegativeInteger(
+        86400,
+        _("""Number of seconds Twitch users and games are cached for"""),
+    ),
+)
+
+# Twitch rate limits
+conf.registerGlobalValue(
+    SpiffyTitles.twitch,
+    "requestsPerMinute",
+    registry.NonNegativeInteger(
+        300,
+        _(
+            """
+            Average number of Twitch API requests allowed per minute. Links over the
+            limit use the default handler. 0 means unlimited.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles.twitch,
+    "requestBurst",
+    registry.PositiveInteger(
+        30,
+        _("""Number of Twitch API requests allowed in a quick burst"""),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles.twitch,
+    "dailyQuota",
+    registry.NonNegativeInteger(
+        0,
+        _(
+            """
+            Number of Twitch API requests allowed per day (UTC). 0 means unlimited.
+            """
+        ),
+    ),
+)
+
 # Twitch Logo
 conf.registerChannelValue(
     SpiffyTitles.twitch,
@@ -655,6 +976,43 @@ conf.registerGlobalValue(
     registry.String("", _("""OMDB API Key"""), private=True),
 )
 
+# OMDB rate limits
+conf.registerGlobalValue(
+    SpiffyTitles.imdb,
+    "requestsPerMinute",
+    registry.NonNegativeInteger(
+        10,
+        _(
+            """
+            Average number of OMDB API requests allowed per minute. Links over the
+            limit use the default handler. 0 means unlimited.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles.imdb,
+    "requestBurst",
+    registry.PositiveInteger(
+        5,
+        _("""Number of OMDB API requests allowed in a quick burst"""),
+    ),
+)
+
+conf.registerGlobalValue(
+    SpiffyTitles.imdb,
+    "dailyQuota",
+    registry.NonNegativeInteger(
+        1000,
+        _(
+            """
+            Number of OMDB API requests allowed per day (UTC). 0 means unlimited.
+            """
+        ),
+    ),
+)
+
 # IMDB Logo
 conf.registerChannelValue(
     SpiffyTitles.imdb,
@@ -0,0 +1,152 @@
+###
+# Copyright (c) 2015, butterscotchstallion
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+domains: suffix index of domain names and the bundled Public Suffix List.
+"""
+
+import os
+import threading
+
+PUBLIC_SUFFIX_LIST = os.path.join(os.path.dirname(__file__), "public_suffix_list.dat")
+
+# Keys that cannot be DNS labels, used to mark trie nodes
+VALUE = ""
+EXCEPTION = "!"
+WILDCARD = "*"
+
+
+def get_labels(domain):
+    """
+    Returns the labels of a domain name from the rightmost one
+    """
+    return domain.strip(".").lower().split(".")[::-1]
+
+
+class SuffixIndex:
+    """
+    Maps domain names to values through a trie of reversed labels, so that a
+    domain finds the value of its most specific registered suffix in a single
+    walk: with imgur.com and i.imgur.com registered, m.imgur.com finds the
+    former and x.i.imgur.com the latter.
+    """
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, domain, value):
+        node = self.root
+        for label in get_labels(domain):
+            node = node.setdefault(label, {})
+        node[VALUE] = value
+
+    def find(self, domain):
+        node = self.root
+        value = None
+        for label in get_labels(domain):
+            node = node.get(label)
+            if node is None:
+                break
+            value = node.get(VALUE, value)
+        return value
+
+
+class PublicSuffixList:
+    """
+    Public suffix rules (https://publicsuffix.org/), used to find the
+    registered domain of a host name, e.g. example.co.uk for www.example.co.uk.
+    """
+
+    def __init__(self, filename=PUBLIC_SUFFIX_LIST):
+        self.root = {}
+        with open(filename, encoding="utf-8") as f:
+            for line in f:
+                rule = line.strip()
+                if rule and not rule.startswith("//"):
+                    self.add(rule.split()[0])
+
+    def add(self, rule):
+        exception = rule.startswith(EXCEPTION)
+        node = self.root
+        for label in get_labels(rule.lstrip(EXCEPTION)):
+            if not label.isascii():
+                try:
+                    label = label.encode("idna").decode("ascii")
+                except UnicodeError:
+                    pass
+            node = node.setdefault(label, {})
+        node[EXCEPTION if exception else VALUE] = True
+
+    def get_public_suffix_length(self, labels):
+        """
+        Returns how many of the reversed labels make up the public suffix. As
+        in the reference algorithm, an unlisted TLD is a public suffix itself.
+        """
+        node = self.root
+        length = 1
+        for i, label in enumerate(labels):
+            child = node.get(label)
+            if child is not None and EXCEPTION in child:
+                return i
+            if WILDCARD in node:
+                length = i + 1
+            if child is None:
+                break
+            if VALUE in child:
+                length = i + 1
+            node = child
+        return length
+
+    def get_registered_domain(self, host):
+        """
+        Returns the public suffix of host plus one label, or host itself if it
+        is a public suffix or an IP address.
+        """
+        host = host.strip(".").lower()
+        if not host or host.replace(".", "").isdigit() or ":" in host:
+            return host
+        labels = get_labels(host)
+        length = self.get_public_suffix_length(labels)
+        return ".".join(labels[: length + 1][::-1])
+
+
+public_suffix_list = None
+public_suffix_list_lock = threading.Lock()
+
+
+def get_public_suffix_list():
+    """
+    Returns the bundled Public Suffix List, parsing it on first use.
+    """
+    global public_suffix_list
+    with public_suffix_list_lock:
+        if public_suffix_list is None:
+            public_suffix_list = PublicSuffixList()
+        return public_suffix_list
@@ -0,0 +1,131 @@
+###
+# Copyright (c) 2015, butterscotchstallion
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+filters: per-channel URL extraction and domain, message and title filters.
+"""
+
+import re
+import sys
+import threading
+import unicodedata
+
+control_characters = None
+control_characters_lock = threading.Lock()
+
+
+def get_control_characters():
+    """
+    Returns a str.translate() table deleting control and format characters,
+    built on first use.
+    """
+    global control_characters
+    with control_characters_lock:
+        if control_characters is None:
+            control_characters = dict.fromkeys(
+                codepoint
+                for codepoint in range(sys.maxunicode + 1)
+                if unicodedata.category(chr(codepoint)) in ("Cc", "Cf")
+            )
+        return control_characters
+
+
+def remove_control_characters(s):
+    """
+    Removes all characters of the Unicode "Other" categories from s. Strings
+    that are all printable, like almost every URL, are returned as is.
+    """
+    if s.isprintable():
+        return s
+    s = s.translate(get_control_characters())
+    if s.isprintable():
+        return s
+    # Surrogates, private use or unassigned code points are left
+    return "".join(ch for ch in s if unicodedata.category(ch)[0] != "C")
+
+
+class ChannelFilters:
+    """
+    The compiled URL regexp and ignore/whitelist patterns of a channel.
+    Patterns that are not set are None.
+    """
+
+    def __init__(
+        self,
+        url_pattern,
+        ignored_domain_pattern=None,
+        whitelist_domain_pattern=None,
+        ignored_message_pattern=None,
+        ignored_title_pattern=None,
+    ):
+        self.url_pattern = url_pattern
+        self.ignored_domain_pattern = ignored_domain_pattern
+        self.whitelist_domain_pattern = whitelist_domain_pattern
+        self.ignored_message_pattern = ignored_message_pattern
+        self.ignored_title_pattern = ignored_title_pattern
+
+    def get_urls(self, message):
+        return self.url_pattern.findall(message)
+
+    def is_ignored_domain(self, domain):
+        """
+        Returns the part of domain matching ignoredDomainPattern, or None
+        """
+        if self.ignored_domain_pattern:
+            match = self.ignored_domain_pattern.search(domain)
+            if match:
+                return match.group()
+
+    def is_whitelisted_domain(self, domain):
+        """
+        Returns the part of domain matching whitelistDomainPattern, or None
+        """
+        if self.whitelist_domain_pattern:
+            match = self.whitelist_domain_pattern.search(domain)
+            if match:
+                return match.group()
+
+    def is_allowed_domain(self, domain):
+        """
+        Checks a domain against both the blacklist and the whitelist
+        """
+        if self.is_ignored_domain(domain):
+            return False
+        if self.whitelist_domain_pattern and not self.is_whitelisted_domain(domain):
+            return False
+        return True
+
+    def message_matches_ignore_pattern(self, message):
+        if self.ignored_message_pattern:
+            return self.ignored_message_pattern.search(message)
+
+    def title_matches_ignore_pattern(self, title):
+        if self.ignored_title_pattern:
+            return self.ignored_title_pattern.search(title)
@@ -0,0 +1,184 @@
+###
+# Copyright (c) 2015, butterscotchstallion
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+metrics: per-handler counters and latency percentiles for SpiffyTitles.
+"""
+
+import math
+import threading
+from collections import Counter, deque
+
+# Latency samples kept per handler for percentiles
+SAMPLES = 1024
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def get_percentile(samples, quantile):
+    """
+    Returns the nearest-rank quantile of a sorted list, or 0 if it is empty
+    """
+    if not samples:
+        return 0
+    rank = max(math.ceil(quantile * len(samples)) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
+
+class HandlerMetrics:
+    def __init__(self):
+        self.lookups = 0
+        self.cache_hits = 0
+        self.timeouts = 0
+        self.errors = Counter()
+        self.bytes = 0
+        self.latency_sum = 0.0
+        self.latencies = deque(maxlen=SAMPLES)
+
+    def snapshot(self):
+        latencies = sorted(self.latencies)
+        return {
+            "lookups": self.lookups,
+            "cache_hits": self.cache_hits,
+            "timeouts": self.timeouts,
+            "errors": dict(self.errors),
+            "bytes": self.bytes,
+            "latency_sum": self.latency_sum,
+            "latency": {
+                quantile: get_percentile(latencies, quantile) for quantile in QUANTILES
+            },
+        }
+
+
+class Metrics:
+    """
+    Lookup counts, cache hits, latencies, timeouts, error classes and bytes
+    downloaded, by handler name. Latency percentiles are computed over the
+    last SAMPLES lookups of each handler.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handlers = {}
+
+    def get_handler(self, handler):
+        metrics = self.handlers.get(handler)
+        if metrics is None:
+            metrics = self.handlers[handler] = HandlerMetrics()
+        return metrics
+
+    def record_lookup(self, handler, seconds):
+        with self.lock:
+            metrics = self.get_handler(handler)
+            metrics.lookups += 1
+            metrics.latency_sum += seconds
+            metrics.latencies.append(seconds)
+
+    def record_cache_hit(self, handler):
+        with self.lock:
+            self.get_handler(handler).cache_hits += 1
+
+    def record_timeout(self, handler):
+        with self.lock:
+            self.get_handler(handler).timeouts += 1
+
+    def record_error(self, handler, error_class):
+        with self.lock:
+            self.get_handler(handler).errors[error_class] += 1
+
+    def record_bytes(self, handler, size):
+        with self.lock:
+            self.get_handler(handler).bytes += size
+
+    def stats(self):
+        """
+        Returns a dict of metrics by handler name
+        """
+        with self.lock:
+            return {
+                handler: metrics.snapshot()
+                for handler, metrics in sorted(self.handlers.items())
+            }
+
+    def clear(self):
+        with self.lock:
+            self.handlers.clear()
+
+    def get_prometheus_text(self, prefix="spiffytitles"):
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        stats = self.stats()
+        lines = []
+
+        def add_metric(name, metric_type, help_text, samples):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help_text))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, metric_type))
+            for suffix, labels, value in samples:
+                labels = ",".join(
+                    '%s="%s"' % (label, str(label_value).replace('"', '\\"'))
+                    for label, label_value in labels
+                )
+                lines.append("%s_%s%s{%s} %s" % (prefix, name, suffix, labels, value))
+
+        for name, help_text in (
+            ("lookups", "Titles looked up by a handler"),
+            ("cache_hits", "Titles served from the link cache"),
+            ("timeouts", "Requests that timed out"),
+            ("bytes", "Bytes downloaded"),
+        ):
+            add_metric(
+                name + "_total",
+                "counter",
+                help_text,
+                [
+                    ("", (("handler", handler),), metrics[name])
+                    for handler, metrics in stats.items()
+                ],
+            )
+        add_metric(
+            "errors_total",
+            "counter",
+            "Failed requests by error class",
+            [
+                ("", (("handler", handler), ("class", error_class)), count)
+                for handler, metrics in stats.items()
+                for error_class, count in sorted(metrics["errors"].items())
+            ],
+        )
+        samples = []
+        for handler, metrics in stats.items():
+            for quantile, seconds in metrics["latency"].items():
+                labels = (("handler", handler), ("quantile", quantile))
+                samples.append(("", labels, "%.6f" % seconds))
+            labels = (("handler", handler),)
+            samples.append(("_sum", labels, "%.6f" % metrics["latency_sum"]))
+            samples.append(("_count", labels, metrics["lookups"]))
+        add_metric("latency_seconds", "summary", "Time taken by handlers", samples)
+        return "\n".join(lines) + "\n"
@@ -35,10 +35,21 @@ import supybot.utils as utils
 import supybot.ircdb as ircdb
 import supybot.log as log
 import supybot.conf as conf
-import re, sys, random, time, json, unicodedata, datetime
-from urllib.parse import urlparse, parse_qsl
+import supybot.schedule as schedule
+import re, sys, os, random, time, json, datetime, threading
+import concurrent.futures
+import functools
+import http.cookiejar
+from urllib.parse import urlparse, urljoin, parse_qsl
 from jinja2 import Template
 import requests
+from .cache import Batcher, LinkCache, SingleFlight, TTLCache, normalize_url
+from .domains import SuffixIndex, get_public_suffix_list
+from .filters import ChannelFilters, remove_control_characters
+from .metrics import Metrics
+from .ratelimit import RateLimited, RateLimiter, parse_retry_after
+from .store import TitleStore
+from .titleparser import parse_title
 
 try:
     from bs4 import BeautifulSoup
@@ -64,8 +75,39 @@ class SpiffyTitles(callbacks.Plugin):
     def __init__(self, irc):
         self.__parent = super(SpiffyTitles, self)
         self.__parent.__init__(irc)
-        self.link_cache = {}
+        self.link_cache = LinkCache()
+        self.title_store = None
+        self.title_store_lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.registryValue("workers"),
+            thread_name_prefix="SpiffyTitles",
+        )
         self.handlers = {}
+        self.handler_index = None
+        self.handler_hosts = ()
+        self.handler_index_lock = threading.Lock()
+        self.templates = {}
+        self.filters = {}
+        self.requests_in_flight = SingleFlight()
+        self.rate_limiter = RateLimiter()
+        self.local = threading.local()
+        self.redirect_cache = TTLCache()
+        self.twitch_cache = TTLCache()
+        self.twitch_token = (None, 0)
+        self.twitch_token_lock = threading.Lock()
+        self.twitch_batchers = {}
+        self.twitch_batchers_lock = threading.Lock()
+        self.pending_lookups = 0
+        self.pending_lookups_lock = threading.Lock()
+        self.metrics = Metrics()
+        metrics_interval = self.registryValue("metricsInterval")
+        if metrics_interval:
+            schedule.addPeriodicEvent(
+                self.write_metrics,
+                metrics_interval,
+                name="SpiffyTitles_metrics",
+                now=False,
+            )
         self.timeout = self.registryValue("timeout")
         self.add_handlers()
         self.proxies = {}
@@ -78,6 +120,173 @@ class SpiffyTitles(callbacks.Plugin):
                 proxy = "http://{0}".format(proxy)
             self.proxies["http"] = proxy
             self.proxies["https"] = proxy
+        self.session = self.get_session()
+
+    def die(self):
+        try:
+            schedule.removePeriodicEvent("SpiffyTitles_metrics")
+        except KeyError:
+            pass
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+        with self.title_store_lock:
+            if self.title_store:
+                self.title_store.close()
+                self.title_store = None
+        self.__parent.die()
+
+    def get_session(self):
+        """
+        Returns a session shared by all handlers, which keeps connections to each
+        host alive and reuses them for later requests. Cookies are never stored,
+        so one link cannot affect the next.
+        """
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.registryValue("poolConnections"),
+            pool_maxsize=self.registryValue("poolSize"),
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.proxies.update(self.proxies)
+        session.cookies.set_policy(
+            http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+        )
+        return session
+
+    def get_url(self, url, api=None, **kwargs):
+        """
+        Requests a URL through the shared session. Identical requests made at the
+        same time, e.g. for a link posted in several channels, share one response
+        unless the response is streamed. Requests to an api are counted against
+        its budget and raise RateLimited when it is exhausted.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        kwargs.setdefault("proxies", self.proxies)
+        if kwargs.get("stream"):
+            return self.send_request(self.session.get, url, **kwargs)
+        get = self.session.get
+        if api:
+            get = functools.partial(self.get_api_url, api)
+        params = kwargs.get("params") or {}
+        headers = kwargs.get("headers") or {}
+        key = (
+            "get",
+            url,
+            tuple(
+                sorted(
+                    (name, tuple(value) if isinstance(value, list) else value)
+                    for name, value in params.items()
+                )
+            ),
+            tuple(
+                sorted(
+                    (name.lower(), value)
+                    for name, value in headers.items()
+                    if name.lower() != "user-agent"
+                )
+            ),
+        )
+        try:
+            return self.requests_in_flight.do(
+                key, self.send_request, get, url, **kwargs
+            )
+        except RateLimited:
+            self.local.rate_limited = True
+            raise
+
+    def send_request(self, get, url, **kwargs):
+        """
+        Makes a request with get and records its outcome in the metrics of the
+        handler running in this thread. The body of streamed responses is
+        counted by whoever reads it.
+        """
+        handler = self.get_current_handler()
+        try:
+            response = get(url, **kwargs)
+        except requests.exceptions.Timeout:
+            self.metrics.record_timeout(handler)
+            raise
+        except RateLimited:
+            self.metrics.record_error(handler, "rate_limited")
+            raise
+        except requests.exceptions.ConnectionError:
+            self.metrics.record_error(handler, "connection")
+            raise
+        except requests.exceptions.RequestException:
+            self.metrics.record_error(handler, "request")
+            raise
+        if response.status_code >= 400:
+            self.metrics.record_error(
+                handler, "http_%sxx" % (response.status_code // 100)
+            )
+        if not kwargs.get("stream"):
+            self.metrics.record_bytes(handler, len(response.content))
+        return response
+
+    def get_current_handler(self):
+        return getattr(self.local, "handler", None) or "other"
+
+    def get_api_url(self, api, url, **kwargs):
+        """
+        Requests a URL of an API if its budget allows it, without waiting. When
+        the API answers 429 or 503, it is left alone for as long as its
+        Retry-After header asks.
+        """
+        self.rate_limiter.configure(
+            api,
+            self.registryValue("%s.requestsPerMinute" % (api)),
+            self.registryValue("%s.requestBurst" % (api)),
+            self.registryValue("%s.dailyQuota" % (api)),
+        )
+        self.rate_limiter.acquire(api)
+        response = self.session.get(url, **kwargs)
+        if response.status_code in (429, 503):
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            seconds = self.rate_limiter.back_off(api, retry_after)
+            log.warning(
+                "SpiffyTitles: %s API returned %s, backing off for %ds"
+                % (api, response.status_code, seconds)
+            )
+        elif response.ok:
+            self.rate_limiter.succeeded(api)
+        return response
+
+    def register_handler(self, domain, handler):
+        """
+        Registers a handler for a domain and all of its subdomains. The handler of
+        the most specific registered domain is used, so i.imgur.com wins over
+        imgur.com for images while m.imgur.com falls back to imgur.com.
+        """
+        with self.handler_index_lock:
+            self.handlers[domain.lower()] = handler
+            self.handler_index = None
+
+    def get_handler(self, domain):
+        """
+        Returns the handler registered for domain or its closest parent domain, or
+        None. Hosts added through handlerHosts are included.
+        """
+        handler_hosts = tuple(self.registryValue("handlerHosts"))
+        with self.handler_index_lock:
+            if self.handler_index is None or handler_hosts != self.handler_hosts:
+                self.handler_hosts = handler_hosts
+                self.handler_index = self.get_handler_index(handler_hosts)
+            handler_index = self.handler_index
+        return handler_index.find(domain)
+
+    def get_handler_index(self, handler_hosts):
+        handler_index = SuffixIndex()
+        for domain, handler in self.handlers.items():
+            handler_index.add(domain, handler)
+        for handler_host in handler_hosts:
+            domain, sep, name = handler_host.partition("=")
+            handler = getattr(self, "handler_%s" % name.strip(), None)
+            if not domain.strip() or name == "default" or not callable(handler):
+                log.error("SpiffyTitles: invalid handler host %s" % (handler_host))
+                continue
+            handler_index.add(domain.strip(), handler)
+        return handler_index
 
     def add_handlers(self):
         """
@@ -180,7 +389,8 @@ class SpiffyTitles(callbacks.Plugin):
             ircmsgs.isCtcp(msg) or ircmsgs.isAction(msg)
         ):
             return
-        if self.message_matches_ignore_pattern(message, channel):
+        filters = self.get_filters(channel)
+        if filters.message_matches_ignore_pattern(message):
             log.debug(
                 "SpiffyTitles: ignoring message due to ignoredMessagePattern match"
             )
@@ -188,56 +398,178 @@ class SpiffyTitles(callbacks.Plugin):
         if not self.is_channel_allowed(channel):
             log.debug(
                 "SpiffyTitles: not responding to link in %s due to black/white "
-                "list restrictions"
-                % (channel)
+                "list restrictions" % (channel)
             )
             return
         if self.registryValue("snarfMultipleUrls", channel=channel):
-            urls = self.get_urls_from_message(message, channel)
+            urls = filters.get_urls(message)
         else:
-            urls = self.get_urls_from_message(message, channel)[0:1]
+            urls = filters.get_urls(message)[0:1]
         if not urls:
             return
+        targets = []
         for url in urls:
             if url.strip():
-                url = self.remove_control_characters(url)
+                url = remove_control_characters(url)
                 # Check if channel is allowed based on white/black list restrictions
                 info = urlparse(url)
                 domain = info.netloc
-                is_ignored = self.is_ignored_domain(domain, channel)
+                is_ignored = filters.is_ignored_domain(domain)
                 if is_ignored:
                     log.debug(
                         "SpiffyTitles: URL ignored due to domain blacklist match: %s"
                         % url
                     )
-                    return
-                is_whitelisted_domain = self.is_whitelisted_domain(domain, channel)
-                whitelist_pattern = self.registryValue(
-                    "whitelistDomainPattern", channel=channel
-                )
-                if whitelist_pattern and not is_whitelisted_domain:
+                    break
+                if not filters.is_allowed_domain(domain):
                     log.debug(
                         "SpiffyTitles: URL ignored due to domain whitelist mismatch: %s"
                         % url
                     )
+                    break
+                if url not in targets:
+                    targets.append(url)
+        if not targets:
+            return
+        if self.registryValue("backgroundLookups"):
+            self.reply_titles_later(irc, channel, targets, msg.nick, filters)
+            return
+        titles = self.get_titles_by_urls(targets, channel, msg.nick)
+        try:
+            for url, title in titles:
+                if not self.reply_title(irc, channel, url, title, filters):
                     return
-                title = self.get_title_by_url(url, channel, msg.nick)
-                if title:
-                    prefixed = self.registryValue("prefixNick", channel=channel)
-                    ignore_match = self.title_matches_ignore_pattern(title, channel)
-                    if ignore_match:
-                        return
-                    elif not is_ignored:
-                        irc.reply(title, prefixNick=prefixed)
-                else:
-                    if self.registryValue("default.enabled", channel):
-                        log.debug("SpiffyTitles: could not get a title for %s" % (url))
-                    else:
+        finally:
+            titles.close()
+
+    def reply_title(self, irc, channel, url, title, filters):
+        """
+        Replies with the title of a link from a channel message. Returns False if
+        the title matches ignoredTitlePattern and the remaining links of the
+        message should be skipped.
+        """
+        if title:
+            prefixed = self.registryValue("prefixNick", channel=channel)
+            ignore_match = filters.title_matches_ignore_pattern(title)
+            if ignore_match:
+                log.debug(
+                    "SpiffyTitles: title %s matches ignoredTitlePattern for %s"
+                    % (title, channel)
+                )
+                return False
+            irc.reply(title, prefixNick=prefixed)
+        else:
+            if self.registryValue("default.enabled", channel):
+                log.debug("SpiffyTitles: could not get a title for %s" % (url))
+            else:
+                log.debug(
+                    "SpiffyTitles: could not get a title for %s but default    "
+                    "                                handler is disabled" % (url)
+                )
+        return True
+
+    def reply_titles_later(self, irc, channel, urls, origin_nick, filters):
+        """
+        Submits the links of a message to the worker pool without waiting for
+        them, for backgroundLookups. Titles are replied in order as they arrive,
+        within messageTimeout seconds. The links are dropped if there would be
+        more than maxPendingLookups lookups waiting for the pool.
+        """
+        max_pending = self.registryValue("maxPendingLookups")
+        with self.pending_lookups_lock:
+            if max_pending and self.pending_lookups + len(urls) > max_pending:
+                log.debug(
+                    "SpiffyTitles: dropping %s links from %s, %s lookups pending"
+                    % (len(urls), channel, self.pending_lookups)
+                )
+                return
+            self.pending_lookups += len(urls)
+        message_timeout = self.registryValue("messageTimeout")
+        deadline = time.monotonic() + message_timeout
+        titles = [None] * len(urls)
+        done = [False] * len(urls)
+        state = {"next": 0}
+        lock = threading.RLock()
+        futures = []
+
+        def stop():
+            state["next"] = len(urls)
+            for future in futures:
+                future.cancel()
+
+        def finished(index, future):
+            with self.pending_lookups_lock:
+                self.pending_lookups -= 1
+            with lock:
+                if future.cancelled():
+                    return
+                try:
+                    titles[index] = future.result()
+                except Exception:
+                    log.exception(
+                        "SpiffyTitles: error getting title for %s" % (urls[index])
+                    )
+                done[index] = True
+                while state["next"] < len(urls) and done[state["next"]]:
+                    url = urls[state["next"]]
+                    if message_timeout > 0 and time.monotonic() > deadline:
                         log.debug(
-                            "SpiffyTitles: could not get a title for %s but default    "
-                            "                                handler is disabled"
-                            % (url)
+                            "SpiffyTitles: gave up on %s after %s seconds"
+                            % (url, message_timeout)
                         )
+                        stop()
+                        return
+                    title = titles[state["next"]]
+                    state["next"] += 1
+                    if not self.reply_title(irc, channel, url, title, filters):
+                        stop()
+                        return
+
+        with lock:
+            for index, url in enumerate(urls):
+                future = self.executor.submit(
+                    self.get_title_by_url, url, channel, origin_nick
+                )
+                futures.append(future)
+                future.add_done_callback(functools.partial(finished, index))
+
+    def get_titles_by_urls(self, urls, channel, origin_nick=None):
+        """
+        Generates (url, title) pairs in the order the URLs were given. Several URLs
+        are fetched at the same time on the worker pool, and the ones that are not
+        done within messageTimeout seconds are given up on.
+        """
+        if len(urls) == 1:
+            yield (urls[0], self.get_title_by_url(urls[0], channel, origin_nick))
+            return
+        message_timeout = self.registryValue("messageTimeout")
+        deadline = time.monotonic() + message_timeout
+        futures = []
+        for url in urls:
+            future = self.executor.submit(
+                self.get_title_by_url, url, channel, origin_nick
+            )
+            futures.append((url, future))
+        try:
+            for url, future in futures:
+                timeout = None
+                if message_timeout > 0:
+                    timeout = max(deadline - time.monotonic(), 0)
+                try:
+                    title = future.result(timeout=timeout)
+                except concurrent.futures.TimeoutError:
+                    log.debug(
+                        "SpiffyTitles: gave up on %s after %s seconds"
+                        % (url, message_timeout)
+                    )
+                    return
+                except Exception:
+                    log.exception("SpiffyTitles: error getting title for %s" % (url))
+                    title = None
+                yield (url, title)
+        finally:
+            for url, future in futures:
+                future.cancel()
 
     def handler_default(self, url, channel):
         """
@@ -245,10 +577,8 @@ class SpiffyTitles(callbacks.Plugin):
         """
         if self.registryValue("default.enabled", channel):
             log.debug("SpiffyTitles: calling default handler for %s" % (url))
-            default_template = Template(
-                self.registryValue("default.template", channel=channel)
-            )
-            (title, is_redirect) = self.get_source_by_url(url, channel)
+            default_template = self.get_template("default.template", channel)
+            title, is_redirect = self.get_source_by_url(url, channel)
             if title:
                 title_template = default_template.render(
                     title=title, redirect=is_redirect
@@ -277,69 +607,159 @@ class SpiffyTitles(callbacks.Plugin):
         cached_link = self.get_link_from_cache(url, channel)
         if cached_link:
             title = cached_link["title"]
+            self.metrics.record_cache_hit(self.get_handler_name(cached_link["handler"]))
         else:
-            if domain in self.handlers:
-                handler = self.handlers[domain]
-                title = handler(url, info, channel)
-            else:
-                base_domain = self.get_base_domain("http://" + domain)
-                if base_domain in self.handlers:
-                    handler = self.handlers[base_domain]
-                    title = handler(url, info, channel)
-                else:
-                    if self.registryValue("default.enabled", channel):
-                        title = self.handler_default(url, channel)
+            self.local.rate_limited = False
+            handler = self.get_handler(info.hostname or domain)
+            if handler:
+                title = self.call_handler(handler, url, info, channel)
+            elif self.registryValue("default.enabled", channel):
+                handler = self.handler_default
+                title = self.call_handler(handler, url, channel)
         if title and not cached_link:
             title = self.get_formatted_title(title, channel)
-            # Update link cache
-            log.debug("SpiffyTitles: caching %s" % (url))
-            now = datetime.datetime.now()
-            if channel not in self.link_cache:
-                self.link_cache[channel] = []
-            self.link_cache[channel].append(
-                {
-                    "url": url,
-                    "timestamp": now,
-                    "title": title,
-                    "from": origin_nick,
-                    "channel": channel,
-                }
+            self.add_link_to_cache(
+                url,
+                channel,
+                title,
+                handler.__name__,
+                origin_nick,
+                degraded=self.local.rate_limited,
             )
         elif title and cached_link:
-            self.link_cache[channel].append(cached_link)
             log.debug("SpiffyTitles: serving link from cache: %s" % (url))
         return title
 
+    def call_handler(self, handler, *args):
+        """
+        Calls a handler and records how long it took. Requests made meanwhile
+        from this thread are accounted to it.
+        """
+        name = self.get_handler_name(handler.__name__)
+        # Redirects can look up another link from within a handler
+        outer_handler = getattr(self.local, "handler", None)
+        self.local.handler = name
+        start = time.monotonic()
+        try:
+            return handler(*args)
+        except Exception:
+            self.metrics.record_error(name, "exception")
+            raise
+        finally:
+            self.metrics.record_lookup(name, time.monotonic() - start)
+            self.local.handler = outer_handler
+
+    def get_handler_name(self, handler_name):
+        if handler_name and handler_name.startswith("handler_"):
+            return handler_name[len("handler_") :]
+        return handler_name or "other"
+
     def get_link_from_cache(self, url, channel):
         """
         Looks for a URL in the link cache and returns info about if it's not stale
         according to the configured cache lifetime, or None. If cacheLifetime is 0,
-        then cache is disabled and we can immediately return
+        then cache is disabled and we can immediately return. Links missing from
+        memory are loaded from the persistent cache when it is enabled.
         """
         cache_lifetime_in_seconds = int(self.registryValue("cacheLifetime"))
         if cache_lifetime_in_seconds == 0:
             return
-        # No cache yet
-        if len(self.link_cache) == 0:
-            return
-        cached_link = None
-        now = datetime.datetime.now()
-        stale = False
-        seconds = 0
-        if channel in self.link_cache:
-            for i in range(len(self.link_cache[channel])):
-                if self.link_cache[channel][i]["url"] == url:
-                    cached_link = self.link_cache[channel].pop(i)
-                    break
-        # Found link, check timestamp
+        self.link_cache.configure(
+            cache_lifetime_in_seconds,
+            self.registryValue("cacheChannelSize"),
+            self.registryValue("cacheSize"),
+            self.registryValue("cacheMaxBytes"),
+        )
+        url = normalize_url(url)
+        cached_link = self.link_cache.get(channel, url)
         if cached_link:
-            seconds = (now - cached_link["timestamp"]).total_seconds()
-            if seconds >= cache_lifetime_in_seconds:
-                stale = True
-        if stale:
-            log.debug("SpiffyTitles: %s was sent %s seconds ago" % (url, seconds))
-        else:
             return cached_link
+        title_store = self.get_title_store()
+        if not title_store:
+            return
+        row = title_store.get(channel, url)
+        if not row:
+            return
+        cached_link = self.make_cached_link(
+            url, channel, row["title"], row["handler"], row["fetched"], row["negative"]
+        )
+        seconds = time.time() - row["fetched"]
+        if seconds >= cached_link.get("lifetime", cache_lifetime_in_seconds):
+            log.debug("SpiffyTitles: %s was sent %s seconds ago" % (url, seconds))
+            return
+        log.debug("SpiffyTitles: loaded %s from the persistent cache" % (url))
+        self.link_cache.set(channel, url, cached_link)
+        return cached_link
+
+    def add_link_to_cache(
+        self, url, channel, title, handler_name, origin_nick=None, degraded=False
+    ):
+        """
+        Caches a title in memory and, if enabled, in the persistent cache. Titles
+        for bad links, and degraded titles of links whose API was rate limited,
+        are kept for cacheNegativeLifetime seconds only.
+        """
+        cache_lifetime_in_seconds = int(self.registryValue("cacheLifetime"))
+        if cache_lifetime_in_seconds == 0:
+            return
+        log.debug("SpiffyTitles: caching %s" % (url))
+        url = normalize_url(url)
+        now = time.time()
+        negative = degraded or self.is_bad_link_title(title, channel)
+        cached_link = self.make_cached_link(
+            url, channel, title, handler_name, now, negative, origin_nick
+        )
+        self.link_cache.set(channel, url, cached_link)
+        title_store = self.get_title_store()
+        if title_store:
+            title_store.set(channel, url, handler_name, title, now, negative)
+            if title_store.needs_pruning():
+                title_store.prune(
+                    cache_lifetime_in_seconds,
+                    self.registryValue("cacheNegativeLifetime"),
+                )
+
+    def make_cached_link(
+        self, url, channel, title, handler_name, timestamp, negative, origin_nick=None
+    ):
+        cached_link = {
+            "url": url,
+            "timestamp": timestamp,
+            "title": title,
+            "from": origin_nick,
+            "channel": channel,
+            "handler": handler_name,
+        }
+        if negative:
+            cached_link["lifetime"] = min(
+                self.registryValue("cacheNegativeLifetime"),
+                self.registryValue("cacheLifetime"),
+            )
+        return cached_link
+
+    def is_bad_link_title(self, title, channel):
+        """
+        Checks whether a title was rendered from badLinkText
+        """
+        bad_link_text = self.registryValue("badLinkText", channel=channel)
+        return bool(bad_link_text) and bad_link_text in title
+
+    def get_title_store(self):
+        """
+        Returns the persistent title cache, opening it on first use, or None if
+        cachePersistent is disabled.
+        """
+        if not self.registryValue("cachePersistent"):
+            return
+        with self.title_store_lock:
+            if self.title_store is None:
+                filename = conf.supybot.directories.data.dirize("SpiffyTitles.db")
+                self.title_store = TitleStore(filename)
+                self.title_store.prune(
+                    self.registryValue("cacheLifetime"),
+                    self.registryValue("cacheNegativeLifetime"),
+                )
+            return self.title_store
 
     def is_channel_allowed(self, channel):
         """
@@ -369,35 +789,42 @@ class SpiffyTitles(callbacks.Plugin):
         """
         return set([channel for channel in input if len(channel.strip())])
 
+    def get_filters(self, channel):
+        """
+        Returns the compiled URL regexp and ignore/whitelist patterns for
+        channel. They are only rebuilt when one of the settings changes.
+        """
+        key = (
+            self.registryValue("urlRegexp", channel),
+            self.registryValue("ignoredDomainPattern", channel=channel),
+            self.registryValue("whitelistDomainPattern", channel=channel),
+            self.registryValue("ignoredMessagePattern", channel=channel),
+            self.registryValue("ignoredTitlePattern", channel=channel),
+        )
+        cached = self.filters.get(channel)
+        if cached and cached[0] == key:
+            return cached[1]
+        url_re = key[0] or utils.web._httpUrlRe
+        try:
+            url_pattern = re.compile(url_re)
+        except re.error:
+            log.error("SpiffyTitles: invalid regular expression: %s" % (url_re))
+            url_pattern = re.compile(utils.web._httpUrlRe)
+        filters = ChannelFilters(url_pattern, *key[1:])
+        self.filters[channel] = (key, filters)
+        return filters
+
     def is_ignored_domain(self, domain, channel):
         """
         Checks domain against a regular expression
         """
-        pattern = self.registryValue("ignoredDomainPattern", channel=channel)
-        if pattern:
-            log.debug("SpiffyTitles: matching %s against %s" % (domain, str(pattern)))
-            try:
-                pattern_search_result = re.search(pattern, domain)
-                if pattern_search_result:
-                    match = pattern_search_result.group()
-                    return match
-            except re.error:
-                log.error("SpiffyTitles: invalid regular expression: %s" % (pattern))
+        return self.get_filters(channel).is_ignored_domain(domain)
 
     def is_whitelisted_domain(self, domain, channel):
         """
         Checks domain against a regular expression
         """
-        pattern = self.registryValue("whitelistDomainPattern", channel=channel)
-        if pattern:
-            log.debug("SpiffyTitles: matching %s against %s" % (domain, str(pattern)))
-            try:
-                pattern_search_result = re.search(pattern, domain)
-                if pattern_search_result:
-                    match = pattern_search_result.group()
-                    return match
-            except re.error:
-                log.error("SpiffyTitles: invalid regular expression: %s" % (pattern))
+        return self.get_filters(channel).is_whitelisted_domain(domain)
 
     def get_formatted_title(self, title, channel):
         """
@@ -410,133 +837,192 @@ class SpiffyTitles(callbacks.Plugin):
             title = ircutils.bold(title).strip()
         return title
 
-    def get_title_from_html(self, html, channel):
-        """
-        Retrieves value of <title> tag from HTML
-        """
-        title = None
-        soup = BeautifulSoup(html)
-        if soup:
-            try:
-                title = soup.title.string.strip()
-            except:
-                title = self.registryValue("badLinkText", channel=channel)
-        return title
-
-    def get_source_by_url(self, url, channel, retries=1):
+    def get_source_by_url(self, url, channel):
         """
-        Get the HTML of a website based on a URL
+        Follows the redirects of a link one hop at a time and returns the title of
+        the page it ends on, along with whether that page is on another site.
+        Hops to other sites are checked against the domain filters, and the first
+        one with a handler is looked up by that handler instead.
         """
-        max_retries = self.registryValue("maxRetries")
-        if retries >= max_retries:
-            log.debug("SpiffyTitles: hit maximum retries for %s" % url)
-            return (None, False)
-        log.debug("SpiffyTitles: attempt #%s for %s" % (retries, url))
+        filters = self.get_filters(channel)
+        headers = self.get_headers(channel)
+        link_domain = self.get_base_domain(url)
         is_redirect = False
-        try:
-            headers = self.get_headers(channel)
-            log.debug("SpiffyTitles: requesting %s" % (url))
-            with requests.get(
-                url,
-                headers=headers,
-                timeout=self.timeout,
-                allow_redirects=True,
-                stream=True,
-                proxies=self.proxies,
-            ) as request:
-                request.raise_for_status()
-                if request.history:
-                    # check the top two domain levels
-                    link_domain = self.get_base_domain(request.history[0].url)
-                    real_domain = self.get_base_domain(request.url)
-                    if link_domain != real_domain:
-                        is_redirect = True
-                        for redir in request.history:
-                            log.debug(
-                                "SpiffyTitles: Redirect %s from %s"
-                                % (redir.status_code, redir.url)
-                            )
-                        log.debug("SpiffyTitles: Final url %s" % (request.url))
-                        info = urlparse(request.url)
-                        domain = info.netloc
-                        is_ignored = self.is_ignored_domain(domain, channel)
-                        if is_ignored:
-                            log.debug(
-                                "SpiffyTitles: URL ignored due to domain blacklist"
-                                " match: %s"
-                                % url
-                            )
-                            return
-                        whitelist_pattern = self.registryValue(
-                            "whitelistDomainPattern", channel=channel
-                        )
-                        is_whitelisted_domain = self.is_whitelisted_domain(
-                            domain, channel
-                        )
-                        if whitelist_pattern and not is_whitelisted_domain:
-                            log.debug(
-                                "SpiffyTitles: URL ignored due to domain whitelist"
-                                " mismatch: %s"
-                                % url
-                            )
-                            return
-                        text = self.get_title_by_url(request.url, channel)
-                        text = text.lstrip("\x02").lstrip("^").strip()
-                        return (text, is_redirect)
-                # Check the content type
-                content_type = request.headers.get("content-type").split(";")[0].strip()
-                acceptable_types = self.registryValue("default.mimeTypes")
-                log.debug("SpiffyTitles: content type %s" % (content_type))
-                if content_type in acceptable_types:
-                    text = request.content
-                    if text:
-                        return (self.get_title_from_html(text, channel), is_redirect)
-                    else:
-                        log.debug("SpiffyTitles: empty content from %s" % (url))
-                else:
+        hops = 0
+        while True:
+            if hops:
+                info = urlparse(url)
+                domain = info.netloc
+                is_redirect = self.get_base_domain(url) != link_domain
+            if hops and is_redirect:
+                if filters.is_ignored_domain(domain):
                     log.debug(
-                        "SpiffyTitles: unacceptable mime type %s for url %s"
-                        % (content_type, url)
-                    )
-                    size = request.headers.get("content-length")
-                    if size:
-                        size = self.get_readable_file_size(int(size))
-                    file_template = self.registryValue(
-                        "default.fileTemplate", channel=channel
+                        "SpiffyTitles: URL ignored due to domain blacklist"
+                        " match: %s" % url
                     )
-                    text = Template(file_template).render(
-                        {"type": content_type, "size": size}
+                    return (None, False)
+                if not filters.is_allowed_domain(domain):
+                    log.debug(
+                        "SpiffyTitles: URL ignored due to domain whitelist"
+                        " mismatch: %s" % url
                     )
+                    return (None, False)
+                handler = self.get_handler(info.hostname or domain)
+                if handler and not getattr(self.local, "redirected", False):
+                    log.debug("SpiffyTitles: handing %s to its handler" % url)
+                    self.local.redirected = True
+                    try:
+                        text = self.call_handler(handler, url, info, channel)
+                    finally:
+                        self.local.redirected = False
+                    if text:
+                        text = text.lstrip("\x02").lstrip("^").strip()
                     return (text, is_redirect)
-        except requests.exceptions.MissingSchema as e:
-            url_wschema = "http://%s" % (url)
-            log.error("SpiffyTitles missing schema. Retrying with %s" % (url_wschema))
-            info = urlparse(url_wschema)
-            if self.is_ignored_domain(info.netloc, channel):
-                return
+            try:
+                page = self.get_page(url, headers)
+            except requests.exceptions.MissingSchema:
+                url = "http://%s" % (url)
+                log.error("SpiffyTitles missing schema. Retrying with %s" % (url))
+                if self.is_ignored_domain(urlparse(url).netloc, channel):
+                    return (None, False)
+                link_domain = self.get_base_domain(url)
+                continue
+            except (
+                requests.exceptions.HTTPError,
+                requests.exceptions.InvalidURL,
+            ) as e:
+                log.error("SpiffyTitles %s: %s" % (type(e).__name__, str(e)))
+                text = self.registryValue("badLinkText", channel=channel)
+                return (text, is_redirect)
+            if not page:
+                return (None, False)
+            if page["location"]:
+                hops += 1
+                log.debug(
+                    "SpiffyTitles: Redirect %s from %s" % (page["status_code"], url)
+                )
+                if hops > self.session.max_redirects:
+                    log.error("SpiffyTitles: too many redirects for %s" % (url))
+                    text = self.registryValue("badLinkText", channel=channel)
+                    return (text, is_redirect)
+                url = page["location"]
+                continue
+            if hops:
+                log.debug("SpiffyTitles: Final url %s" % (url))
+            break
+        # Check the content type
+        content_type = page["content_type"]
+        log.debug("SpiffyTitles: content type %s" % (content_type))
+        if page["is_html"]:
+            if page["size"]:
+                title = page["title"]
+                if not title:
+                    title = self.registryValue("badLinkText", channel=channel)
+                return (title, is_redirect)
             else:
-                return self.get_source_by_url(url_wschema, channel)
-        except requests.exceptions.Timeout as e:
-            log.error("SpiffyTitles Timeout: %s" % (str(e)))
-            self.get_source_by_url(url, channel, retries + 1)
-        except requests.exceptions.ConnectionError as e:
-            log.error("SpiffyTitles ConnectionError: %s" % (str(e)))
-            self.get_source_by_url(url, channel, retries + 1)
-        except requests.exceptions.HTTPError as e:
-            log.error("SpiffyTitles HTTPError: %s" % (str(e)))
-            text = self.registryValue("badLinkText", channel=channel)
-            return (text, is_redirect)
-        except requests.exceptions.InvalidURL as e:
-            log.error("SpiffyTitles InvalidURL: %s" % (str(e)))
-            text = self.registryValue("badLinkText", channel=channel)
+                log.debug("SpiffyTitles: empty content from %s" % (url))
+        else:
+            log.debug(
+                "SpiffyTitles: unacceptable mime type %s for url %s"
+                % (content_type, url)
+            )
+            size = page["content_length"]
+            if size:
+                size = self.get_readable_file_size(int(size))
+            file_template = self.get_template("default.fileTemplate", channel)
+            text = file_template.render({"type": content_type, "size": size})
             return (text, is_redirect)
         return (None, False)
 
+    def get_page(self, url, headers):
+        """
+        Returns the page of url, or where it redirects to if that is known from an
+        earlier lookup. Timeouts and connection errors are retried up to
+        maxRetries, after which None is returned.
+        """
+        redirect_cache = self.get_redirect_cache()
+        if redirect_cache:
+            redirect = redirect_cache.get(normalize_url(url))
+            if redirect:
+                return redirect
+        max_retries = self.registryValue("maxRetries")
+        for retries in range(1, max_retries):
+            log.debug("SpiffyTitles: attempt #%s for %s" % (retries, url))
+            try:
+                return self.requests_in_flight.do(
+                    ("page", normalize_url(url), headers["Accept-Language"]),
+                    self.fetch_page,
+                    url,
+                    headers,
+                )
+            except requests.exceptions.Timeout as e:
+                log.error("SpiffyTitles Timeout: %s" % (str(e)))
+            except requests.exceptions.ConnectionError as e:
+                log.error("SpiffyTitles ConnectionError: %s" % (str(e)))
+        log.debug("SpiffyTitles: hit maximum retries for %s" % url)
+
+    def get_redirect_cache(self):
+        """
+        Returns the cache of redirect targets, which keeps them as long as titles
+        are kept in the link cache, or None when the link cache is disabled.
+        """
+        cache_lifetime_in_seconds = int(self.registryValue("cacheLifetime"))
+        if cache_lifetime_in_seconds == 0:
+            return
+        self.redirect_cache.lifetime = cache_lifetime_in_seconds
+        return self.redirect_cache
+
+    def fetch_page(self, url, headers):
+        """
+        Requests a page without following redirects and returns its raw metadata:
+        the redirect target for redirects, otherwise the content type and length,
+        and the title for HTML pages.
+        """
+        log.debug("SpiffyTitles: requesting %s" % (url))
+        with self.get_url(
+            url, headers=headers, allow_redirects=False, stream=True
+        ) as request:
+            if request.is_redirect:
+                # Read the body so the connection can be reused
+                request.content
+                redirect = {
+                    "status_code": request.status_code,
+                    "location": urljoin(
+                        request.url, self.session.get_redirect_target(request)
+                    ),
+                }
+                redirect_cache = self.get_redirect_cache()
+                if redirect_cache:
+                    redirect_cache.set(normalize_url(url), redirect)
+                return redirect
+            request.raise_for_status()
+            content_type = request.headers.get("content-type").split(";")[0].strip()
+            page = {
+                "status_code": request.status_code,
+                "location": None,
+                "content_type": content_type,
+                "content_length": request.headers.get("content-length"),
+                "is_html": content_type in self.registryValue("default.mimeTypes"),
+                "title": None,
+                "size": 0,
+            }
+            if page["is_html"]:
+                page["title"], page["size"] = parse_title(
+                    request.iter_content(chunk_size=16384),
+                    request.headers.get("content-type"),
+                    self.registryValue("default.maxBytes"),
+                )
+                self.metrics.record_bytes(self.get_current_handler(), page["size"])
+            return page
+
     def get_base_domain(self, url):
         """
-        Returns the FQDN comprising the top two domain levels
+        Returns the registered domain of a URL according to the bundled Public
+        Suffix List, e.g. example.co.uk for https://www.example.co.uk/
         """
-        return ".".join(urlparse(url).netloc.rsplit(".", 2)[-2:])
+        info = urlparse(url)
+        host = info.hostname or info.netloc
+        return get_public_suffix_list().get_registered_domain(host)
 
     def get_headers(self, channel):
         agent = self.get_user_agent()
@@ -559,40 +1045,29 @@ class SpiffyTitles(callbacks.Plugin):
         Checks message against ignoredMessagePattern to determine
         whether the message should be ignored.
         """
-        match = False
-        pattern = self.registryValue("ignoredMessagePattern")
-        if pattern:
-            match = re.search(pattern, input)
-        return match
+        return self.get_filters(channel).message_matches_ignore_pattern(input)
 
     def title_matches_ignore_pattern(self, input, channel):
         """
         Checks message against ignoredTitlePattern to determine
         whether the title should be ignored.
         """
-        match = False
-        pattern = self.registryValue("ignoredTitlePattern", channel=channel)
-        if pattern:
-            match = re.search(pattern, input)
-            if match:
-                log.debug(
-                    "SpiffyTitles: title %s matches ignoredTitlePattern for %s"
-                    % (input, channel)
-                )
+        match = self.get_filters(channel).title_matches_ignore_pattern(input)
+        if match:
+            log.debug(
+                "SpiffyTitles: title %s matches ignoredTitlePattern for %s"
+                % (input, channel)
+            )
         return match
 
     def get_urls_from_message(self, input, channel):
         """
         Find the first string that looks like a URL from the message
         """
-        url_re = self.registryValue("urlRegexp", channel)
-        if not url_re:
-            url_re = utils.web._httpUrlRe
-        matches = re.findall(url_re, input)
-        return matches
+        return self.get_filters(channel).get_urls(input)
 
     def remove_control_characters(self, s):
-        return "".join(ch for ch in s if unicodedata.category(ch)[0] != "C")
+        return remove_control_characters(s)
 
     def user_has_capability(self, msg):
         channel = msg.args[0]
@@ -622,11 +1097,19 @@ class SpiffyTitles(callbacks.Plugin):
             num /= 1024.0
         return "%.1f%s%s" % (num, "Yi", suffix)
 
-    def get_template(self, handler_template, channel):
+    def get_template(self, handler_template, channel=None):
         """
-        Returns the requested template object.
+        Returns the requested template object. Templates are compiled once per
+        distinct template string, so channels sharing a template share the compiled
+        object, and changing the config value compiles the new template.
         """
-        template = Template(self.registryValue(handler_template, channel=channel))
+        source = self.registryValue(handler_template, channel=channel)
+        template = self.templates.get(source)
+        if template is None:
+            template = Template(source)
+            if len(self.templates) >= 256:
+                self.templates.clear()
+            self.templates[source] = template
         return template
 
     def handler_dailymotion(self, url, info, channel):
@@ -652,10 +1135,13 @@ class SpiffyTitles(callbacks.Plugin):
             )
             return self.handler_default(url, channel)
         fields = "id,title,owner.screenname,duration,views_total"
-        api_url = "https://api.dailymotion.com/video/%s?fields=%s" % (video_id, fields,)
+        api_url = "https://api.dailymotion.com/video/%s?fields=%s" % (
+            video_id,
+            fields,
+        )
         log.debug("SpiffyTitles: looking up dailymotion info: %s", api_url)
         try:
-            request = requests.get(api_url, timeout=self.timeout, proxies=self.proxies)
+            request = self.get_url(api_url)
             request.raise_for_status()
         except (
             requests.exceptions.RequestException,
@@ -666,9 +1152,7 @@ class SpiffyTitles(callbacks.Plugin):
         response = json.loads(request.content.decode())
         if response and "title" in response:
             video = response
-            dailymotion_template = Template(
-                self.registryValue("dailymotion.template", channel=channel)
-            )
+            dailymotion_template = self.get_template("dailymotion.template", channel)
             video["views_total"] = "{:,}".format(int(video["views_total"]))
             video["duration"] = self.get_duration_from_seconds(video["duration"])
             video["ownerscreenname"] = video["owner.screenname"]
@@ -703,7 +1187,7 @@ class SpiffyTitles(callbacks.Plugin):
         api_url = "https://vimeo.com/api/v2/video/%s.json" % video_id
         log.debug("SpiffyTitles: looking up vimeo info: %s", api_url)
         try:
-            request = requests.get(api_url, timeout=self.timeout, proxies=self.proxies)
+            request = self.get_url(api_url)
             request.raise_for_status()
         except (
             requests.exceptions.RequestException,
@@ -714,9 +1198,7 @@ class SpiffyTitles(callbacks.Plugin):
         response = json.loads(request.content.decode())
         if response and "title" in response[0]:
             video = response[0]
-            vimeo_template = Template(
-                self.registryValue("vimeo.template", channel=channel)
-            )
+            vimeo_template = self.get_template("vimeo.template", channel)
             """
             Some videos do not have this information available
             """
@@ -763,7 +1245,7 @@ class SpiffyTitles(callbacks.Plugin):
             return self.handler_default(url, channel)
         api_url = "http://coub.com/api/v2/coubs/%s" % video_id
         try:
-            request = requests.get(api_url, timeout=self.timeout, proxies=self.proxies)
+            request = self.get_url(api_url)
             request.raise_for_status()
         except (
             requests.exceptions.RequestException,
@@ -774,7 +1256,7 @@ class SpiffyTitles(callbacks.Plugin):
         response = json.loads(request.content.decode())
         if response:
             video = response
-            coub_template = Template(self.registryValue("coub.template"))
+            coub_template = self.get_template("coub.template")
             video["likes_count"] = "{:,}".format(int(video["likes_count"]))
             video["recoubs_count"] = "{:,}".format(int(video["recoubs_count"]))
             video["views_count"] = "{:,}".format(int(video["views_count"]))
@@ -831,7 +1313,7 @@ class SpiffyTitles(callbacks.Plugin):
                 "SpiffyTitles: Failed to get YouTube video ID for URL: {0}".format(url)
             )
             return self.handler_default(url, channel)
-        yt_template = Template(self.registryValue("youtube.template", channel))
+        yt_template = self.get_template("youtube.template", channel)
         title = ""
         options = {
             "part": "snippet,statistics,contentDetails",
@@ -842,9 +1324,7 @@ class SpiffyTitles(callbacks.Plugin):
         api_url = "https://www.googleapis.com/youtube/v3/videos"
         log.debug("SpiffyTitles: requesting %s" % (api_url))
         try:
-            request = requests.get(
-                api_url, params=options, timeout=self.timeout, proxies=self.proxies
-            )
+            request = self.get_url(api_url, params=options, api="youtube")
             request.raise_for_status()
         except (
             requests.exceptions.RequestException,
@@ -933,9 +1413,9 @@ class SpiffyTitles(callbacks.Plugin):
     def get_youtube_logo(self, channel):
         use_bold = self.registryValue("useBold", channel)
         if use_bold:
-            yt_logo = "{0}\x0F\x02".format(self.registryValue("youtube.logo", channel))
+            yt_logo = "{0}\x0f\x02".format(self.registryValue("youtube.logo", channel))
         else:
-            yt_logo = "{0}\x0F".format(self.registryValue("youtube.logo", channel))
+            yt_logo = "{0}\x0f".format(self.registryValue("youtube.logo", channel))
         return yt_logo
 
     def get_total_seconds_from_duration(self, input):
@@ -995,9 +1475,12 @@ class SpiffyTitles(callbacks.Plugin):
         if not twitch_client_id:
             log.error("SpiffyTitles: Please set your Twitch client ID")
             return self.handler_default(url, channel)
-        access_token = self.registryValue("twitch.accessToken")
-        if not access_token:
-            log.error("SpiffyTitles: Please set your Twitch Access Token")
+        if not self.registryValue("twitch.accessToken") and not self.registryValue(
+            "twitch.clientSecret"
+        ):
+            log.error(
+                "SpiffyTitles: Please set your Twitch Access Token or Client Secret"
+            )
             return self.handler_default(url, channel)
         url = url.split("?")[0]
         self.log.debug("SpiffyTitles: calling twitch handler for %s" % (url))
@@ -1005,17 +1488,20 @@ class SpiffyTitles(callbacks.Plugin):
             "video": {
                 "pattern": r"^http(s)?:\/\/(www\.|go\.|player\.)?twitch\.tv\/"
                 r"(videos/|\?video=v)(?P<video_id>[0-9]+)",
-                "url": "https://api.twitch.tv/helix/videos?id={video_id}",
+                "endpoint": "videos",
+                "param": ("id", "{video_id}"),
             },
             "clip": {
                 "pattern": r"(http(s)?:\/\/clips\.twitch\.tv\/|http(s)?:\/\/"
                 r"www\.twitch\.tv\/([^\/]+)\/clip\/)(?P<clip>.+)$",
-                "url": "https://api.twitch.tv/helix/clips?id={clip}",
+                "endpoint": "clips",
+                "param": ("id", "{clip}"),
             },
             "channel": {
                 "pattern": r"^http(s)?:\/\/(www\.|go\.)?twitch\.tv\/"
                 r"(?P<channel_name>[^\/]+)",
-                "url": "https://api.twitch.tv/helix/streams?user_login={channel_name}",
+                "endpoint": "streams",
+                "param": ("user_login", "{channel_name}"),
             },
         }
         for name in patterns:
@@ -1023,82 +1509,47 @@ class SpiffyTitles(callbacks.Plugin):
             if match:
                 link_type = name
                 link_info = match.groupdict()
-                data_url = patterns[name]["url"].format(**link_info)
+                endpoint = patterns[name]["endpoint"]
+                param, value = patterns[name]["param"]
+                key = self.get_twitch_key(param, value.format(**link_info))
                 break
         if not match:
             self.log.debug("SpiffyTitles: twitch - no title found.")
             return self.handler_default(url, channel)
-        bearer = "Bearer {}".format(access_token.strip())
-        headers = {"Client-ID": twitch_client_id, "Authorization": bearer}
-        self.log.debug("SpiffyTitles: twitch - requesting %s" % (data_url))
+        self.log.debug("SpiffyTitles: twitch - requesting %s %s" % (endpoint, key))
         try:
-            request = requests.get(
-                data_url, timeout=self.timeout, headers=headers, proxies=self.proxies
-            )
-            request.raise_for_status()
+            # Streams and the channel's user are looked up at the same time
+            future = self.get_twitch_batcher(endpoint).submit(key)
+            user_data = None
+            if link_type == "channel":
+                login = key[1]
+                user_data = self.get_twitch_users(logins=[login]).get(("login", login))
+            data = future.result()
+            data = [data] if data else []
+            if link_type != "channel" and data:
+                user_id = data[0].get("broadcaster_id") or data[0].get("user_id")
+                user_data = self.get_twitch_users(ids=[user_id]).get(("id", user_id))
+            if data and data[0].get("game_id") and data[0].get("game_name"):
+                # Streams name their game, which saves a lookup for its clips
+                self.get_twitch_cache().set(
+                    ("game", data[0]["game_id"]),
+                    {"id": data[0]["game_id"], "name": data[0]["game_name"]},
+                )
         except (
             requests.exceptions.RequestException,
             requests.exceptions.HTTPError,
+            ValueError,
         ) as e:
-            log.error("SpiffytTitles: Twitch Error: {0}".format(e))
+            log.error("SpiffyTitles: Twitch Error: {0}".format(e))
             return self.handler_default(url, channel)
-        data = {}
-        try:
-            response = json.loads(request.content.decode())
-        except:
-            response = None
-        if not response:
-            log.error("SpiffyTitles: Error parsing Twitch.TV JSON response")
-            return self.handler_default(url, channel)
-        self.log.debug("SpiffyTitles: twitch - got response:\n%s" % (response))
-        if "error" in response:
-            log.error("SpiffyTitles: Twitch Error: {0}".format(response["error"]))
-            return self.handler_default(url, channel)
-        if link_type == "channel":
-            self.log.debug("SpiffyTitles: Twitch: link_type is channel")
-            if "data" in response and response["data"]:
-                self.log.debug("SpiffyTitles: Twitch: Got data[0]")
-                data = response["data"][0]
-                link_type = "stream"
-            else:
-                self.log.debug("SpiffyTitles: Twitch: No data[0]")
-            data_url = "https://api.twitch.tv/helix/users?login={channel_name}".format(
-                **link_info
-            )
-            try:
-                request = requests.get(
-                    data_url,
-                    timeout=self.timeout,
-                    headers=headers,
-                    proxies=self.proxies,
-                )
-                request.raise_for_status()
-            except (
-                requests.exceptions.RequestException,
-                requests.exceptions.HTTPError,
-            ) as e:
-                log.error("SpiffyTitles: Twitch Error: {0}".format(e))
-                return self.handler_default(url, channel)
-            user_data = {}
-            try:
-                response = json.loads(request.content.decode())
-                user_data = response["data"][0]
-                display_name = user_data["display_name"]
-                description = user_data["description"]
-                view_count = user_data["view_count"]
-            except Exception as e:
-                log.error(
-                    "SpiffyTitles: KeyError parsing Twitch.TV JSON response: %s"
-                    % (str(e))
-                )
-        elif link_type == "video":
-            data = response
-        elif link_type == "clip":
-            data = response
+        self.log.debug("SpiffyTitles: twitch - got data:\n%s" % (data))
+        if link_type == "channel" and data:
+            link_type = "stream"
         if not data and not user_data:
             log.error("SpiffyTitles: Twitch: Failed to get data from Twitch API")
             return self.handler_default(url, channel)
-        log.debug("SpiffyTitles: twitch - Got data '%s'" % (data))
+        user_data = user_data or {}
+        data = data[0] if data else {}
         twitch_template = self.get_template(
             "".join(["twitch.", link_type, "Template"]), channel
         )
@@ -1107,138 +1558,212 @@ class SpiffyTitles(callbacks.Plugin):
             self.log.debug("SpiffyTitles - twitch: bad template for %s" % (link_type))
             log.error("SpiffyTitles: Twitch: Got data, but template was bad")
             return self.handler_default(url, channel)
-        if link_type == "stream":
-            display_name = data["user_name"]
-            game_id = data["game_id"]
-            game_name = game_id
-            title = data["title"]
-            view_count = data["viewer_count"]
-            created_at = self._time_created_at(data["started_at"])
-            if game_id:
-                get_game = requests.get(
-                    "https://api.twitch.tv/helix/games?id={}".format(game_id),
-                    timeout=self.timeout,
-                    headers=headers,
-                    proxies=self.proxies,
-                )
-                game_data = json.loads(get_game.content.decode())
-                game_name = game_data["data"][0]["name"]
-            template_vars = {
-                "display_name": display_name,
-                "game_name": game_name,
-                "title": title,
-                "view_count": view_count,
-                "description": description,
-                "created_at": created_at,
-                "twitch_logo": twitch_logo,
-            }
-            reply = twitch_template.render(template_vars)
-        elif link_type == "clip":
-            data = response["data"][0]
-            display_name = data["broadcaster_name"]
-            data_url = "https://api.twitch.tv/helix/users?login={}".format(display_name)
-            try:
-                request = requests.get(
-                    data_url,
-                    timeout=self.timeout,
-                    headers=headers,
-                    proxies=self.proxies,
+        reply = None
+        try:
+            description = user_data.get("description")
+            if link_type == "stream":
+                game_name = data.get("game_name") or self.get_twitch_game_name(
+                    data["game_id"]
                 )
-                request.raise_for_status()
-            except (
-                requests.exceptions.RequestException,
-                requests.exceptions.HTTPError,
-            ) as e:
-                log.error("SpiffyTitles: Twitch Error: {0}".format(e))
-                return self.handler_default(url, channel)
-            user_data = {}
-            try:
-                response = json.loads(request.content.decode())
-                user_data = response["data"][0]
-                description = user_data["description"]
-                game_id = data["game_id"]
-                game_name = game_id
-                title = data["title"]
-                view_count = data["view_count"]
-                created_at = self._time_created_at(data["created_at"])
-                if game_id:
-                    get_game = requests.get(
-                        "https://api.twitch.tv/helix/games?id={}".format(game_id),
-                        timeout=self.timeout,
-                        headers=headers,
-                        proxies=self.proxies,
-                    )
-                    game_data = json.loads(get_game.content.decode())
-                    game_name = game_data["data"][0]["name"]
                 template_vars = {
-                    "display_name": display_name,
+                    "display_name": data["user_name"],
                     "game_name": game_name,
-                    "title": title,
-                    "view_count": view_count,
+                    "title": data["title"],
+                    "view_count": data["viewer_count"],
                     "description": description,
-                    "created_at": created_at,
+                    "created_at": self._time_created_at(data["started_at"]),
                     "twitch_logo": twitch_logo,
                 }
-                reply = twitch_template.render(template_vars)
-            except Exception as e:
-                self.log.error(
-                    "SpiffyTitles: Error parsing Twitch.TV JSON response: %s" % (str(e))
-                )
-        elif link_type == "video":
-            data = response["data"][0]
-            display_name = data["user_name"]
-            data_url = "https://api.twitch.tv/helix/users?login={}".format(display_name)
-            try:
-                request = requests.get(
-                    data_url,
-                    timeout=self.timeout,
-                    headers=headers,
-                    proxies=self.proxies,
-                )
-            except (
-                requests.exceptions.RequestException,
-                requests.exceptions.HTTPError,
-            ) as e:
-                log.error("SpiffyTitles: Twitch Error: {0}".format(e))
-                return self.handler_default(url, channel)
-            user_data = {}
-            try:
-                response = json.loads(request.content.decode())
-                user_data = response["data"][0]
-                description = user_data["description"]
-                title = data["title"]
-                view_count = data["view_count"]
-                created_at = self._time_created_at(data["created_at"])
-                duration = data["duration"]
+            elif link_type == "clip":
                 template_vars = {
-                    "display_name": display_name,
-                    "title": title,
-                    "view_count": view_count,
-                    "created_at": created_at,
+                    "display_name": data["broadcaster_name"],
+                    "game_name": self.get_twitch_game_name(data["game_id"]),
+                    "title": data["title"],
+                    "view_count": data["view_count"],
                     "description": description,
-                    "duration": duration,
+                    "created_at": self._time_created_at(data["created_at"]),
                     "twitch_logo": twitch_logo,
                 }
-                reply = twitch_template.render(template_vars)
-            except Exception as e:
-                self.log.error(
-                    "SpiffyTitles: Error parsing Twitch.TV JSON response: %s" % (str(e))
-                )
-        else:
-            try:
+            elif link_type == "video":
                 template_vars = {
-                    "display_name": display_name,
+                    "display_name": data["user_name"],
+                    "title": data["title"],
+                    "view_count": data["view_count"],
+                    "created_at": self._time_created_at(data["created_at"]),
                     "description": description,
-                    "view_count": view_count,
+                    "duration": data["duration"],
                     "twitch_logo": twitch_logo,
                 }
-                reply = twitch_template.render(template_vars)
-            except Exception as e:
-                self.log.error(
-                    "SpiffyTitles: Error parsing Twitch.TV JSON response: %s" % (str(e))
-                )
+            else:
+                template_vars = {
+                    "display_name": user_data["display_name"],
+                    "description": description,
+                    "view_count": user_data.get("view_count", 0),
+                    "twitch_logo": twitch_logo,
+                }
+            reply = twitch_template.render(template_vars)
+        except Exception as e:
+            self.log.error(
+                "SpiffyTitles: Error parsing Twitch.TV JSON response: %s" % (str(e))
+            )
         return reply
 
+    def get_twitch_headers(self, renew=False):
+        """
+        Returns the Helix request headers. Without an accessToken, an app access
+        token is requested with the client secret and reused until it expires.
+        """
+        access_token = self.registryValue("twitch.accessToken")
+        if not access_token:
+            access_token = self.get_twitch_app_token(renew)
+        return {
+            "Client-ID": self.registryValue("twitch.clientID"),
+            "Authorization": "Bearer {}".format(access_token.strip()),
+        }
+
+    def get_twitch_app_token(self, renew=False):
+        with self.twitch_token_lock:
+            token, expires = self.twitch_token
+            if renew or not token or time.monotonic() >= expires:
+                log.debug("SpiffyTitles: requesting a Twitch app access token")
+                request = self.session.post(
+                    "https://id.twitch.tv/oauth2/token",
+                    data={
+                        "client_id": self.registryValue("twitch.clientID"),
+                        "client_secret": self.registryValue("twitch.clientSecret"),
+                        "grant_type": "client_credentials",
+                    },
+                    timeout=self.timeout,
+                    proxies=self.proxies,
+                )
+                request.raise_for_status()
+                response = json.loads(request.content.decode())
+                # Renew a minute early so in-flight requests do not get a 401
+                lifetime = max(response.get("expires_in", 3600) - 60, 0)
+                self.twitch_token = (
+                    response["access_token"],
+                    time.monotonic() + lifetime,
+                )
+            return self.twitch_token[0]
+
+    def get_twitch_data(self, endpoint, params):
+        """
+        Requests a Helix endpoint and returns the list in its "data" field. Lists
+        in params are sent as repeated parameters, e.g. id=1&id=2.
+        """
+        api_url = "https://api.twitch.tv/helix/{}".format(endpoint)
+        for renew in (False, True):
+            headers = self.get_twitch_headers(renew)
+            request = self.get_url(
+                api_url, params=params, headers=headers, api="twitch"
+            )
+            if request.status_code != 401 or self.registryValue("twitch.accessToken"):
+                break
+        request.raise_for_status()
+        response = json.loads(request.content.decode())
+        if "error" in response:
+            raise requests.exceptions.HTTPError(response["error"])
+        return response.get("data") or []
+
+    def get_twitch_key(self, param, value):
+        """
+        Returns the (param, value) key of a Helix lookup, with logins in
+        lowercase since Twitch ignores their case
+        """
+        value = str(value)
+        return (param, value.lower() if "login" in param else value)
+
+    def get_twitch_batcher(self, endpoint):
+        """
+        Returns the Batcher combining concurrent lookups of a Helix endpoint,
+        so links posted together are looked up with one request
+        """
+        with self.twitch_batchers_lock:
+            batcher = self.twitch_batchers.get(endpoint)
+            if batcher is None:
+                batcher = Batcher(functools.partial(self.get_twitch_batch, endpoint))
+                self.twitch_batchers[endpoint] = batcher
+            return batcher
+
+    def get_twitch_batch(self, endpoint, keys):
+        """
+        Looks up (param, value) keys with a single request to a Helix endpoint
+        and returns the objects found by key. The objects have a field named
+        like each parameter.
+        """
+        params = {}
+        for param, value in keys:
+            params.setdefault(param, []).append(value)
+        found = {}
+        for item in self.get_twitch_data(endpoint, params):
+            for param in params:
+                if param in item:
+                    found[self.get_twitch_key(param, item[param])] = item
+        return found
+
+    def get_twitch_users(self, ids=(), logins=()):
+        """
+        Returns a dict of Twitch users keyed by ("id", user_id) and
+        ("login", login). Users are kept for twitch.cacheLifetime seconds and the
+        missing ones are fetched with a single request.
+        """
+        users = {}
+        futures = {}
+        for param, values in (("id", ids), ("login", logins)):
+            for value in values:
+                key = self.get_twitch_key(param, value)
+                user = self.get_twitch_cache().get(("user",) + key)
+                if user:
+                    users[key] = user
+                elif key not in futures:
+                    futures[key] = self.get_twitch_batcher("users").submit(key)
+        for future in futures.values():
+            user = future.result()
+            if user:
+                for key in (("id", user["id"]), ("login", user["login"])):
+                    key = self.get_twitch_key(*key)
+                    self.twitch_cache.set(("user",) + key, user)
+                    users[key] = user
+        return users
+
+    def get_twitch_games(self, ids):
+        """
+        Returns a dict of Twitch games by ID, cached like users
+        """
+        games = {}
+        futures = {}
+        for game_id in ids:
+            game = self.get_twitch_cache().get(("game", game_id))
+            if game:
+                games[game_id] = game
+            elif game_id not in futures:
+                futures[game_id] = self.get_twitch_batcher("games").submit(
+                    ("id", game_id)
+                )
+        for future in futures.values():
+            game = future.result()
+            if game:
+                self.twitch_cache.set(("game", game["id"]), game)
+                games[game["id"]] = game
+        return games
+
+    def get_twitch_game_name(self, game_id):
+        """
+        Returns the name of a game, or its ID if it cannot be looked up
+        """
+        if not game_id:
+            return game_id
+        try:
+            game = self.get_twitch_games([game_id]).get(game_id)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            log.error("SpiffyTitles: Twitch Error: {0}".format(e))
+            return game_id
+        return game["name"] if game else game_id
+
+    def get_twitch_cache(self):
+        self.twitch_cache.lifetime = self.registryValue("twitch.cacheLifetime")
+        return self.twitch_cache
+
     def _time_created_at(self, s):
         """
         Return relative time delta between now and s (dt string).
@@ -1267,11 +1792,11 @@ class SpiffyTitles(callbacks.Plugin):
     def get_twitch_logo(self, channel):
         use_bold = self.registryValue("useBold", channel)
         if use_bold:
-            twitch_logo = "{0}\x0F\x02".format(
+            twitch_logo = "{0}\x0f\x02".format(
                 self.registryValue("twitch.logo", channel)
             )
         else:
-            twitch_logo = "{0}\x0F".format(self.registryValue("twitch.logo", channel))
+            twitch_logo = "{0}\x0f".format(self.registryValue("twitch.logo", channel))
         return twitch_logo
 
     def handler_imdb(self, url, info, channel):
@@ -1301,18 +1826,16 @@ class SpiffyTitles(callbacks.Plugin):
         omdb_url = "http://www.omdbapi.com/"
         options = {"apikey": apikey, "i": imdb_id, "r": "json", "plot": "short"}
         try:
-            request = requests.get(
-                omdb_url, params=options, timeout=self.timeout, proxies=self.proxies
-            )
+            request = self.get_url(omdb_url, params=options, api="imdb")
             request.raise_for_status()
         except (
             requests.exceptions.RequestException,
             requests.exceptions.HTTPError,
         ) as e:
             log.error("SpiffyTitles OMDB Error: %s" % (str(e)))
+            return self.handler_default(url, channel)
         try:
             response = json.loads(request.content.decode())
-            imdb_template = Template(self.registryValue("imdb.template"))
             if "Error" in response or response["Response"] != "True":
                 response = None
         except:
@@ -1322,7 +1845,7 @@ class SpiffyTitles(callbacks.Plugin):
             )
             response = None
         if response:
-            imdb_template = Template(self.registryValue("imdb.template"))
+            imdb_template = self.get_template("imdb.template")
             meta = None
             tomato = None
             for rating in response["Ratings"]:
@@ -1365,9 +1888,9 @@ class SpiffyTitles(callbacks.Plugin):
     def get_imdb_logo(self, channel):
         use_bold = self.registryValue("useBold", channel)
         if use_bold:
-            imdb_logo = "{0}\x0F\x02".format(self.registryValue("imdb.logo", channel))
+            imdb_logo = "{0}\x0f\x02".format(self.registryValue("imdb.logo", channel))
         else:
-            imdb_logo = "{0}\x0F".format(self.registryValue("imdb.logo", channel))
+            imdb_logo = "{0}\x0f".format(self.registryValue("imdb.logo", channel))
         return imdb_logo
 
     def handler_wikipedia(self, url, domain, channel):
@@ -1415,9 +1938,7 @@ class SpiffyTitles(callbacks.Plugin):
         extract = ""
         self.log.debug("SpiffyTitles: requesting %s" % (api_url))
         try:
-            request = requests.get(
-                api_url, params=api_params, timeout=self.timeout, proxies=self.proxies
-            )
+            request = self.get_url(api_url, params=api_params)
             request.raise_for_status()
         except (
             requests.exceptions.RequestException,
@@ -1443,10 +1964,7 @@ class SpiffyTitles(callbacks.Plugin):
                 extract = (
                     extract[: max_chars - 3].rsplit(" ", 1)[0].rstrip(",.") + "..."
                 )
-            extract_template = self.registryValue(
-                "wikipedia.extractTemplate", channel=channel
-            )
-            wikipedia_template = Template(extract_template)
+            wikipedia_template = self.get_template("wikipedia.extractTemplate", channel)
             return wikipedia_template.render({"extract": extract})
         else:
             self.log.debug("SpiffyTitles: falling back to default handler")
@@ -1493,9 +2011,7 @@ class SpiffyTitles(callbacks.Plugin):
         self.log.debug("SpiffyTitles: requesting %s" % (data_url))
         headers = {"User-Agent": self.get_user_agent()}
         try:
-            request = requests.get(
-                data_url, headers=headers, timeout=self.timeout, proxies=self.proxies
-            )
+            request = self.get_url(data_url, headers=headers)
             request.raise_for_status()
         except (
             requests.exceptions.RequestException,
@@ -1542,10 +2058,9 @@ class SpiffyTitles(callbacks.Plugin):
                     extract = data.get("selftext", "")
             if link_type == "comment":
                 extract = data.get("body", "")
-            link_type_template = self.registryValue(
-                "reddit." + link_type + "Template", channel=channel
+            reddit_template = self.get_template(
+                "reddit." + link_type + "Template", channel
             )
-            reddit_template = Template(link_type_template)
             template_vars = {
                 "id": data.get("id", ""),
                 "user": data.get("name", ""),
@@ -1631,9 +2146,7 @@ class SpiffyTitles(callbacks.Plugin):
         headers = {"Authorization": "Client-ID {0}".format(client_id)}
         api_url = "https://api.imgur.com/3/album/{0}".format(album_id)
         try:
-            request = requests.get(
-                api_url, headers=headers, timeout=self.timeout, proxies=self.proxies
-            )
+            request = self.get_url(api_url, headers=headers, api="imgur")
             request.raise_for_status()
         except (
             requests.exceptions.RequestException,
@@ -1645,8 +2158,7 @@ class SpiffyTitles(callbacks.Plugin):
         album = json.loads(request.content.decode())
         album = album.get("data")
         if album:
-            album_template = self.registryValue("imgur.albumTemplate", channel=channel)
-            imgur_album_template = Template(album_template)
+            imgur_album_template = self.get_template("imgur.albumTemplate", channel)
             compiled_template = imgur_album_template.render(
                 {
                     "title": album.get("title"),
@@ -1691,9 +2203,7 @@ class SpiffyTitles(callbacks.Plugin):
         headers = {"Authorization": "Client-ID {0}".format(client_id)}
         api_url = "https://api.imgur.com/3/image/{0}".format(image_id)
         try:
-            request = requests.get(
-                api_url, headers=headers, timeout=self.timeout, proxies=self.proxies
-            )
+            request = self.get_url(api_url, headers=headers, api="imgur")
             request.raise_for_status()
         except (
             requests.exceptions.RequestException,
@@ -1709,10 +2219,7 @@ class SpiffyTitles(callbacks.Plugin):
             log.error("SpiffyTitles: Error reading imgur JSON response")
             image = None
         if image:
-            channel_template = self.registryValue(
-                "imgur.imageTemplate", channel=channel
-            )
-            imgur_template = Template(channel_template)
+            imgur_template = self.get_template("imgur.imageTemplate", channel)
             readable_file_size = self.get_readable_file_size(image["size"])
             compiled_template = imgur_template.render(
                 {
@@ -1741,7 +2248,7 @@ class SpiffyTitles(callbacks.Plugin):
             url
         )
         try:
-            request = requests.get(api_url, timeout=self.timeout, proxies=self.proxies)
+            request = self.get_url(api_url)
             request.raise_for_status()
         except (
             requests.exceptions.RequestException,
@@ -1764,7 +2271,7 @@ class SpiffyTitles(callbacks.Plugin):
             results["name"] = match.group(2)
             results["nick"] = match.group(3)
             results["date"] = match.group(4)
-        template = Template(self.registryValue("twitter.template", channel))
+        template = self.get_template("twitter.template", channel)
         title = template.render(results).strip()
         if title:
             return title
@@ -1788,5 +2295,114 @@ class SpiffyTitles(callbacks.Plugin):
 
     t = wrap(t, ["text"])
 
+    def cachestats(self, irc, msg, args):
+        """takes no arguments
+
+        Shows the size of the link cache, its hit, miss and eviction counters, and
+        how many requests were shared with an identical request in progress.
+        """
+        stats = self.link_cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = 100.0 * stats["hits"] / lookups if lookups else 0.0
+        irc.reply(
+            "Link cache: %s links in %s channels (%s) :: %s hits, %s misses (%.1f%%"
+            " hit rate) :: %s evictions, %s expirations :: %s coalesced requests"
+            % (
+                stats["entries"],
+                stats["channels"],
+                self.get_readable_file_size(stats["bytes"]),
+                stats["hits"],
+                stats["misses"],
+                hit_rate,
+                stats["evictions"],
+                stats["expirations"],
+                self.requests_in_flight.shared,
+            )
+        )
+
+    cachestats = wrap(cachestats, ["admin"])
+
+    def quotas(self, irc, msg, args):
+        """takes no arguments
+
+        Shows how many requests were made to each rate limited API, in total and
+        today, and how many were refused or throttled by the API.
+        """
+        stats = self.rate_limiter.stats()
+        if not stats:
+            irc.reply("No API requests made yet.")
+            return
+        replies = []
+        for api, counters in stats.items():
+            today = counters["today"]
+            if counters["daily_quota"]:
+                today = "%s/%s" % (today, counters["daily_quota"])
+            reply = "%s: %s requests, %s today, %s rate limited, %s throttled" % (
+                api,
+                counters["requests"],
+                today,
+                counters["limited"],
+                counters["throttled"],
+            )
+            if counters["backoff"]:
+                reply += ", backing off for %ds" % (counters["backoff"])
+            replies.append(reply)
+        irc.reply(" :: ".join(replies))
+
+    quotas = wrap(quotas, ["admin"])
+
+    def handlerstats(self, irc, msg, args, handler):
+        """[<handler>]
+
+        Shows the number of lookups, cache hits, latency percentiles, timeouts,
+        errors and bytes downloaded of each handler, or of <handler> only.
+        """
+        stats = self.metrics.stats()
+        if handler:
+            stats = {name: stats[name] for name in stats if name == handler}
+        if not stats:
+            irc.reply("No handler metrics yet.")
+            return
+        replies = []
+        for name, metrics in stats.items():
+            latency = " ".join(
+                "p%d %dms" % (quantile * 100, seconds * 1000)
+                for quantile, seconds in metrics["latency"].items()
+            )
+            errors = ", ".join(
+                "%s %s" % (count, error_class)
+                for error_class, count in sorted(metrics["errors"].items())
+            )
+            replies.append(
+                "%s: %s lookups, %s cache hits, %s, %s timeouts, %s, %s"
+                % (
+                    name,
+                    metrics["lookups"],
+                    metrics["cache_hits"],
+                    latency,
+                    metrics["timeouts"],
+                    errors or "no errors",
+                    self.get_readable_file_size(metrics["bytes"]),
+                )
+            )
+        irc.reply(" :: ".join(replies))
+
+    handlerstats = wrap(handlerstats, ["admin", optional("somethingWithoutSpaces")])
+
+    def write_metrics(self):
+        """
+        Writes the handler metrics in the Prometheus text format to
+        SpiffyTitles.prom in the data directory, for the node exporter's
+        textfile collector or a similar scraper.
+        """
+        filename = conf.supybot.directories.data.dirize("SpiffyTitles.prom")
+        temporary = filename + ".tmp"
+        try:
+            with open(temporary, "w") as f:
+                f.write(self.metrics.get_prometheus_text())
+            os.replace(temporary, filename)
+        except OSError as e:
+            log.error("SpiffyTitles: could not write metrics: %s" % (e))
+
 
 Class = SpiffyTitles
@@ -0,0 +1,227 @@
+###
+# Copyright (c) 2015, butterscotchstallion
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+ratelimit: per-API request budgets used by SpiffyTitles.
+"""
+
+import datetime
+import email.utils
+import threading
+import time
+
+import requests
+
+
+class RateLimited(requests.exceptions.RequestException):
+    """
+    Raised instead of making a request when an API is over its budget
+    """
+
+
+def parse_retry_after(value):
+    """
+    Returns the number of seconds to wait from a Retry-After header, which is
+    either a number of seconds or an HTTP date, or None.
+    """
+    if not value:
+        return
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max((date - now).total_seconds(), 0)
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average and bursts of up to burst
+    requests. A rate of 0 means unlimited.
+    """
+
+    def __init__(self, rate=0, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def configure(self, rate, burst):
+        burst = max(burst, 1)
+        if not self.rate:
+            # A bucket that was unlimited starts full
+            self.tokens = burst
+            self.updated = time.monotonic()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = min(self.tokens, self.burst)
+
+    def consume(self):
+        """
+        Takes a token and returns True, or returns False if there is none left.
+        Never waits.
+        """
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class APIBudget:
+    """
+    The token bucket, daily quota, backoff and usage counters of one API
+    """
+
+    # Backoff when the API asks us to slow down without a Retry-After header
+    min_backoff = 30
+    max_backoff = 3600
+
+    def __init__(self):
+        self.bucket = TokenBucket()
+        self.daily_quota = 0
+        self.day = None
+        self.used_today = 0
+        self.requests = 0
+        self.limited = 0
+        self.throttled = 0
+        self.failures = 0
+        self.backoff_until = 0
+
+    def get_day(self):
+        return datetime.datetime.now(datetime.timezone.utc).date()
+
+    def acquire(self):
+        """
+        Returns None if a request can be made now, or why it cannot.
+        """
+        now = time.monotonic()
+        if now < self.backoff_until:
+            reason = "backing off for %ds" % (self.backoff_until - now)
+        elif self.daily_quota and self.get_used_today() >= self.daily_quota:
+            reason = "daily quota of %s requests used" % (self.daily_quota)
+        elif not self.bucket.consume():
+            reason = "over %g requests per minute" % (self.bucket.rate * 60)
+        else:
+            self.used_today += 1
+            self.requests += 1
+            return
+        self.limited += 1
+        return reason
+
+    def get_used_today(self):
+        day = self.get_day()
+        if day != self.day:
+            self.day = day
+            self.used_today = 0
+        return self.used_today
+
+    def back_off(self, seconds=None):
+        self.throttled += 1
+        self.failures += 1
+        if seconds is None:
+            seconds = min(self.min_backoff * 2 ** (self.failures - 1), self.max_backoff)
+        self.backoff_until = max(self.backoff_until, time.monotonic() + seconds)
+        return seconds
+
+    def succeeded(self):
+        self.failures = 0
+
+
+class RateLimiter:
+    """
+    Keeps an APIBudget per API name. Nothing here blocks: a request is either
+    allowed right away or refused with RateLimited.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.budgets = {}
+
+    def get_budget(self, api):
+        budget = self.budgets.get(api)
+        if budget is None:
+            budget = self.budgets[api] = APIBudget()
+        return budget
+
+    def configure(self, api, requests_per_minute, burst, daily_quota):
+        with self.lock:
+            budget = self.get_budget(api)
+            budget.bucket.configure(requests_per_minute / 60.0, burst)
+            budget.daily_quota = daily_quota
+
+    def acquire(self, api):
+        """
+        Accounts for one request to api, or raises RateLimited if the API is
+        over its budget or backing off.
+        """
+        with self.lock:
+            reason = self.get_budget(api).acquire()
+        if reason:
+            raise RateLimited("%s: %s" % (api, reason))
+
+    def back_off(self, api, seconds=None):
+        """
+        Stops requests to api for seconds, or for an exponentially growing
+        time if the API did not say how long to wait. Returns the delay.
+        """
+        with self.lock:
+            return self.get_budget(api).back_off(seconds)
+
+    def succeeded(self, api):
+        with self.lock:
+            self.get_budget(api).succeeded()
+
+    def stats(self):
+        """
+        Returns a dict of usage counters by API name.
+        """
+        now = time.monotonic()
+        with self.lock:
+            return {
+                api: {
+                    "requests": budget.requests,
+                    "today": budget.get_used_today(),
+                    "daily_quota": budget.daily_quota,
+                    "limited": budget.limited,
+                    "throttled": budget.throttled,
+                    "backoff": max(budget.backoff_until - now, 0),
+                }
+                for api, budget in sorted(self.budgets.items())
+            }
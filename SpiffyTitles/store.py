@@ -0,0 +1,114 @@
+###
+# Copyright (c) 2015, butterscotchstallion
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+store: on-disk title cache used by SpiffyTitles so titles survive restarts.
+"""
+
+import sqlite3
+import threading
+import time
+
+
+class TitleStore:
+    """
+    SQLite-backed store of rendered titles, keyed by cache channel and
+    normalized URL. Rows remember the handler that produced the title, when
+    it was fetched and whether it was a negative result (a dead link).
+    """
+
+    # Number of writes between two purges of stale rows
+    prune_interval = 500
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS titles ("
+            "channel TEXT NOT NULL, "
+            "url TEXT NOT NULL, "
+            "handler TEXT, "
+            "title TEXT NOT NULL, "
+            "fetched REAL NOT NULL, "
+            "negative INTEGER NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (channel, url))"
+        )
+        self.db.commit()
+
+    def get(self, channel, url):
+        """
+        Returns the stored row for url in channel as a dict, or None.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT handler, title, fetched, negative FROM titles "
+                "WHERE channel = ? AND url = ?",
+                (channel, url),
+            ).fetchone()
+        if row:
+            return {
+                "handler": row[0],
+                "title": row[1],
+                "fetched": row[2],
+                "negative": bool(row[3]),
+            }
+
+    def set(self, channel, url, handler, title, fetched, negative=False):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO titles "
+                "(channel, url, handler, title, fetched, negative) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (channel, url, handler, title, fetched, int(negative)),
+            )
+            self.db.commit()
+            self.writes += 1
+
+    def prune(self, lifetime, negative_lifetime):
+        """
+        Deletes rows that are older than their lifetime in seconds.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM titles WHERE (negative = 0 AND fetched <= ?) "
+                "OR (negative != 0 AND fetched <= ?)",
+                (now - lifetime, now - negative_lifetime),
+            )
+            self.db.commit()
+            self.writes = 0
+
+    def needs_pruning(self):
+        return self.writes >= self.prune_interval
+
+    def close(self):
+        with self.lock:
+            self.db.close()
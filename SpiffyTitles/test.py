@@ -0,0 +1,522 @@
+###
+# Copyright (c) 2015, butterscotchstallion
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+import http.server
+import os
+import threading
+import time
+
+from supybot.test import *
+
+from .cache import Batcher, LinkCache, SingleFlight
+from .filters import remove_control_characters
+from . import benchmark, ratelimit
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves canned (status, headers, body) responses from the routes dict
+    """
+
+    routes = {}
+
+    def do_GET(self):
+        status, headers, body = self.routes.get(self.path, (404, {}, b""))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SpiffyTitlesTestCase(PluginTestCase):
+    plugins = ("SpiffyTitles",)
+
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.base_url = "http://127.0.0.1:%s" % self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        PluginTestCase.tearDown(self)
+
+    def testDefaultHandler(self):
+        cb = self.irc.getCallback("SpiffyTitles")
+        html = "text/html; charset=utf-8"
+        StubHandler.routes = {
+            "/page": (200, {"Content-Type": html}, b"<title> A  page </title>"),
+            "/og": (
+                200,
+                {"Content-Type": html},
+                b'<head><meta property="og:title" content="OG"></head><body>'
+                + b"x" * 1048576,
+            ),
+            "/file": (200, {"Content-Type": "image/png"}, b"\x89PNG" * 256),
+        }
+        self.assertEqual(cb.get_title_by_url(self.base_url + "/page", "#a"), "^ A page")
+        self.assertEqual(cb.get_title_by_url(self.base_url + "/og", "#a"), "^ OG")
+        self.assertEqual(
+            cb.get_title_by_url(self.base_url + "/file", "#a"), "^ [image/png] (1.0KiB)"
+        )
+        self.assertEqual(
+            cb.get_title_by_url(self.base_url + "/missing", "#a"),
+            "^ " + cb.registryValue("badLinkText"),
+        )
+
+    def testLinkCacheBounds(self):
+        cache = LinkCache(lifetime=600, channel_size=2, size=3)
+        for i in range(3):
+            cache.set(
+                "#a", "http://a/%s" % i, {"timestamp": time.time(), "title": str(i)}
+            )
+        self.assertIsNone(cache.get("#a", "http://a/0"))
+        self.assertEqual(cache.get("#a", "http://a/2")["title"], "2")
+        cache.set("#b", "http://b/0", {"timestamp": time.time(), "title": "b"})
+        cache.set("#b", "http://b/1", {"timestamp": time.time(), "title": "b"})
+        # the global bound evicts the least recently used link first
+        self.assertIsNone(cache.get("#a", "http://a/1"))
+        self.assertIsNotNone(cache.get("#a", "http://a/2"))
+        self.assertEqual(cache.stats()["entries"], 3)
+        self.assertEqual(cache.stats()["evictions"], 2)
+
+    def testLinkCacheExpiry(self):
+        cache = LinkCache(lifetime=60)
+        cache.set("#a", "http://a", {"timestamp": time.time() - 120, "title": "a"})
+        self.assertIsNone(cache.get("#a", "http://a"))
+        self.assertEqual(cache.stats()["expirations"], 1)
+        self.assertEqual(cache.stats()["entries"], 0)
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+    def testPersistentCache(self):
+        cb = self.irc.getCallback("SpiffyTitles")
+        with conf.supybot.plugins.SpiffyTitles.cachePersistent.context(True):
+            cb.add_link_to_cache("HTTP://Example.com", "#a", "^ Example", "handler")
+            cb.link_cache.clear()
+            link = cb.get_link_from_cache("http://example.com/", "#a")
+            self.assertEqual(link["title"], "^ Example")
+            self.assertEqual(link["handler"], "handler")
+            bad_link_text = cb.registryValue("badLinkText")
+            cb.add_link_to_cache("http://dead.link/", "#a", bad_link_text, "handler")
+            link = cb.get_link_from_cache("http://dead.link/", "#a")
+            self.assertEqual(
+                link["lifetime"], cb.registryValue("cacheNegativeLifetime")
+            )
+
+    def testTitlesByUrlsOrder(self):
+        cb = self.irc.getCallback("SpiffyTitles")
+
+        def get_title_by_url(url, channel, origin_nick=None):
+            time.sleep(float(url.rsplit("/", 1)[1]))
+            return url
+
+        cb.get_title_by_url = get_title_by_url
+        urls = ["http://a/0.2", "http://a/0.1", "http://a/0"]
+        start = time.monotonic()
+        titles = list(cb.get_titles_by_urls(urls, "#a"))
+        self.assertLess(time.monotonic() - start, 0.3)
+        self.assertEqual(titles, [(url, url) for url in urls])
+        with conf.supybot.plugins.SpiffyTitles.messageTimeout.context(1):
+            urls.insert(1, "http://a/2")
+            titles = list(cb.get_titles_by_urls(urls, "#a"))
+            self.assertEqual(titles, [(urls[0], urls[0])])
+
+    def testTemplateCache(self):
+        cb = self.irc.getCallback("SpiffyTitles")
+        template = cb.get_template("default.template", "#a")
+        self.assertIs(cb.get_template("default.template", "#b"), template)
+        with conf.supybot.plugins.SpiffyTitles.default.template.context("{{title}}"):
+            changed = cb.get_template("default.template", "#a")
+            self.assertIsNot(changed, template)
+            self.assertEqual(changed.render(title="t"), "t")
+
+    def testSingleFlight(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        calls = []
+
+        def fetch(url):
+            calls.append(url)
+            started.set()
+            time.sleep(0.2)
+            return {"url": url}
+
+        def follow():
+            started.wait()
+            results.append(flight.do("key", fetch, "http://a"))
+
+        results = []
+        follower = threading.Thread(target=follow)
+        follower.start()
+        results.append(flight.do("key", fetch, "http://a"))
+        follower.join()
+        self.assertEqual(calls, ["http://a"])
+        self.assertIs(results[0], results[1])
+        self.assertEqual(flight.shared, 1)
+        self.assertEqual(flight.calls, {})
+
+    def testBatcher(self):
+        batches = []
+
+        def lookup(keys):
+            batches.append(sorted(keys))
+            return {key: key.upper() for key in keys if key != "missing"}
+
+        batcher = Batcher(lookup, delay=0.1, size=3)
+        futures = [batcher.submit(key) for key in ("a", "b", "a", "missing")]
+        self.assertEqual(
+            [future.result(1) for future in futures], ["A", "B", "A", None]
+        )
+        self.assertEqual(batches, [["a", "b", "missing"]])
+        futures = [batcher.submit(key) for key in ("c", "d")]
+        self.assertEqual([future.result(1) for future in futures], ["C", "D"])
+        self.assertEqual(batches[1:], [["c", "d"]])
+        batcher = Batcher(lambda keys: 1 / 0)
+        self.assertRaises(ZeroDivisionError, batcher.submit("a").result, 1)
+
+    def testHandlerDispatch(self):
+        cb = self.irc.getCallback("SpiffyTitles")
+        self.assertEqual(cb.get_handler("en.m.wikipedia.org"), cb.handler_wikipedia)
+        self.assertEqual(cb.get_handler("old.reddit.com"), cb.handler_reddit)
+        self.assertEqual(cb.get_handler("i.imgur.com"), cb.handler_imgur_image)
+        self.assertEqual(cb.get_handler("m.imgur.com"), cb.handler_imgur)
+        self.assertIsNone(cb.get_handler("notimgur.com"))
+        self.assertIsNone(cb.get_handler("www.bbc.co.uk"))
+        with conf.supybot.plugins.SpiffyTitles.handlerHosts.context(
+            ["bbc.co.uk=reddit", "bad"]
+        ):
+            self.assertEqual(cb.get_handler("www.bbc.co.uk"), cb.handler_reddit)
+        cb.register_handler("example.org", cb.handler_vimeo)
+        self.assertEqual(cb.get_handler("www.example.org"), cb.handler_vimeo)
+        self.assertEqual(
+            cb.get_base_domain("https://www.example.co.uk/x"), "example.co.uk"
+        )
+
+    def testChannelFilters(self):
+        cb = self.irc.getCallback("SpiffyTitles")
+        filters = cb.get_filters("#a")
+        self.assertIs(cb.get_filters("#a"), filters)
+        self.assertEqual(
+            filters.get_urls("see http://a.com/x and https://b.org"),
+            ["http://a.com/x", "https://b.org"],
+        )
+        self.assertTrue(filters.is_allowed_domain("a.com"))
+        pattern = conf.supybot.plugins.SpiffyTitles.ignoredDomainPattern
+        pattern.set(r"m/^a\.com$/")
+        try:
+            filters = cb.get_filters("#a")
+            self.assertEqual(filters.is_ignored_domain("a.com"), "a.com")
+            self.assertFalse(filters.is_allowed_domain("a.com"))
+            self.assertTrue(filters.is_allowed_domain("b.org"))
+        finally:
+            pattern.set("")
+        self.assertTrue(cb.get_filters("#a").is_allowed_domain("a.com"))
+        self.assertEqual(remove_control_characters("http://a.com/"), "http://a.com/")
+        self.assertEqual(
+            remove_control_characters("\x02http://a\u200b.com/\x1f\ue000"),
+            "http://a.com/",
+        )
+
+    def testRedirects(self):
+        cb = self.irc.getCallback("SpiffyTitles")
+        html = {"Content-Type": "text/html"}
+        server = benchmark.StubServer(
+            {
+                "https://sho.rt/a": {
+                    "status": 301,
+                    "headers": {"Location": "https://www.example.org/start"},
+                },
+                "https://www.example.org/start": {
+                    "status": 302,
+                    "headers": {"Location": "/final"},
+                },
+                "https://www.example.org/final": {
+                    "headers": html,
+                    "body": "<title>Final</title>",
+                },
+                "https://sho.rt/b": {
+                    "status": 301,
+                    "headers": {"Location": "https://ignored.example/"},
+                },
+                "https://sho.rt/c": {
+                    "status": 302,
+                    "headers": {"Location": "/c"},
+                },
+            }
+        )
+        pattern = conf.supybot.plugins.SpiffyTitles.ignoredDomainPattern
+        pattern.set(r"m/^ignored\.example$/")
+        try:
+            with benchmark.stubbed_session(cb.session, server.base_url):
+                self.assertEqual(
+                    cb.get_title_by_url("https://sho.rt/a", "#a"),
+                    "(REDIRECT) ^ Final",
+                )
+                self.assertEqual(
+                    cb.get_title_by_url("https://sho.rt/a", "#b"),
+                    "(REDIRECT) ^ Final",
+                )
+                self.assertIsNone(cb.get_title_by_url("https://sho.rt/b", "#a"))
+                self.assertEqual(
+                    cb.get_title_by_url("https://sho.rt/c", "#a"),
+                    "^ " + cb.registryValue("badLinkText"),
+                )
+        finally:
+            pattern.set("")
+            server.stop()
+        self.assertEqual(server.hits["https://sho.rt/a"], 1)
+        self.assertEqual(server.hits["https://www.example.org/start"], 1)
+        self.assertEqual(server.hits["https://www.example.org/final"], 2)
+        self.assertNotIn("https://ignored.example/", server.hits)
+
+    def testRateLimiter(self):
+        limiter = ratelimit.RateLimiter()
+        limiter.configure("a", 60, 2, 0)
+        limiter.acquire("a")
+        limiter.acquire("a")
+        self.assertRaises(ratelimit.RateLimited, limiter.acquire, "a")
+        limiter.configure("b", 0, 1, 2)
+        limiter.acquire("b")
+        limiter.acquire("b")
+        self.assertRaises(ratelimit.RateLimited, limiter.acquire, "b")
+        self.assertEqual(limiter.back_off("c"), 30)
+        self.assertEqual(limiter.back_off("c"), 60)
+        self.assertRaises(ratelimit.RateLimited, limiter.acquire, "c")
+        self.assertEqual(limiter.stats()["b"]["today"], 2)
+        self.assertEqual(limiter.stats()["a"]["limited"], 1)
+        self.assertEqual(ratelimit.parse_retry_after("120"), 120)
+        self.assertEqual(
+            ratelimit.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0
+        )
+        self.assertIsNone(ratelimit.parse_retry_after("soon"))
+
+    def testRetryAfter(self):
+        cb = self.irc.getCallback("SpiffyTitles")
+        StubHandler.routes = {"/api": (429, {"Retry-After": "120"}, b"")}
+        url = self.base_url + "/api"
+        self.assertEqual(cb.get_url(url, api="youtube").status_code, 429)
+        self.assertRaises(ratelimit.RateLimited, cb.get_url, url, api="youtube")
+        self.assertTrue(cb.local.rate_limited)
+        self.assertRegexp(
+            "quotas",
+            "youtube: 1 requests, 1/10000 today, 1 rate limited, 1 throttled, "
+            "backing off for 1[12][0-9]s",
+        )
+
+    def testImdbRateLimited(self):
+        cb = self.irc.getCallback("SpiffyTitles")
+        path = "/title.imdb.com/title/tt0000001/"
+        StubHandler.routes = {
+            path: (200, {"Content-Type": "text/html"}, b"<title>Film</title>")
+        }
+        cb.rate_limiter.back_off("imdb", 120)
+        with conf.supybot.plugins.SpiffyTitles.handlerHosts.context(["127.0.0.1=imdb"]):
+            self.assertEqual(cb.get_title_by_url(self.base_url + path, "#a"), "^ Film")
+        self.assertTrue(cb.local.rate_limited)
+
+    def testTwitchLookups(self):
+        cb = self.irc.getCallback("SpiffyTitles")
+        started = "2020-01-01T00:00:00Z"
+        responses = {
+            "streams": [
+                {
+                    "user_id": "7",
+                    "user_login": "foo",
+                    "user_name": "Foo",
+                    "game_id": "1",
+                    "game_name": "Chess",
+                    "title": "live",
+                    "viewer_count": 5,
+                    "started_at": started,
+                }
+            ],
+            "users": [
+                {"id": "7", "login": "foo", "display_name": "Foo", "description": ""}
+            ],
+            "clips": [
+                {
+                    "id": "Clip",
+                    "broadcaster_id": "7",
+                    "broadcaster_name": "Foo",
+                    "game_id": "1",
+                    "title": "clip",
+                    "view_count": 3,
+                    "created_at": started,
+                }
+            ],
+            "games": [{"id": "1", "name": "Chess"}],
+        }
+        calls = []
+
+        def get_twitch_data(endpoint, params):
+            calls.append((endpoint, params))
+            return responses[endpoint]
+
+        cb.get_twitch_data = get_twitch_data
+        twitch = conf.supybot.plugins.SpiffyTitles.twitch
+        with twitch.clientID.context("id"), twitch.accessToken.context("token"):
+            # The stream and the user are looked up at the same time
+            title = cb.handler_twitch("https://www.twitch.tv/Foo", None, "#a")
+            self.assertIn("[Chess]", title)
+            self.assertCountEqual(
+                calls,
+                [("streams", {"user_login": ["foo"]}), ("users", {"login": ["foo"]})],
+            )
+            # The user is cached and the game is known from the stream
+            del calls[:]
+            title = cb.handler_twitch("https://clips.twitch.tv/Clip", None, "#a")
+            self.assertIn("[Chess]", title)
+            self.assertEqual(calls, [("clips", {"id": ["Clip"]})])
+            del calls[:]
+            cb.handler_twitch("https://www.twitch.tv/foo", None, "#a")
+            self.assertEqual(calls, [("streams", {"user_login": ["foo"]})])
+            # Links handled together share one request per endpoint
+            cb.twitch_cache.clear()
+            del calls[:]
+            threads = [
+                threading.Thread(
+                    target=cb.handler_twitch,
+                    args=("https://www.twitch.tv/%s" % name, None, "#a"),
+                )
+                for name in ("foo", "bar")
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(
+                sorted(endpoint for endpoint, params in calls), ["streams", "users"]
+            )
+            params = dict(calls)
+            self.assertCountEqual(params["streams"]["user_login"], ["foo", "bar"])
+            self.assertCountEqual(params["users"]["login"], ["foo", "bar"])
+
+    def testBackgroundLookups(self):
+        cb = self.irc.getCallback("SpiffyTitles")
+        StubHandler.routes = {
+            "/a": (200, {"Content-Type": "text/html"}, b"<title>A</title>"),
+            "/b": (200, {"Content-Type": "text/html"}, b"<title>B</title>"),
+        }
+        with conf.supybot.plugins.SpiffyTitles.backgroundLookups.context(True):
+            with conf.supybot.plugins.SpiffyTitles.snarfMultipleUrls.context(True):
+                self.irc.feedMsg(
+                    ircmsgs.privmsg(
+                        "#test",
+                        "%s/a %s/b" % (self.base_url, self.base_url),
+                        prefix="foo!bar@baz",
+                    )
+                )
+                replies = []
+                deadline = time.monotonic() + 5
+                while len(replies) < 2 and time.monotonic() < deadline:
+                    msg = self.irc.takeMsg()
+                    if msg:
+                        replies.append(msg.args[1])
+                    else:
+                        time.sleep(0.01)
+        self.assertEqual(replies, ["^ A", "^ B"])
+        self.assertEqual(cb.pending_lookups, 0)
+
+    def testBackgroundLookupsLimit(self):
+        cb = self.irc.getCallback("SpiffyTitles")
+        StubHandler.routes = {
+            "/a": (200, {"Content-Type": "text/html"}, b"<title>A</title>"),
+            "/b": (200, {"Content-Type": "text/html"}, b"<title>B</title>"),
+        }
+        with conf.supybot.plugins.SpiffyTitles.backgroundLookups.context(True):
+            with conf.supybot.plugins.SpiffyTitles.maxPendingLookups.context(1):
+                with conf.supybot.plugins.SpiffyTitles.snarfMultipleUrls.context(True):
+                    self.irc.feedMsg(
+                        ircmsgs.privmsg(
+                            "#test",
+                            "%s/a %s/b" % (self.base_url, self.base_url),
+                            prefix="foo!bar@baz",
+                        )
+                    )
+                    time.sleep(0.5)
+                    self.assertIsNone(self.irc.takeMsg())
+        self.assertEqual(cb.pending_lookups, 0)
+
+    def testHandlerMetrics(self):
+        cb = self.irc.getCallback("SpiffyTitles")
+        cb.metrics.clear()
+        StubHandler.routes = {
+            "/page": (200, {"Content-Type": "text/html"}, b"<title>Page</title>"),
+        }
+        cb.get_title_by_url(self.base_url + "/page", "#a")
+        cb.get_title_by_url(self.base_url + "/page", "#a")
+        cb.get_title_by_url(self.base_url + "/missing", "#a")
+        metrics = cb.metrics.stats()["default"]
+        self.assertEqual(metrics["lookups"], 2)
+        self.assertEqual(metrics["cache_hits"], 1)
+        self.assertEqual(metrics["errors"], {"http_4xx": 1})
+        self.assertEqual(metrics["bytes"], len(b"<title>Page</title>"))
+        self.assertRegexp("handlerstats default", "default: 2 lookups, 1 cache hits")
+        cb.write_metrics()
+        filename = conf.supybot.directories.data.dirize("SpiffyTitles.prom")
+        with open(filename) as f:
+            self.assertIn('spiffytitles_lookups_total{handler="default"} 2', f.read())
+
+    def testBenchmark(self):
+        """
+        Replays the benchmark corpus once. Set SPIFFYTITLES_BENCHMARK to a number
+        of rounds, and optionally SPIFFYTITLES_BENCHMARK_CORPUS to a corpus file,
+        to run the full benchmark and print its report.
+        """
+        cb = self.irc.getCallback("SpiffyTitles")
+        rounds = int(os.environ.get("SPIFFYTITLES_BENCHMARK", 0))
+        corpus = None
+        if os.environ.get("SPIFFYTITLES_BENCHMARK_CORPUS"):
+            corpus = benchmark.load_corpus(os.environ["SPIFFYTITLES_BENCHMARK_CORPUS"])
+        report = benchmark.run_benchmark(cb, self.irc, corpus, rounds=rounds or 1)
+        if rounds:
+            print()
+            for line in benchmark.format_report(report, cb.get_readable_file_size):
+                print(line)
+        else:
+            handlers = report["handlers"]
+            self.assertEqual(report["rounds"][0]["replies"], 19)
+            self.assertEqual(handlers["youtube"]["lookups"], 2)
+            self.assertEqual(handlers["reddit"]["lookups"], 2)
+
+    def testCacheStats(self):
+        self.assertRegexp("cachestats", "Link cache: 0 links")
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,172 @@
+###
+# Copyright (c) 2015, butterscotchstallion
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+titleparser: incremental extraction of page titles from HTML responses.
+"""
+
+import codecs
+import re
+from html.parser import HTMLParser
+
+META_TITLES = ("og:title", "twitter:title")
+CHARSET_RE = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?([\w.:-]+)""", re.I)
+# Bytes to look at for a <meta> charset before decoding anything
+SNIFF_BYTES = 2048
+# Characters fed to the parser at once, so it stops soon after the title
+FEED_SIZE = 1024
+
+
+class TitleParser(HTMLParser):
+    """
+    Collects the text of <title> and the og:title and twitter:title meta tags
+    while the document is fed in, and sets done once the rest of the document
+    cannot change the title anymore.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = None
+        self.title_parts = []
+        self.in_title = False
+        self.meta = {}
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == "title" and self.title is None:
+            self.in_title = True
+        elif tag == "meta":
+            attrs = dict(attrs)
+            name = (attrs.get("property") or attrs.get("name") or "").lower()
+            content = (attrs.get("content") or "").strip()
+            if name in META_TITLES and content:
+                self.meta.setdefault(name, content)
+        elif tag == "body":
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if self.done:
+            return
+        if tag == "title" and self.in_title:
+            self.in_title = False
+            self.title = "".join(self.title_parts).strip()
+            if self.title:
+                self.done = True
+        elif tag == "head":
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title and not self.done:
+            self.title_parts.append(data)
+
+    def get_title(self):
+        """
+        Returns the <title> text, falling back to the og:title or twitter:title
+        meta tags, or None.
+        """
+        title = self.title
+        if title is None and self.title_parts:
+            # The byte limit was hit in the middle of the title
+            title = "".join(self.title_parts).strip()
+        if title:
+            return title
+        for name in META_TITLES:
+            if name in self.meta:
+                return self.meta[name]
+
+
+def get_encoding(content_type, head):
+    """
+    Returns the character encoding of a document, read from the content-type
+    header, then from a <meta> tag in its first bytes, defaulting to UTF-8.
+    """
+    encoding = None
+    for param in (content_type or "").split(";")[1:]:
+        key, _, value = param.partition("=")
+        if key.strip().lower() == "charset":
+            encoding = value.strip().strip("\"'")
+    if not encoding:
+        if head.startswith(codecs.BOM_UTF8):
+            return "utf-8-sig"
+        match = CHARSET_RE.search(head)
+        if match:
+            encoding = match.group(1).decode("ascii", "replace")
+    try:
+        return codecs.lookup(encoding).name
+    except (LookupError, TypeError):
+        return "utf-8"
+
+
+def feed(parser, text):
+    """
+    Feeds text to parser in slices, so that the rest of a chunk is not
+    tokenized once the parser is done.
+    """
+    for start in range(0, len(text), FEED_SIZE):
+        parser.feed(text[start : start + FEED_SIZE])
+        if parser.done:
+            return
+
+
+def parse_title(chunks, content_type=None, max_bytes=0):
+    """
+    Feeds byte chunks of an HTML document to a TitleParser until the title is
+    found, the end of <head> is reached or max_bytes have been read (0 for no
+    limit). Returns the title or None, and the number of bytes read.
+    """
+    parser = TitleParser()
+    decoder = None
+    head = b""
+    size = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if max_bytes:
+            chunk = chunk[: max_bytes - size]
+        size += len(chunk)
+        limit_reached = max_bytes and size >= max_bytes
+        if decoder is None:
+            head += chunk
+            if len(head) < SNIFF_BYTES and not limit_reached:
+                continue
+            chunk = head
+            encoding = get_encoding(content_type, head)
+            decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        feed(parser, decoder.decode(chunk))
+        if parser.done or limit_reached:
+            break
+    else:
+        if decoder is None and head:
+            encoding = get_encoding(content_type, head)
+            feed(parser, head.decode(encoding, errors="replace"))
+    parser.close()
+    return (parser.get_title(), size)
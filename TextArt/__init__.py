@@ -49,11 +49,27 @@ __contributors__ = {}
 __url__ = "https://github.com/oddluck/limnoria-plugins/"
 
 from . import config
+from . import ansi
+from . import convert
+from . import encoder
+from . import fetch
+from . import fonts
+from . import quantize
+from . import scroller
+from . import workers
 from . import plugin
 from importlib import reload
 
 # In case we're being reloaded.
 reload(config)
+reload(ansi)
+reload(convert)
+reload(encoder)
+reload(fetch)
+reload(fonts)
+reload(quantize)
+reload(scroller)
+reload(workers)
 reload(plugin)
 # Add more reloads here if you add third-party modules and want them to be
 # reloaded when this plugin is reloaded.  Don't forget to import them as well!
@@ -0,0 +1,321 @@
+###
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+ansi: converts ANSI escape sequences to IRC formatting in a single pass, for
+terminal output like wttr.in's and for .ans art files.
+"""
+
+import re
+
+import numpy as np
+
+from .colors import ansi16, ansi83, ansi99, x16colors
+from .quantize import get_palette
+
+# Printable text, a CSI sequence, any other escape sequence or a control
+# character.
+TOKEN = re.compile(
+    r"([^\x00-\x1f\x7f]+)|\x1b\[([0-?]*)[ -/]*([@-~])|\x1b[ -/]*[0-~]?|(.)", re.S
+)
+
+# IRC codes of SGR colors 30-37, then of their bright versions
+BASIC = [x16colors[str(30 + i)] for i in range(8)]
+BASIC += [x16colors["{0};1".format(30 + i)] for i in range(8)]
+
+TABLES = {16: ansi16, 83: ansi83, 99: ansi99}
+
+# SGR state: (fg, bg, bold, italic, underline, blink, reverse). Colors are
+# None for the default, or a pair of IRC codes for the normal and the
+# bold/blinking version, since bold brightens basic foreground colors and
+# blink brightens backgrounds (iCE colors).
+DEFAULT = (None, None, False, False, False, False, False)
+
+# IRC formatting: (fg, bg, bold, italic, underline, reverse)
+PLAIN = (None, None, False, False, False, False)
+
+# New SGR states by palette, state and SGR parameters, and IRC formatting by
+# SGR state. They only hold what follows from their keys, so all conversions
+# share them.
+transitions = {}
+state_formats = {}
+MAX_TRANSITIONS = 65536
+
+# Bounds of the screen, so that cursor movements cannot make it allocate
+# rows and columns nothing was written to
+MAX_ROWS = 10000
+MAX_COLUMNS = 1000
+
+
+def ansi2irc(text, colors=83, width=0, max_rows=0):
+    """
+    Returns text with its ANSI escape sequences converted to IRC formatting,
+    using the 16, 83 or 99 IRC colors. Lines wrap after width characters
+    unless it is 0. Conversion stops after max_rows rows, and always after
+    MAX_ROWS.
+    """
+    screen = Screen(colors, width, max_rows)
+    screen.feed(text)
+    return "\n".join(screen.lines())
+
+
+def apply_sgr(state, params, colors):
+    """
+    Returns the SGR state after the sequence ESC [ params m.
+    """
+    fg, bg, bold, italic, underline, blink, reverse = state
+    values = [int(v) if v.isdigit() else 0 for v in re.split("[;:]", params)]
+    i = 0
+    while i < len(values):
+        value = values[i]
+        if value == 0:
+            fg, bg, bold, italic, underline, blink, reverse = DEFAULT
+        elif value == 1:
+            bold = True
+        elif value == 3:
+            italic = True
+        elif value == 4:
+            underline = True
+        elif value in (5, 6):
+            blink = True
+        elif value == 7:
+            reverse = True
+        elif value in (21, 22):
+            bold = False
+        elif value == 23:
+            italic = False
+        elif value == 24:
+            underline = False
+        elif value == 25:
+            blink = False
+        elif value == 27:
+            reverse = False
+        elif 30 <= value <= 37:
+            fg = (BASIC[value - 30], BASIC[value - 22])
+        elif value == 39:
+            fg = None
+        elif 40 <= value <= 47:
+            bg = (BASIC[value - 40], BASIC[value - 32])
+        elif value == 49:
+            bg = None
+        elif 90 <= value <= 97:
+            fg = (BASIC[value - 82],) * 2
+        elif 100 <= value <= 107:
+            bg = (BASIC[value - 92],) * 2
+        elif value in (38, 48):
+            code, i = get_extended_color(values, i, colors)
+            if code and value == 38:
+                fg = (code, code)
+            elif code:
+                bg = (code, code)
+        i += 1
+    return (fg, bg, bold, italic, underline, blink, reverse)
+
+
+def get_extended_color(values, i, colors):
+    """
+    Returns the IRC code of the 256 color (38;5;n) or true color (38;2;r;g;b)
+    starting at values[i], and the index of its last parameter.
+    """
+    if values[i + 1 : i + 2] == [5] and len(values) > i + 2:
+        if values[i + 2] > 255:
+            return None, i + 2
+        return TABLES.get(colors, ansi83)[values[i + 2]], i + 2
+    if values[i + 1 : i + 2] == [2] and len(values) > i + 4:
+        rgb = np.array([[min(v, 255) for v in values[i + 2 : i + 5]]])
+        code = get_palette(colors).nearest(rgb, "fast")[0]
+        return "{:02d}".format(int(code)), i + 4
+    return None, i + 1
+
+
+def get_format(state):
+    """
+    Returns the IRC formatting of an SGR state.
+    """
+    fg, bg, bold, italic, underline, blink, reverse = state
+    fg_code = fg[bold] if fg else None
+    bg_code = bg[blink] if bg else None
+    # Bold is shown as such only when it did not brighten the color instead
+    bold = bold and (fg is None or fg[0] == fg[1])
+    if reverse and fg_code and bg_code:
+        fg_code, bg_code, reverse = bg_code, fg_code, False
+    return (fg_code, bg_code, bold, italic, underline, reverse)
+
+
+def get_codes(current, new, next_char):
+    """
+    Returns the IRC codes switching from the formatting current to new, given
+    the character that follows them.
+    """
+    codes = ""
+    for old, value, code in zip(current[2:], new[2:], ("\x02", "\x1d", "\x1f", "\x16")):
+        if old != value:
+            codes += code
+    fg, bg = new[:2]
+    if (fg, bg) == current[:2]:
+        return codes
+    if fg is None and bg is None:
+        # A bare color code would take a following number as a color
+        if next_char.isdigit() or next_char == ",":
+            return codes + "\x0399,99"
+        return codes + "\x03"
+    if bg == current[1] and next_char != ",":
+        return codes + "\x03{0}".format(fg or "99")
+    return codes + "\x03{0},{1}".format(fg or "99", bg or "99")
+
+
+def encode_row(chars, formats):
+    """
+    Returns a row of characters as an IRC line, given the IRC formatting of
+    each.
+    """
+    line = []
+    current = PLAIN
+    start = 0
+    for i in range(1, len(chars) + 1):
+        if i < len(chars) and formats[i] == formats[start]:
+            continue
+        line.append(get_codes(current, formats[start], chars[start]))
+        line.append("".join(chars[start:i]))
+        current = formats[start]
+        start = i
+    return "".join(line)
+
+
+class Screen:
+    """
+    Text written by an ANSI stream, as rows of characters and of their IRC
+    formatting, following cursor movements. The cursor stays within
+    max_rows rows, MAX_ROWS at most, and MAX_COLUMNS columns.
+    """
+
+    def __init__(self, colors=83, width=0, max_rows=0):
+        self.colors = colors
+        self.width = min(width, MAX_COLUMNS)
+        self.max_rows = min(max_rows or MAX_ROWS, MAX_ROWS)
+        self.transitions = transitions.setdefault(colors, {})
+        self.rows = []
+        self.x = 0
+        self.y = 0
+        self.saved = (0, 0)
+        self.state = DEFAULT
+        self.format = PLAIN
+
+    def feed(self, text):
+        """
+        Writes text, up to an end of file character (^Z) like those before
+        SAUCE records, or until the last row is passed.
+        """
+        for match in TOKEN.finditer(text):
+            if self.y >= self.max_rows:
+                return
+            printable, params, command, control = match.groups()
+            if printable:
+                self.write(printable)
+            elif command == "m":
+                self.set_state(params)
+            elif command:
+                self.move(params, command)
+            elif control == "\n":
+                self.x = 0
+                self.y += 1
+            elif control == "\r":
+                self.x = 0
+            elif control == "\t":
+                self.x = min((self.x // 8 + 1) * 8, MAX_COLUMNS)
+            elif control == "\b":
+                self.x = max(self.x - 1, 0)
+            elif control == "\x1a":
+                return
+            elif control and control != "\x1b":
+                self.write(" ")
+
+    def set_state(self, params):
+        key = (self.state, params)
+        state = self.transitions.get(key)
+        if state is None:
+            state = apply_sgr(self.state, params, self.colors)
+            if len(self.transitions) >= MAX_TRANSITIONS:
+                self.transitions.clear()
+            self.transitions[key] = state
+        self.state = state
+        self.format = state_formats.get(state)
+        if self.format is None:
+            self.format = state_formats[state] = get_format(state)
+
+    def move(self, params, command):
+        if params.startswith("?"):
+            return
+        values = [int(v) if v.isdigit() else 0 for v in params.split(";")]
+        n = max(values[0], 1)
+        if command == "A":
+            self.y = max(self.y - n, 0)
+        elif command == "B":
+            self.y = min(self.y + n, self.max_rows)
+        elif command == "C":
+            self.x = min(self.x + n, (self.width or MAX_COLUMNS) - 1)
+        elif command == "D":
+            self.x = max(min(self.x, self.width or self.x) - n, 0)
+        elif command in ("H", "f"):
+            self.y = min(n - 1, self.max_rows)
+            self.x = max(values[1], 1) - 1 if len(values) > 1 else 0
+            self.x = min(self.x, (self.width or MAX_COLUMNS) - 1)
+        elif command == "s":
+            self.saved = (self.x, self.y)
+        elif command == "u":
+            self.x, self.y = self.saved
+
+    def write(self, text):
+        start = 0
+        while start < len(text):
+            if self.width and self.x >= self.width:
+                self.x = 0
+                self.y += 1
+            if self.y >= self.max_rows or self.x >= MAX_COLUMNS:
+                return
+            end = min(len(text), start + (self.width or MAX_COLUMNS) - self.x)
+            while len(self.rows) <= self.y:
+                self.rows.append(([], []))
+            chars, formats = self.rows[self.y]
+            if len(chars) < self.x:
+                padding = self.x - len(chars)
+                chars.extend(" " * padding)
+                formats.extend([PLAIN] * padding)
+            x = self.x + end - start
+            chars[self.x : x] = text[start:end]
+            formats[self.x : x] = [self.format] * (end - start)
+            self.x = x
+            start = end
+
+    def lines(self):
+        """
+        Yields the rows as IRC formatted lines.
+        """
+        for chars, formats in self.rows:
+            yield encode_row(chars, formats)
@@ -60,6 +60,14 @@ conf.registerGlobalValue(
     TextArt, "imgurAPI", registry.String("", _("""Imgur Client ID"""), private=True)
 )
 
+conf.registerGlobalValue(
+    TextArt,
+    "uploadTimeout",
+    registry.NonNegativeInteger(
+        30, _("""Seconds to wait for Imgur to take an image. 0 for no limit.""")
+    ),
+)
+
 conf.registerChannelValue(
     TextArt,
     "pasteEnable",
@@ -70,6 +78,95 @@ conf.registerGlobalValue(
     TextArt, "cacheColors", registry.Boolean(False, _("""Cache color calculations.""")),
 )
 
+conf.registerGlobalValue(
+    TextArt,
+    "colorTableBits",
+    registry.NonNegativeInteger(
+        0,
+        _(
+            """
+            Bits per RGB channel (up to 8) of the precomputed lookup tables of IRC
+            colors, which are built in the background and saved in the data
+            directory the first time each palette and speed is used. Colors are
+            matched without the table until it is ready. 6 builds 256KiB tables in
+            seconds, 8 builds exact 16MiB tables in minutes. 0 disables the tables
+            (default).
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    TextArt,
+    "maxFileSize",
+    registry.NonNegativeInteger(
+        1048576,
+        _(
+            """
+            Maximum number of bytes read from art files fetched by scroll, mircart,
+            a2m and png. scroll and mircart cut longer files off, a2m and png refuse
+            them. 0 for no limit.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    TextArt,
+    "maxImageSize",
+    registry.NonNegativeInteger(
+        10485760,
+        _(
+            """
+            Maximum number of bytes of images fetched by img and p2u. Larger images
+            are refused. 0 for no limit.
+            """
+        ),
+    ),
+)
+
+conf.registerChannelValue(
+    TextArt,
+    "maxLines",
+    registry.NonNegativeInteger(
+        1000,
+        _(
+            """
+            Maximum number of lines scrolled from art files fetched by scroll,
+            mircart and a2m. 0 for no limit.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    TextArt,
+    "cacheFiles",
+    registry.NonNegativeInteger(
+        200,
+        _(
+            """
+            Number of art files fetched by scroll and mircart kept in the data
+            directory. 0 disables the cache. The fortune file is always kept.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    TextArt,
+    "cacheLifetime",
+    registry.NonNegativeInteger(
+        86400,
+        _(
+            """
+            Seconds cached art files are used without asking the server whether
+            they changed, using their ETag and Last-Modified headers.
+            """
+        ),
+    ),
+)
+
 conf.registerChannelValue(
     TextArt,
     "showStats",
@@ -213,6 +310,70 @@ conf.registerChannelValue(
     ),
 )
 
+conf.registerGlobalValue(
+    TextArt,
+    "fontDirectories",
+    registry.CommaSeparatedListOfStrings(
+        ["/usr/share/figlet", "/usr/local/share/tdfiglet/fonts"],
+        _(
+            """
+            Directories searched for FIGlet (.flf, .tlf) and TheDraw (.tdf) fonts,
+            in order. The figlet directory of the plugin, which has the standard
+            font, is searched first and the fonts directory in the data directory
+            last.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    TextArt,
+    "fontCacheSize",
+    registry.NonNegativeInteger(16, _("""Number of parsed fonts kept in memory.""")),
+)
+
+conf.registerGlobalValue(
+    TextArt,
+    "workers",
+    registry.NonNegativeInteger(
+        0,
+        _(
+            """
+            Number of worker processes converting images for img and png, so several
+            conversions run at once. 0 converts in the command's thread.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    TextArt,
+    "workerTimeout",
+    registry.NonNegativeInteger(
+        60,
+        _(
+            """
+            Seconds a worker process, or the external converter of a2m and p2u,
+            may spend on one conversion before it is killed. 0 for no limit.
+            """
+        ),
+    ),
+)
+
+conf.registerGlobalValue(
+    TextArt,
+    "workerMemory",
+    registry.NonNegativeInteger(
+        512,
+        _(
+            """
+            Megabytes of memory a worker process may allocate on top of its own
+            size once started. 0 for no limit.
+            """
+        ),
+    ),
+)
+
 conf.registerGlobalValue(
     TextArt,
     "userAgents",
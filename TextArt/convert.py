@@ -0,0 +1,295 @@
+###
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+convert: image to IRC art and IRC art to image conversions. They only take
+plain values, so they can run in a worker process.
+"""
+
+import io
+import os
+import re
+import threading
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageEnhance, ImageFont
+from .colors import rgbColors
+from .encoder import encode_line, get_half_block_cells
+from .quantize import get_palette
+
+FONT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "DejaVu.ttf")
+CELL_WIDTH = 10
+CELL_HEIGHT = 20
+# Glyphs kept per font size before the atlas starts over
+MAX_GLYPHS = 4096
+
+FORMAT = re.compile(
+    "\x03([0-9]{1,2})(?:,([0-9]{1,2}))?|[\x02\x03\x0f\x16\x1f]|[^\x02\x03\x0f\x16\x1f]+"
+)
+STRIP_FORMAT = re.compile("(\x03([0-9]{1,2})(,[0-9]{1,2})?)|[\x0f\x02\x1f\x03\x16]")
+IGNORE_CHRS = ("\x16", "\x1f", "\x02", "\x03", "\x0f")
+
+
+def image2irc(
+    data,
+    type="1/2",
+    gscale="\xa0",
+    cols=80,
+    colors=83,
+    speed="slow",
+    quantize=False,
+    bg=99,
+    fg=99,
+    saturation=None,
+    resize=3,
+    chars=False,
+    tops=False,
+    cache=False,
+    bits=0,
+    directory=None,
+    max_bytes=0,
+):
+    """
+    Converts the image file data to IRC lines. Returns the lines and the
+    number of source colors that had to be matched to the palette.
+    """
+    image = Image.open(io.BytesIO(data))
+    source_colors = 0
+    if image.mode == "RGBA":
+        if bg == 99:
+            newbg = 1
+        else:
+            newbg = bg
+        image = Image.alpha_composite(
+            Image.new("RGBA", image.size, rgbColors[newbg] + (255,)), image
+        )
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    # store dimensions
+    W, H = image.size[0], image.size[1]
+    # compute width of tile
+    w = W / cols
+    # compute tile height based on aspect ratio and scale
+    if type == "1/2":
+        scale = 1.0
+    else:
+        scale = 0.5
+    h = w / scale
+    # compute number of rows
+    rows = int(H / h)
+    if type != "no-color":
+        image2 = image.resize((cols, rows), resize)
+        if saturation is not None:
+            image2 = ImageEnhance.Color(image2).enhance(saturation)
+        if quantize:
+            image2 = image2.quantize(dither=None)
+            image2 = image2.convert("RGB")
+        colormap, source_colors = get_palette(colors).match(
+            np.array(image2), speed, cache, bits, directory
+        )
+        colormap = colormap.tolist()
+    # ascii image is a list of character strings
+    aimg = []
+    if type == "1/2":
+        for j in range(0, rows - 1, 2):
+            cells = get_half_block_cells(colormap[j], colormap[j + 1], tops)
+            aimg.append(encode_line(cells, max_bytes))
+        return aimg, source_colors
+    if not chars and gscale != "\xa0":
+        image = image.resize((cols, rows), resize)
+        image = image.convert("L")
+        lumamap = np.array(image)
+    # generate list of dimensions
+    char = 0
+    for j in range(rows):
+        # append an empty string
+        aimg.append("")
+        old_color = None
+        for i in range(cols):
+            if not chars and gscale != "\xa0":
+                # get average luminance
+                avg = int(np.average(lumamap[j][i]))
+                # look up ascii char
+                gsval = gscale[int((avg * (len(gscale) - 1)) / 255)]
+            elif chars and gscale != "\xa0":
+                if char < len(gscale):
+                    gsval = gscale[char]
+                    char += 1
+                else:
+                    char = 0
+                    gsval = gscale[char]
+                    char += 1
+            else:
+                gsval = "\xa0"
+            # get color value
+            if type != "no-color" and gscale != "\xa0" and i == 0:
+                color = colormap[j][i]
+                old_color = color
+                if bg != 99:
+                    color = "{0},{1}".format(color, "{:02d}".format(int(bg)))
+                if gsval != "\xa0":
+                    aimg[j] += "\x03{0}{1}".format(color, gsval)
+                else:
+                    aimg[j] += "\x030,{0} ".format(int(color))
+            elif type == "no-color" and i == 0:
+                if bg != 99 and fg != 99:
+                    aimg[j] += "\x03{0},{1}{2}".format(
+                        "{:02d}".format(int(fg)), "{:02d}".format(int(bg)), gsval
+                    )
+                elif fg != 99:
+                    aimg[j] += "\x03{0}{1}".format("{:02d}".format(int(fg)), gsval)
+                elif bg != 99:
+                    aimg[j] += "\x03{0},{1}{2}".format(
+                        "{:02d}".format(int(fg)), "{:02d}".format(int(bg)), gsval
+                    )
+            elif type != "no-color" and gsval != " ":
+                color = colormap[j][i]
+                if color != old_color:
+                    old_color = color
+                    # append ascii char to string
+                    if gsval != "\xa0":
+                        if gsval.isdigit():
+                            color = "{:02d}".format(int(color))
+                            aimg[j] += "\x03{0}{1}".format(color, gsval)
+                        else:
+                            aimg[j] += "\x03{0}{1}".format(int(color), gsval)
+                    else:
+                        aimg[j] += "\x030,{0} ".format(int(color))
+                else:
+                    aimg[j] += "{0}".format(gsval)
+            else:
+                aimg[j] += "{0}".format(gsval)
+    return aimg, source_colors
+
+
+class GlyphAtlas:
+    """
+    Antialiased masks of the glyphs of the font at size, each rasterized
+    once into a cell of CELL_WIDTH by CELL_HEIGHT pixels.
+    """
+
+    def __init__(self, size):
+        self.font = ImageFont.truetype(FONT, size)
+        self.lock = threading.Lock()
+        # Index 0 is the blank glyph of empty cells
+        self.index = {" ": 0}
+        self.masks = np.zeros((1, CELL_HEIGHT, CELL_WIDTH), dtype=np.uint8)
+
+    def rasterize(self, chars):
+        masks = []
+        for char in chars:
+            mask = Image.new("L", (CELL_WIDTH, CELL_HEIGHT))
+            ImageDraw.Draw(mask).text((0, 0), char, font=self.font, fill=255)
+            masks.append(np.array(mask))
+        return masks
+
+    def get_masks(self, chars):
+        """
+        Returns an array of glyph masks and a dict of the index of every
+        character of chars in it, rasterizing the ones not seen yet. Once the
+        atlas holds MAX_GLYPHS glyphs, characters that would overflow it are
+        rasterized into masks for this call only.
+        """
+        chars = set(chars)
+        with self.lock:
+            new = sorted(chars.difference(self.index))
+            if len(self.index) + len(new) <= MAX_GLYPHS:
+                if new:
+                    masks = self.rasterize(new)
+                    self.index.update(zip(new, range(len(self.index), MAX_GLYPHS)))
+                    self.masks = np.concatenate((self.masks, masks))
+                return self.masks, {char: self.index[char] for char in chars}
+            index = {char: self.index[char] for char in chars if char in self.index}
+            index.update(zip(new, range(len(self.masks), len(self.masks) + len(new))))
+            return np.concatenate((self.masks, self.rasterize(new))), index
+
+
+atlases = {}
+
+
+def get_atlas(size):
+    atlas = atlases.get(size)
+    if atlas is None:
+        atlas = atlases[size] = GlyphAtlas(size)
+    return atlas
+
+
+def irc2png(text, size=18, defaultBg=1, defaultFg=0):
+    """
+    Draws IRC formatted text and returns it as PNG data. Every character is
+    parsed into grids of glyph, foreground and background indexes, and the
+    image is assembled from one tile per distinct cell.
+    """
+    if not (0 <= defaultBg < len(rgbColors) and 0 <= defaultFg < len(rgbColors)):
+        raise ValueError("colors must be 0-{0}".format(len(rgbColors) - 1))
+    text = text.replace("\t", " ")
+    lineLens = [len(line) for line in STRIP_FORMAT.sub("", text).splitlines()]
+    width, height = max(lineLens), len(lineLens)
+    glyphs = np.zeros((height, width), dtype=np.intp)
+    fgs = np.full((height, width), defaultFg, dtype=np.intp)
+    bgs = np.full((height, width), defaultBg, dtype=np.intp)
+    runs = []
+    for y, line in enumerate(text.split("\n")[:height]):
+        x, fg, bg = 0, defaultFg, defaultBg
+        for match in FORMAT.finditer(line):
+            run = match.group(0)
+            if run == "\x03":
+                fg, bg = defaultFg, defaultBg
+            elif run[0] == "\x03":
+                fg = int(match.group(1))
+                if match.group(2) is not None:
+                    bg = int(match.group(2))
+            elif run == "\x0f":
+                fg, bg = defaultFg, defaultBg
+            elif run not in IGNORE_CHRS:
+                run = run[: width - x]
+                runs.append((y, x, run))
+                fgs[y, x : x + len(run)] = fg
+                bgs[y, x : x + len(run)] = bg
+                x += len(run)
+    masks, index = get_atlas(size).get_masks("".join(run for y, x, run in runs))
+    for y, x, run in runs:
+        glyphs[y, x : x + len(run)] = [index[char] for char in run]
+    # 99 is the default color
+    fgs[fgs == 99] = defaultFg
+    bgs[bgs == 99] = defaultBg
+    # Every glyph, foreground and background combination is blended once
+    cells, inverse = np.unique((glyphs * 100 + fgs) * 100 + bgs, return_inverse=True)
+    palette = np.array(rgbColors, dtype=np.uint16)
+    mask = masks[cells // 10000].astype(np.uint16)[..., np.newaxis]
+    fg = palette[cells // 100 % 100][:, np.newaxis, np.newaxis]
+    bg = palette[cells % 100][:, np.newaxis, np.newaxis]
+    # Divides by 255 with the rounding PIL uses to draw antialiased text
+    blend = bg * (255 - mask) + fg * mask + 128
+    tiles = (((blend >> 8) + blend) >> 8).astype(np.uint8)
+    image = tiles[inverse.reshape(height, width)].transpose(0, 2, 1, 3, 4)
+    image = image.reshape(height * CELL_HEIGHT, width * CELL_WIDTH, 3)
+    output = io.BytesIO()
+    Image.fromarray(image).save(output, "PNG")
+    return output.getvalue()
@@ -0,0 +1,160 @@
+###
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+encoder: writes rows of colored cells as IRC text with as few color codes
+as possible.
+"""
+
+UPPER_HALF = "▀"
+LOWER_HALF = "▄"
+FULL_BLOCK = "█"
+
+# A color code sets the foreground and optionally the background: \x03FG,BG
+MAX_CODE_BYTES = len("\x0399,99")
+# Color written when a code has to set a color no cell needs, as the shortest
+FILLER = 1
+# Colors of the next cells tried when a code can set a color early
+MAX_NEXT_COLORS = 2
+
+
+def get_half_block_cells(top, bottom, tops=False):
+    """
+    Returns the cells showing two rows of IRC colors with half blocks. Every
+    cell is a tuple of the ways to draw it as (glyph, fg, bg), where a None
+    color may be anything. With tops, only upper half blocks and spaces are
+    used, for fonts that draw the other blocks badly.
+    """
+    cells = []
+    for color1, color2 in zip(top, bottom):
+        if color1 == color2:
+            if tops:
+                cells.append(((" ", None, color1),))
+            else:
+                cells.append(((" ", None, color1), (FULL_BLOCK, color1, None)))
+        elif tops:
+            cells.append(((UPPER_HALF, color1, color2),))
+        else:
+            cells.append(((UPPER_HALF, color1, color2), (LOWER_HALF, color2, color1)))
+    return cells
+
+
+def get_next_colors(cells, start):
+    """
+    Returns the colors the cells from start on may need, up to the first cell
+    that cannot be drawn without setting both colors or MAX_NEXT_COLORS
+    colors, so that a color code can already set one of them.
+    """
+    colors = []
+    for cell in cells[start:]:
+        for glyph, glyph_fg, glyph_bg in cell:
+            for color in (glyph_fg, glyph_bg):
+                if color is not None and color not in colors:
+                    colors.append(color)
+        if len(colors) >= MAX_NEXT_COLORS or all(None not in option for option in cell):
+            break
+    return tuple(colors[:MAX_NEXT_COLORS])
+
+
+def get_codes(fg, bg, glyph, glyph_fg, glyph_bg, colors):
+    """
+    Yields the (code, fg, bg) that switch from the fg and bg colors to ones
+    that draw glyph. A color the glyph does not care about is kept, or set
+    to one of colors or to the one digit FILLER when both have to be written
+    anyway.
+    """
+    fg_ok = glyph_fg is None or glyph_fg == fg
+    bg_ok = glyph_bg is None or glyph_bg == bg
+    if fg_ok and bg_ok:
+        yield "", fg, bg
+        return
+    if bg_ok:
+        yield "\x03%d" % glyph_fg, glyph_fg, bg
+    if glyph_fg is not None:
+        fgs = (glyph_fg,)
+    else:
+        fgs = {color for color in colors + (fg, FILLER) if color is not None}
+    if glyph_bg is not None:
+        bgs = (glyph_bg,)
+    else:
+        bgs = {color for color in colors + (bg, FILLER) if color is not None}
+    for new_fg in fgs:
+        for new_bg in bgs:
+            yield "\x03%d,%d" % (new_fg, new_bg), new_fg, new_bg
+
+
+def encode_line(cells, max_bytes=0):
+    """
+    Returns the shortest IRC text drawing cells, as returned by
+    get_half_block_cells, given that the colors at the start of the line are
+    unknown. This is a shortest path search over the (fg, bg) colors in
+    effect after each cell, keeping only the states that can still beat the
+    best one. Glyphs must not be digits or commas, which would be read as
+    part of a color code. With max_bytes, cells that do not fit in that many
+    UTF-8 bytes are dropped from the end of the line.
+    """
+    states = {(None, None): (0, None, "")}
+    steps = []
+    for index, cell in enumerate(cells):
+        colors = get_next_colors(cells, index + 1)
+        next_states = {}
+        for state, (cost, _, _) in states.items():
+            for glyph, glyph_fg, glyph_bg in cell:
+                glyph_bytes = len(glyph.encode())
+                for code, fg, bg in get_codes(
+                    *state, glyph, glyph_fg, glyph_bg, colors
+                ):
+                    new_cost = cost + len(code) + glyph_bytes
+                    best = next_states.get((fg, bg))
+                    if best is None or new_cost < best[0]:
+                        next_states[(fg, bg)] = (new_cost, state, code + glyph)
+        least = min(cost for cost, _, _ in next_states.values())
+        states = {
+            state: step
+            for state, step in next_states.items()
+            if step[0] < least + MAX_CODE_BYTES
+        }
+        steps.append(states)
+    if not steps:
+        return ""
+    state = min(states, key=lambda state: states[state][0])
+    pieces = []
+    for states in reversed(steps):
+        _, previous, piece = states[state]
+        pieces.append(piece)
+        state = previous
+    pieces.reverse()
+    if max_bytes:
+        size = 0
+        for index, piece in enumerate(pieces):
+            size += len(piece.encode())
+            if size > max_bytes:
+                pieces = pieces[:index]
+                break
+    return "".join(pieces)
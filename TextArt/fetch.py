@@ -0,0 +1,266 @@
+###
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+fetch: reads text files from the web line by line as they download, keeping
+complete files in a cache that is revalidated with ETag and Last-Modified.
+"""
+
+import hashlib
+import io
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+CHUNK_SIZE = 8192
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+class FileCache:
+    """
+    Downloaded files kept in directory, each next to a JSON file with its URL,
+    content type, encoding and validators. Only the size most recently
+    checked files are kept.
+    """
+
+    def __init__(self, directory, size=200):
+        self.directory = directory
+        self.size = size
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode()).hexdigest())
+
+    def load(self, url):
+        """
+        Returns the metadata of the cached copy of url, or None.
+        """
+        path = self.get_path(url)
+        try:
+            with open("%s.json" % path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return
+        if meta.get("url") != url or not os.path.exists(path):
+            return
+        return meta
+
+    def store(self, url, filename, meta):
+        """
+        Moves the complete download in filename to the cache.
+        """
+        os.replace(filename, self.get_path(url))
+        self.touch(url, meta)
+        self.prune()
+
+    def touch(self, url, meta):
+        """
+        Saves meta for url, recording that the cached copy was just checked.
+        """
+        meta["checked"] = time.time()
+        path = "%s.json" % self.get_path(url)
+        with open("%s.tmp" % path, "w") as f:
+            json.dump(meta, f)
+        os.replace("%s.tmp" % path, path)
+
+    def prune(self):
+        with self.lock:
+            files = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".json"):
+                    try:
+                        mtime = os.path.getmtime(os.path.join(self.directory, name))
+                    except OSError:
+                        continue
+                    files.append((mtime, name[: -len(".json")]))
+            files.sort()
+            for mtime, name in files[: max(len(files) - self.size, 0)]:
+                for filename in (name, "%s.json" % name):
+                    try:
+                        os.remove(os.path.join(self.directory, filename))
+                    except OSError:
+                        pass
+
+
+class Download:
+    """
+    A file read from url, or from cache when its copy was checked less than
+    lifetime seconds ago or the server answers that it did not change. Only
+    the first max_bytes bytes are read. Raises requests exceptions when the
+    file cannot be retrieved.
+    """
+
+    def __init__(
+        self, url, headers=None, cache=None, lifetime=0, max_bytes=0, timeout=10
+    ):
+        self.url = url
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.response = None
+        self.meta = cache.load(url) if cache else None
+        if self.meta and time.time() - self.meta["checked"] < lifetime:
+            return
+        headers = dict(headers or {})
+        if self.meta and self.meta.get("etag"):
+            headers["If-None-Match"] = self.meta["etag"]
+        if self.meta and self.meta.get("last_modified"):
+            headers["If-Modified-Since"] = self.meta["last_modified"]
+        response = requests.get(url, headers=headers, stream=True, timeout=timeout)
+        if response.status_code == 304 and self.meta:
+            response.close()
+            cache.touch(url, self.meta)
+            return
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            response.close()
+            raise
+        self.response = response
+        self.meta = {
+            "url": url,
+            "content_type": response.headers.get("content-type", ""),
+            "encoding": response.encoding,
+            "etag": response.headers.get("etag"),
+            "last_modified": response.headers.get("last-modified"),
+        }
+
+    @property
+    def content_type(self):
+        return self.meta["content_type"]
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+
+    def iter_content(self):
+        """
+        Yields the file in chunks. A download read to the end is saved to the
+        cache.
+        """
+        size = 0
+        for chunk in self.iter_chunks():
+            if self.max_bytes and size + len(chunk) > self.max_bytes:
+                yield chunk[: self.max_bytes - size]
+                return
+            size += len(chunk)
+            yield chunk
+
+    def iter_chunks(self):
+        if self.response is None:
+            return self.iter_file()
+        return self.iter_response()
+
+    def iter_file(self):
+        with open(self.cache.get_path(self.url), "rb") as f:
+            yield from iter(lambda: f.read(CHUNK_SIZE), b"")
+
+    def iter_response(self):
+        temp = None
+        if self.cache:
+            temp = tempfile.NamedTemporaryFile(dir=self.cache.directory, delete=False)
+        complete = False
+        try:
+            with self.response:
+                for chunk in self.response.iter_content(CHUNK_SIZE):
+                    if temp:
+                        temp.write(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            if temp:
+                temp.close()
+                if complete:
+                    self.cache.store(self.url, temp.name, self.meta)
+                else:
+                    os.remove(temp.name)
+
+    def lines(self, max_lines=0):
+        """
+        Yields the decoded lines of the file as they arrive, up to max_lines.
+        """
+        lines = self.iter_lines()
+        if max_lines:
+            lines = itertools.islice(lines, max_lines)
+        return lines
+
+    def iter_lines(self):
+        buffer = b""
+        for chunk in self.iter_content():
+            *lines, buffer = (buffer + chunk).split(b"\n")
+            for line in lines:
+                yield from self.decode(line)
+        if buffer:
+            yield from self.decode(buffer)
+
+    def decode(self, line):
+        try:
+            text = line.decode()
+        except UnicodeDecodeError:
+            text = line.decode(self.meta["encoding"] or "latin-1", "replace")
+        return text.splitlines() or [""]
+
+    def read(self):
+        """
+        Returns the whole file, read into memory. Raises FileTooLarge if it
+        is longer than max_bytes.
+        """
+        length = self.response.headers.get("content-length") if self.response else None
+        if self.max_bytes and length and length.isdigit():
+            if int(length) > self.max_bytes:
+                self.close()
+                raise FileTooLarge(self.max_bytes)
+        buffer = io.BytesIO()
+        chunks = self.iter_chunks()
+        try:
+            for chunk in chunks:
+                buffer.write(chunk)
+                if self.max_bytes and buffer.tell() > self.max_bytes:
+                    raise FileTooLarge(self.max_bytes)
+        finally:
+            chunks.close()
+        return buffer.getvalue()
+
+    def save(self):
+        """
+        Returns the path of the cached copy of the file, downloading it first
+        unless the cached copy is still valid.
+        """
+        if self.response is not None:
+            for chunk in self.iter_content():
+                pass
+        return self.cache.get_path(self.url)
@@ -0,0 +1,579 @@
+###
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+fonts: renders text with FIGlet (.flf, .tlf) and TheDraw (.tdf) fonts, which
+are parsed once into glyph tables and kept in an LRU cache.
+"""
+
+import io
+import os
+import struct
+import threading
+import zipfile
+from collections import OrderedDict
+
+from .ansi import PLAIN, encode_row
+
+FIGLET_EXTENSIONS = (".flf", ".tlf")
+TDF_EXTENSIONS = (".tdf",)
+
+# FIGlet horizontal layout: smushing rules, fitting and smushing
+SM_EQUAL = 1
+SM_LOWLINE = 2
+SM_HIERARCHY = 4
+SM_PAIR = 8
+SM_BIGX = 16
+SM_HARDBLANK = 32
+SM_KERN = 64
+SM_SMUSH = 128
+
+HIERARCHY = ("|", "/\\", "[]", "{}", "()", "<>")
+PAIRS = {"[]", "][", "{}", "}{", "()", ")("}
+
+# Codes of the German characters that follow ASCII in every FIGlet font
+DEUTSCH = (196, 214, 220, 228, 246, 252, 223)
+
+TDF_HEADER = b"\x13TheDraw FONTS file\x1a"
+TDF_FONT = b"\x55\xaa\x00\xff"
+TDF_TYPES = ("outline", "block", "color")
+TDF_SPACE_WIDTH = 3
+
+# IRC codes of the 16 DOS colors of TheDraw attributes
+DOS_COLORS = (
+    "01",
+    "02",
+    "03",
+    "10",
+    "05",
+    "06",
+    "07",
+    "15",
+    "14",
+    "12",
+    "09",
+    "11",
+    "04",
+    "13",
+    "08",
+    "00",
+)
+
+BLANK = (" ", None, None)
+
+
+def get_mirror(*pairs):
+    mirror = {}
+    for a, b in pairs:
+        mirror[ord(a)] = b
+        mirror[ord(b)] = a
+    return mirror
+
+
+FLIP = get_mirror("()", "/\\", "<>", "[]", "{}", "bd", "pq")
+FLOP = get_mirror("/\\", "^v", "_‾", "',", "`.", "MW", "bp", "dq")
+ROTATE = get_mirror("-|", "/\\")
+RAINBOW = ("13", "04", "08", "09", "11", "12")
+METAL = ("12", "02", "15", "14")
+
+
+def break_text(text, measure, width):
+    """
+    Splits text into lines that render at most width columns wide according
+    to measure, between words when possible. A width of 0 means no limit.
+    """
+    if not width:
+        return [text]
+    lines = []
+    line = ""
+    for word in text.split(" "):
+        candidate = "{0} {1}".format(line, word) if line else word
+        if line and measure(candidate) > width:
+            lines.append(line)
+            candidate = word
+        while len(candidate) > 1 and measure(candidate) > width:
+            cut = len(candidate) - 1
+            while cut > 1 and measure(candidate[:cut]) > width:
+                cut -= 1
+            lines.append(candidate[:cut])
+            candidate = candidate[cut:]
+        line = candidate
+    if line:
+        lines.append(line)
+    return lines
+
+
+class FigletFont:
+    """
+    A FIGlet font, with every glyph as a tuple of rows.
+    """
+
+    def __init__(self, name, data):
+        self.name = name
+        if data.startswith(b"PK"):
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                data = archive.read(archive.namelist()[0])
+        try:
+            text = data.decode()
+        except UnicodeDecodeError:
+            text = data.decode("latin-1")
+        lines = text.splitlines()
+        header = lines[0].split() if lines else []
+        if len(header) < 6 or header[0][:5] not in ("flf2a", "tlf2a"):
+            raise ValueError("{0} is not a FIGlet font".format(name))
+        self.hardblank = header[0][5:6] or "$"
+        self.height = int(header[1])
+        self.direction = int(header[6]) if len(header) > 6 else 0
+        old_layout = int(header[4])
+        if len(header) > 7:
+            self.layout = int(header[7])
+        elif old_layout < 0:
+            self.layout = 0
+        elif old_layout == 0:
+            self.layout = SM_KERN
+        else:
+            self.layout = (old_layout & 31) | SM_SMUSH
+        self.glyphs = {}
+        index = 1 + int(header[5])
+        for code in list(range(32, 127)) + list(DEUTSCH):
+            glyph = self.read_glyph(lines, index)
+            if glyph is None:
+                return
+            self.glyphs[chr(code)] = glyph
+            index += self.height
+        while index < len(lines):
+            glyph = self.read_glyph(lines, index + 1)
+            if glyph is None:
+                return
+            try:
+                code = int(lines[index].split()[0], 0)
+            except (IndexError, ValueError):
+                code = -1
+            if 0 <= code < 0x110000:
+                self.glyphs[chr(code)] = glyph
+            index += self.height + 1
+
+    def read_glyph(self, lines, start):
+        rows = lines[start : start + self.height]
+        if len(rows) < self.height:
+            return
+        glyph = []
+        for row in rows:
+            row = row.rstrip()
+            glyph.append(row.rstrip(row[-1]) if row else row)
+        width = max(len(row) for row in glyph)
+        return tuple(row.ljust(width) for row in glyph)
+
+    def smush(self, left, right, layout, widths):
+        """
+        Returns the character replacing left and right when they overlap, or
+        None if they cannot.
+        """
+        if left == " ":
+            return right
+        if right == " ":
+            return left
+        if min(widths) < 2 or not layout & SM_SMUSH:
+            return
+        hardblank = self.hardblank
+        if not layout & 63:
+            if left == hardblank:
+                return right
+            return left if right == hardblank else right
+        if layout & SM_HARDBLANK and left == right == hardblank:
+            return left
+        if hardblank in (left, right):
+            return
+        if layout & SM_EQUAL and left == right:
+            return left
+        if layout & SM_LOWLINE:
+            if left == "_" and right in "|/\\[]{}()<>":
+                return right
+            if right == "_" and left in "|/\\[]{}()<>":
+                return left
+        if layout & SM_HIERARCHY:
+            for i, group in enumerate(HIERARCHY):
+                above = "".join(HIERARCHY[i + 1 :])
+                if left in group and right in above:
+                    return right
+                if right in group and left in above:
+                    return left
+        if layout & SM_PAIR and left + right in PAIRS:
+            return "|"
+        if layout & SM_BIGX:
+            if left == "/" and right == "\\":
+                return "|"
+            if left == "\\" and right == "/":
+                return "Y"
+            if left == ">" and right == "<":
+                return "X"
+
+    def get_overlap(self, rows, glyph, layout, widths):
+        """
+        Returns how many columns glyph can be moved into the rendered rows.
+        """
+        if not layout & (SM_SMUSH | SM_KERN):
+            return 0
+        overlap = widths[1]
+        for row, part in zip(rows, glyph):
+            end = max(len(row.rstrip(" ")) - 1, 0)
+            left = row[end] if row else None
+            start = len(part) - len(part.lstrip(" "))
+            right = part[start] if start < len(part) else None
+            amount = start + len(row) - 1 - end
+            if left is None or left == " ":
+                amount += 1
+            elif right is not None and self.smush(left, right, layout, widths):
+                amount += 1
+            overlap = min(overlap, amount)
+        return overlap
+
+    def render_line(self, text, layout):
+        if self.direction == 1:
+            text = text[::-1]
+        rows = [""] * self.height
+        previous = 0
+        for char in text:
+            glyph = self.glyphs.get(char)
+            if glyph is None:
+                continue
+            widths = (previous, len(glyph[0]))
+            overlap = self.get_overlap(rows, glyph, layout, widths)
+            for i, part in enumerate(glyph):
+                row = list(rows[i])
+                for k in range(overlap if row else 0):
+                    column = max(len(row) - overlap + k, 0)
+                    left, right = row[column], part[k]
+                    row[column] = self.smush(left, right, layout, widths) or right
+                rows[i] = "".join(row) + part[overlap:]
+            previous = widths[1]
+        return rows
+
+    def measure(self, text, layout=None):
+        if layout is None:
+            layout = self.layout
+        return len(self.render_line(text, layout)[0])
+
+    def render(self, text, width=0, layout=None):
+        """
+        Returns the rows of text rendered with the font's layout, or layout,
+        breaking lines to fit in width columns unless it is 0.
+        """
+        if layout is None:
+            layout = self.layout
+        rows = []
+        for line in break_text(text, lambda text: self.measure(text, layout), width):
+            for row in self.render_line(line, layout):
+                rows.append(row.replace(self.hardblank, " ").rstrip())
+        return rows
+
+
+class TheDrawFont:
+    """
+    A TheDraw font, with every glyph as a tuple of rows of (char, fg, bg)
+    cells. Only block and color fonts can be rendered.
+    """
+
+    def __init__(self, name, type, spacing, offsets, data):
+        self.name = name
+        self.type = TDF_TYPES[type] if type < len(TDF_TYPES) else "unknown"
+        self.spacing = spacing
+        self.glyphs = {}
+        for i, offset in enumerate(offsets):
+            if offset != 0xFFFF and offset + 2 <= len(data):
+                self.glyphs[chr(33 + i)] = self.read_glyph(data, offset)
+
+    def read_glyph(self, data, offset):
+        width = data[offset]
+        rows = [[]]
+        i = offset + 2
+        while i < len(data) and data[i]:
+            char = data[i]
+            i += 1
+            if char == 13:
+                rows.append([])
+                continue
+            if char < 32:
+                char = 32
+            char = bytes((char,)).decode("cp437")
+            if self.type == "color" and i < len(data):
+                attr = data[i]
+                i += 1
+                rows[-1].append((char, DOS_COLORS[attr & 15], DOS_COLORS[attr >> 4]))
+            else:
+                rows[-1].append((char, None, None))
+        while len(rows) > 1 and not rows[-1]:
+            rows.pop()
+        width = max([width] + [len(row) for row in rows])
+        return tuple(tuple(row + [BLANK] * (width - len(row))) for row in rows)
+
+    def get_glyph(self, char):
+        if char == " ":
+            return ((BLANK,) * TDF_SPACE_WIDTH,)
+        glyph = self.glyphs.get(char)
+        if glyph is None:
+            glyph = self.glyphs.get(char.upper()) or self.glyphs.get(char.lower())
+        return glyph
+
+    def measure(self, text):
+        glyphs = [glyph for glyph in map(self.get_glyph, text) if glyph]
+        width = sum(len(glyph[0]) for glyph in glyphs)
+        return width + self.spacing * max(len(glyphs) - 1, 0)
+
+    def get_info(self):
+        return "{0}: {1} font, spacing {2}, {3} characters".format(
+            self.name, self.type, self.spacing, len(self.glyphs)
+        )
+
+    def render(self, text, width=80, justify="l"):
+        """
+        Returns text rendered as IRC lines, broken to fit in width columns and
+        justified left (l), right (r) or center (c).
+        """
+        if self.type not in ("block", "color"):
+            raise ValueError("{0} fonts are not supported".format(self.type))
+        output = []
+        for line in break_text(text, self.measure, width):
+            glyphs = [glyph for glyph in map(self.get_glyph, line) if glyph]
+            height = max([len(glyph) for glyph in glyphs] + [0])
+            rows = [[] for _ in range(height)]
+            for index, glyph in enumerate(glyphs):
+                for y, row in enumerate(rows):
+                    if index:
+                        row.extend([BLANK] * self.spacing)
+                    if y < len(glyph):
+                        row.extend(glyph[y])
+                    else:
+                        row.extend([BLANK] * len(glyph[0]))
+            padding = max(width - self.measure(line), 0)
+            if justify == "c":
+                padding //= 2
+            elif justify != "r":
+                padding = 0
+            for row in rows:
+                while row and row[-1] == BLANK:
+                    row.pop()
+                chars = [" "] * padding + [char for char, fg, bg in row]
+                formats = [PLAIN] * padding + [
+                    (fg, bg, False, False, False, False) if fg else PLAIN
+                    for char, fg, bg in row
+                ]
+                output.append(encode_row(chars, formats))
+        return output
+
+
+def read_tdf(name, data):
+    """
+    Returns the fonts of a TheDraw font file.
+    """
+    if not data.startswith(TDF_HEADER):
+        raise ValueError("{0} is not a TheDraw font".format(name))
+    fonts = []
+    offset = len(TDF_HEADER)
+    while data[offset : offset + 4] == TDF_FONT and offset + 213 <= len(data):
+        length = min(data[offset + 4], 12)
+        font_name = data[offset + 5 : offset + 5 + length].decode("cp437")
+        type, spacing, size = struct.unpack_from("<BBH", data, offset + 21)
+        offsets = struct.unpack_from("<94H", data, offset + 25)
+        block = data[offset + 213 : offset + 213 + size]
+        fonts.append(TheDrawFont(font_name, type, spacing, offsets, block))
+        offset += 213 + size
+    if not fonts:
+        raise ValueError("{0} has no fonts".format(name))
+    return fonts
+
+
+def apply_filters(rows, filters):
+    """
+    Returns rows rendered with a FIGlet font as IRC lines, after applying the
+    toilet filters named in filters, in order.
+    """
+    width = max([len(row) for row in rows] + [0])
+    chars = [list(row.ljust(width)) for row in rows]
+    colors = [[None] * width for row in rows]
+    for name in filters:
+        chars, colors = FILTERS[name](chars, colors)
+    output = []
+    for row, row_colors in zip(chars, colors):
+        while row and row[-1] == " ":
+            row = row[:-1]
+        formats = [
+            (color, None, False, False, False, False) if color else PLAIN
+            for color in row_colors[: len(row)]
+        ]
+        output.append(encode_row(row, formats))
+    return output
+
+
+def crop(chars, colors):
+    used = [y for y, row in enumerate(chars) if "".join(row).strip()]
+    if not used:
+        return [], []
+    chars = chars[used[0] : used[-1] + 1]
+    colors = colors[used[0] : used[-1] + 1]
+    left = min(len(row) - len("".join(row).lstrip()) for row in chars)
+    right = max(len("".join(row).rstrip()) for row in chars)
+    return [row[left:right] for row in chars], [row[left:right] for row in colors]
+
+
+def flip(chars, colors):
+    chars = [[char.translate(FLIP) for char in reversed(row)] for row in chars]
+    return chars, [row[::-1] for row in colors]
+
+
+def flop(chars, colors):
+    chars = [[char.translate(FLOP) for char in row] for row in reversed(chars)]
+    return chars, colors[::-1]
+
+
+def rotate180(chars, colors):
+    return flip(*flop(chars, colors))
+
+
+def left(chars, colors):
+    chars = [[char.translate(ROTATE) for char in row] for row in zip(*chars)][::-1]
+    return chars, [list(row) for row in zip(*colors)][::-1]
+
+
+def right(chars, colors):
+    chars = [[char.translate(ROTATE) for char in row[::-1]] for row in zip(*chars)]
+    return chars, [list(row[::-1]) for row in zip(*colors)]
+
+
+def border(chars, colors):
+    width = len(chars[0]) if chars else 0
+    edge = ["+"] + ["-"] * width + ["+"]
+    chars = [edge] + [["|"] + row + ["|"] for row in chars] + [edge]
+    colors = [[None] + row + [None] for row in colors]
+    blank = [None] * (width + 2)
+    return chars, [blank] + colors + [blank]
+
+
+def gay(chars, colors):
+    colors = [
+        [
+            RAINBOW[(x // 2 + y) % 6] if char != " " else None
+            for x, char in enumerate(row)
+        ]
+        for y, row in enumerate(chars)
+    ]
+    return chars, colors
+
+
+def metal(chars, colors):
+    colors = [
+        [
+            METAL[((y + x // 8) // 2) % 4] if char != " " else None
+            for x, char in enumerate(row)
+        ]
+        for y, row in enumerate(chars)
+    ]
+    return chars, colors
+
+
+FILTERS = {
+    "crop": crop,
+    "flip": flip,
+    "flop": flop,
+    "180": rotate180,
+    "left": left,
+    "right": right,
+    "border": border,
+    "gay": gay,
+    "metal": metal,
+}
+
+
+class FontCache:
+    """
+    Index of the font files in a list of directories by type and name, and
+    LRU cache of the size most recently used fonts. The directories are only
+    listed again when they change.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self.lock = threading.Lock()
+        self.fonts = OrderedDict()
+        self.stamps = None
+        self.index = {}
+
+    def get_index(self, directories):
+        stamps = []
+        for directory in directories:
+            if os.path.isdir(directory):
+                stamps.append((directory, os.path.getmtime(directory)))
+        with self.lock:
+            if stamps != self.stamps:
+                self.index = {"figlet": {}, "tdf": {}}
+                for directory, mtime in stamps:
+                    for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+                        name, extension = os.path.splitext(entry.name)
+                        extension = extension.lower()
+                        if extension in FIGLET_EXTENSIONS:
+                            fonts = self.index["figlet"]
+                        elif extension in TDF_EXTENSIONS:
+                            fonts = self.index["tdf"]
+                        else:
+                            continue
+                        fonts.setdefault(name.lower(), entry.path)
+                self.stamps = stamps
+            return self.index
+
+    def list(self, directories, type):
+        """
+        Returns the sorted names of the fonts of type, figlet or tdf.
+        """
+        return sorted(self.get_index(directories)[type])
+
+    def get(self, directories, type, name):
+        """
+        Returns the figlet or tdf font called name, or None if there is no
+        such font. Raises ValueError if its file is not a valid font.
+        """
+        path = self.get_index(directories)[type].get(name.lower())
+        if not path:
+            return
+        key = (path, os.path.getmtime(path))
+        with self.lock:
+            font = self.fonts.get(key)
+            if font is not None:
+                self.fonts.move_to_end(key)
+                return font
+        with open(path, "rb") as f:
+            data = f.read()
+        if type == "figlet":
+            font = FigletFont(name, data)
+        else:
+            font = read_tdf(name, data)[0]
+        with self.lock:
+            self.fonts[key] = font
+            while len(self.fonts) > self.size:
+                self.fonts.popitem(last=False)
+        return font
@@ -36,28 +36,29 @@ import supybot.ircdb as ircdb
 import supybot.callbacks as callbacks
 import supybot.ircmsgs as ircmsgs
 import supybot.log as log
+import supybot.conf as conf
 import os
 import requests
-from PIL import Image, ImageOps, ImageFont, ImageDraw, ImageEnhance
-import numpy as np
 import sys, math
 import re
-import asyncio
-import pexpect
 import time
 import random
-import pyimgur
 import json
-from .colors import (
-    rgbColors,
-    colors16,
-    colors83,
-    colors99,
-    ansi16,
-    ansi83,
-    ansi99,
-    x16colors,
-)
+import subprocess
+import tempfile
+import threading
+from .ansi import ansi2irc
+from .convert import image2irc, irc2png
+from .fetch import Download, FileCache, FileTooLarge
+from .fonts import FILTERS, SM_KERN, SM_SMUSH, FontCache, apply_filters
+from .quantize import get_palette
+from .scroller import Scroller
+from .workers import WorkerError, WorkerPool
+from PIL import Image, UnidentifiedImageError
+
+# FIGlet fonts shipped with the plugin, so artii and toilet work without any
+# installed
+FONT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "figlet")
 
 try:
     from bs4 import BeautifulSoup
@@ -74,28 +75,181 @@ except ImportError:
     _ = lambda x: x
 
 
+class ToolError(Exception):
+    pass
+
+
 class TextArt(callbacks.Plugin):
     """TextArt: Make Text Art"""
 
     threaded = True
+    upload_url = "https://api.imgur.com/3/image"
 
     def __init__(self, irc):
         self.__parent = super(TextArt, self)
         self.__parent.__init__(irc)
-        self.colors = 99
-        self.stopped = {}
-        self.old_color = None
-        self.source_colors = 0
+        self.scroller = Scroller()
+        directory = self.get_data_directory()
+        self.file_cache = FileCache(os.path.join(directory, "cache"))
+        self.fortune_cache = FileCache(os.path.join(directory, "fortune"), 1)
+        self.fortunes = None
+        self.font_cache = FontCache()
+        self.workers = None
+        self.workers_lock = threading.Lock()
         self.agents = self.registryValue("userAgents")
-        self.matches = {}
+
+    def die(self):
+        self.scroller.close()
+        if self.workers:
+            self.workers.close()
+        self.__parent.die()
+
+    def get_data_directory(self):
+        directory = conf.supybot.directories.data.dirize("TextArt")
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def download(self, url, headers):
+        """
+        Starts downloading an art file, through the file cache unless it is
+        disabled.
+        """
+        self.file_cache.size = self.registryValue("cacheFiles")
+        return Download(
+            url,
+            headers,
+            self.file_cache if self.file_cache.size else None,
+            self.registryValue("cacheLifetime"),
+            self.registryValue("maxFileSize"),
+        )
+
+    def convert(self, function, *args, **kwargs):
+        """
+        Runs a conversion from .convert in the worker pool, or in this thread
+        when workers are disabled. The pool is restarted when its size or
+        memory limit changes, since workers apply the limit when they start.
+        """
+        size = self.registryValue("workers")
+        memory = self.registryValue("workerMemory") * 1024 * 1024
+        with self.workers_lock:
+            if self.workers and (self.workers.size, self.workers.memory) != (
+                size,
+                memory,
+            ):
+                self.workers.close()
+                self.workers = None
+            if size and not self.workers:
+                self.workers = WorkerPool(
+                    size, memory=memory, preload=[image2irc.__module__]
+                )
+            workers = self.workers
+        if not workers:
+            return function(*args, **kwargs)
+        workers.timeout = self.registryValue("workerTimeout")
+        return workers.run(function, *args, **kwargs)
+
+    def fetch(self, irc, command, url, accept, max_bytes):
+        """
+        Returns the content of url read into memory, or None if it cannot be
+        downloaded, accept refuses its content type or it is longer than
+        max_bytes.
+        """
+        header = {"User-Agent": random.choice(self.agents)}
+        try:
+            download = Download(url, header, max_bytes=max_bytes)
+            if not accept(download.content_type):
+                download.close()
+                irc.reply("Invalid file type.", private=False, notice=False)
+                return
+            return download.read()
+        except requests.exceptions.RequestException as e:
+            log.debug("TextArt: error retrieving data for {0}: {1}".format(command, e))
+        except FileTooLarge:
+            irc.reply(
+                "Error: file is larger than {0} bytes.".format(max_bytes),
+                private=False,
+                notice=False,
+            )
+
+    def run_tool(self, command, content, seek=False):
+        """
+        Runs an external converter on content and returns what it wrote to
+        standard output. content is piped to its standard input, or for tools
+        that seek in their input, written to a temporary file given as its
+        last argument. Raises ToolError if the tool fails or runs longer than
+        workerTimeout, and OSError if it cannot be run.
+        """
+        if seek:
+            with tempfile.NamedTemporaryFile(prefix="TextArt") as f:
+                f.write(content)
+                f.flush()
+                return self.run_tool(command + [f.name], b"")
+        timeout = self.registryValue("workerTimeout") or None
+        try:
+            process = subprocess.run(
+                command,
+                input=content,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=timeout,
+            )
+        except subprocess.TimeoutExpired:
+            raise ToolError("timed out after {0} seconds".format(timeout)) from None
+        if process.returncode:
+            errors = process.stderr.decode(errors="replace").strip().splitlines()
+            raise ToolError(
+                errors[-1] if errors else "exit status {0}".format(process.returncode)
+            )
+        return process.stdout
+
+    def get_font_directories(self):
+        directories = [FONT_DIRECTORY]
+        directories.extend(self.registryValue("fontDirectories"))
+        directories.append(os.path.join(self.get_data_directory(), "fonts"))
+        return directories
+
+    def get_font(self, type, *names):
+        """
+        Returns the first figlet or tdf font found among names, or None.
+        """
+        self.font_cache.size = self.registryValue("fontCacheSize")
+        directories = self.get_font_directories()
+        for name in names:
+            try:
+                font = self.font_cache.get(directories, type, name)
+            except (OSError, ValueError) as e:
+                log.debug("TextArt: error loading font {0}: {1}".format(name, e))
+                continue
+            if font:
+                return font
+
+    def get_fortunes(self, f):
+        """
+        Returns the byte ranges of the fortunes in the open fortune file f,
+        which is only searched again when it changes.
+        """
+        mtime = os.fstat(f.fileno()).st_mtime
+        if self.fortunes is None or self.fortunes[0] != mtime:
+            data = f.read()
+            starts = [0] + [m.end() for m in re.finditer(b"%\n", data)]
+            stops = [m.start() for m in re.finditer(b"%\n", data)] + [len(data)]
+            self.fortunes = (mtime, list(zip(starts, stops)))
+        return self.fortunes[1]
+
+    def get_max_bytes(self, irc, channel):
+        """
+        Returns how many bytes of text fit in a message to channel once the
+        server relays it with our hostmask.
+        """
+        prefix = ":{0} PRIVMSG {1} :\r\n".format(irc.prefix, channel)
+        return 512 - len(prefix.encode())
 
     def doPrivmsg(self, irc, msg):
         channel = msg.args[0]
         if not irc.isChannel(channel):
             channel = msg.nick
-        self.stopped.setdefault(channel, None)
         if msg.args[1].lower().strip()[1:] == "cq":
-            self.stopped[channel] = True
+            self.scroller.stop(channel)
 
     def doPaste(self, description, paste):
         try:
@@ -114,314 +268,21 @@ class TextArt(callbacks.Plugin):
                 " https://paste.ee/account/api"
             )
 
-    def renderImage(self, text, size=18, defaultBg=1, defaultFg=0):
-        try:
-            if utf8 and not isinstance(text, unicode):
-                text = text.decode("utf-8")
-        except:
-            pass
-        text = text.replace("\t", " ")
-        self.strip_colors_regex = re.compile(
-            "(\x03([0-9]{1,2})(,[0-9]{1,2})?)|[\x0f\x02\x1f\x03\x16]"
-        ).sub
-        path = os.path.dirname(os.path.abspath(__file__))
-        defaultFont = "{0}/DejaVu.ttf".format(path)
-
-        def strip_colors(string):
-            return self.strip_colors_regex("", string)
-
-        _colorRegex = re.compile("(([0-9]{1,2})(,([0-9]{1,2}))?)")
-        IGNORE_CHRS = ("\x16", "\x1f", "\x02", "\x03", "\x0f")
-        lineLens = [len(line) for line in strip_colors(text).splitlines()]
-        maxWidth, height = max(lineLens), len(lineLens)
-        font = ImageFont.truetype(defaultFont, size)
-        fontX = 10
-        fontY = 20
-        imageX, imageY = maxWidth * fontX, height * fontY
-        image = Image.new("RGB", (imageX, imageY), rgbColors[defaultBg])
-        draw = ImageDraw.Draw(image)
-        dtext, drect, match, x, y, fg, bg = (
-            draw.text,
-            draw.rectangle,
-            _colorRegex.match,
-            0,
-            0,
-            defaultFg,
-            defaultBg,
-        )
-        for text in text.split("\n"):
-            ll, i = len(text), 0
-            while i < ll:
-                chr = text[i]
-                if chr == "\x03":
-                    m = match(text[i + 1 : i + 6])
-                    if m:
-                        i += len(m.group(1))
-                        fg = int(m.group(2))
-                        if m.group(4) is not None:
-                            bg = int(m.group(4))
-                    else:
-                        bg, fg = defaultBg, defaultFg
-                elif chr == "\x0f":
-                    fg, bg = defaultFg, defaultBg
-                elif chr not in IGNORE_CHRS:
-                    if bg != defaultBg:  # bg is not white, render it
-                        drect((x, y, x + fontX, y + fontY), fill=rgbColors[bg])
-                    if bg != fg:  # text will show, render it. this saves a lot of time!
-                        dtext((x, y), chr, font=font, fill=rgbColors[fg])
-                    x += fontX
-                i += 1
-            y += fontY
-            fg, bg, x = defaultFg, defaultBg, 0
-        return image
-
-    def getColor(self, pixel, speed):
-        pixel = tuple(pixel)
-        try:
-            return self.matches[pixel]
-        except KeyError:
-            if self.colors == 16:
-                colors = list(colors16.keys())
-            elif self.colors == 99:
-                colors = list(colors99.keys())
-            else:
-                colors = list(colors83.keys())
-            closest_colors = sorted(
-                colors,
-                key=lambda color: self.distance(color, self.rgb2lab(pixel), speed),
-            )
-            closest_color = closest_colors[0]
-            if self.colors == 16:
-                self.matches[pixel] = colors16[closest_color]
-            elif self.colors == 99:
-                self.matches[pixel] = colors99[closest_color]
-            else:
-                self.matches[pixel] = colors83[closest_color]
-            self.source_colors += 1
-            return self.matches[pixel]
-
-    def rgb2lab(self, inputColor):
-        try:
-            return self.labmatches[inputColor]
-        except:
-            num = 0
-            RGB = [0, 0, 0]
-            for value in inputColor:
-                value = float(value) / 255
-                if value > 0.04045:
-                    value = ((value + 0.055) / 1.055) ** 2.4
-                else:
-                    value = value / 12.92
-                RGB[num] = value * 100
-                num = num + 1
-            XYZ = [
-                0,
-                0,
-                0,
-            ]
-            X = RGB[0] * 0.4124 + RGB[1] * 0.3576 + RGB[2] * 0.1805
-            Y = RGB[0] * 0.2126 + RGB[1] * 0.7152 + RGB[2] * 0.0722
-            Z = RGB[0] * 0.0193 + RGB[1] * 0.1192 + RGB[2] * 0.9505
-            XYZ[0] = round(X, 4)
-            XYZ[1] = round(Y, 4)
-            XYZ[2] = round(Z, 4)
-            XYZ[0] = (
-                float(XYZ[0]) / 95.047
-            )  # ref_X =  95.047   Observer= 2°, Illuminant= D65
-            XYZ[1] = float(XYZ[1]) / 100.0  # ref_Y = 100.000
-            XYZ[2] = float(XYZ[2]) / 108.883  # ref_Z = 108.883
-            num = 0
-            for value in XYZ:
-                if value > 0.008856:
-                    value = value ** (0.3333333333333333)
-                else:
-                    value = (7.787 * value) + (16 / 116)
-                XYZ[num] = value
-                num = num + 1
-            Lab = [0, 0, 0]
-            L = (116 * XYZ[1]) - 16
-            a = 500 * (XYZ[0] - XYZ[1])
-            b = 200 * (XYZ[1] - XYZ[2])
-            Lab[0] = round(L, 4)
-            Lab[1] = round(a, 4)
-            Lab[2] = round(b, 4)
-            self.labmatches[inputColor] = Lab
-            return self.labmatches[inputColor]
-
-    def ciede2000(self, lab1, lab2):
-        """ CIEDE2000 color difference formula. https://peteroupc.github.io/colorgen.html"""
-        dl = lab2[0] - lab1[0]
-        hl = lab1[0] + dl * 0.5
-        sqb1 = lab1[2] * lab1[2]
-        sqb2 = lab2[2] * lab2[2]
-        c1 = math.sqrt(lab1[1] * lab1[1] + sqb1)
-        c2 = math.sqrt(lab2[1] * lab2[1] + sqb2)
-        hc7 = math.pow((c1 + c2) * 0.5, 7)
-        trc = math.sqrt(hc7 / (hc7 + 6103515625))
-        t2 = 1.5 - trc * 0.5
-        ap1 = lab1[1] * t2
-        ap2 = lab2[1] * t2
-        c1 = math.sqrt(ap1 * ap1 + sqb1)
-        c2 = math.sqrt(ap2 * ap2 + sqb2)
-        dc = c2 - c1
-        hc = c1 + dc * 0.5
-        hc7 = math.pow(hc, 7)
-        trc = math.sqrt(hc7 / (hc7 + 6103515625))
-        h1 = math.atan2(lab1[2], ap1)
-        if h1 < 0:
-            h1 = h1 + math.pi * 2
-        h2 = math.atan2(lab2[2], ap2)
-        if h2 < 0:
-            h2 = h2 + math.pi * 2
-        hdiff = h2 - h1
-        hh = h1 + h2
-        if abs(hdiff) > math.pi:
-            hh = hh + math.pi * 2
-            if h2 <= h1:
-                hdiff = hdiff + math.pi * 2
-            else:
-                hdiff = hdiff - math.pi * 2
-        hh = hh * 0.5
-        t2 = 1 - 0.17 * math.cos(hh - math.pi / 6) + 0.24 * math.cos(hh * 2)
-        t2 = t2 + 0.32 * math.cos(hh * 3 + math.pi / 30)
-        t2 = t2 - 0.2 * math.cos(hh * 4 - math.pi * 63 / 180)
-        dh = 2 * math.sqrt(c1 * c2) * math.sin(hdiff * 0.5)
-        sqhl = (hl - 50) * (hl - 50)
-        fl = dl / (1 + (0.015 * sqhl / math.sqrt(20 + sqhl)))
-        fc = dc / (hc * 0.045 + 1)
-        fh = dh / (t2 * hc * 0.015 + 1)
-        dt = 30 * math.exp(
-            -math.pow(36 * hh - 55 * math.pi, 2) / (25 * math.pi * math.pi)
-        )
-        r = -2 * trc * math.sin(2 * dt * math.pi / 180)
-        de =  math.sqrt(fl * fl + fc * fc + fh * fh + r * fc * fh)
-        dep = 1.43 * de ** 0.70
-        return dep
-
-    def distance(self, c1, c2, speed):
-        if speed == "fast":
-            delta_e = math.sqrt(
-                (c1[0] - c2[0]) ** 2 + (c1[1] - c2[1]) ** 2 + (c1[2] - c2[2]) ** 2
-            )
-        elif speed == "slow":
-            delta_e = self.ciede2000(c1, c2)
-        return delta_e
-
-    def process_ansi(self, ansi):
-        if self.colors == 16:
-            colors = ansi16
-        elif self.colors == 99:
-            colors = ansi99
-        else:
-            colors = ansi83
-        x16color1 = None
-        x16color2 = None
-        x256color1 = None
-        x256color2 = None
-        effect = None
-        ansi = ansi.lower().strip("\x1b[").strip("m").split(";")
-        if len(ansi) > 1:
-            i = 0
-            while i < len(ansi):
-                if i >= len(ansi):
-                    break
-                elif ansi[i] == "0":
-                    effect = 0
-                    i += 1
-                    continue
-                elif ansi[i] == "1":
-                    effect = 1
-                    i += 1
-                    continue
-                elif ansi[i] == "4":
-                    effect = 4
-                    i += 1
-                    continue
-                elif ansi[i] == "2":
-                    effect = 2
-                    i += 1
-                    continue
-                elif int(ansi[i]) > 29 and int(ansi[i]) < 38:
-                    if effect == 1 or ansi[-1] == "1":
-                        x16color1 = x16colors["{0};1".format(ansi[i])]
-                        effect = None
-                        i += 1
-                        continue
-                    else:
-                        x16color1 = x16colors[ansi[i]]
-                        i += 1
-                        continue
-                elif int(ansi[i]) > 39 and int(ansi[i]) < 48:
-                    if effect == 1 or ansi[-1] == "1":
-                        x16color2 = x16colors["{0};1".format(ansi[i])]
-                        effect = None
-                        i += 1
-                        continue
-                    else:
-                        x16color2 = x16colors[ansi[i]]
-                        i += 1
-                        continue
-                elif ansi[i] == "38":
-                    x256color1 = colors[int(ansi[i + 2])]
-                    i += 3
-                    continue
-                elif ansi[i] == "48":
-                    x256color2 = colors[int(ansi[i + 2])]
-                    i += 3
-                    continue
-                else:
-                    i += 1
-                    continue
-            if x16color1 and x16color2:
-                color = "\x03{0},{1}".format(x16color1, x16color2)
-            elif x256color1 and x256color2:
-                color = "\x03{0},{1}".format(x256color1, x256color2)
-            elif x16color1:
-                color = "\x03{0}".format(x16color1)
-            elif x16color2:
-                color = "\x0399,{0}".format(x16color2)
-            elif x256color1:
-                color = "\x03{0}".format(x256color1)
-            elif x256color2:
-                color = "\x0399,{0}".format(x256color2)
-            else:
-                color = ""
-            if effect == 1:
-                color += "\x02"
-            if effect == 4:
-                color += "\x1F"
-        elif len(ansi[0]) > 0:
-            if ansi[0] == "0":
-                color = "\x0F"
-            elif ansi[0] == "1" or ansi[0] == "2":
-                color = "\x02"
-            elif ansi[0] == "4":
-                color = "\x1F"
-            elif int(ansi[0]) > 29 and int(ansi[0]) < 38:
-                color = "\x03{0}".format(x16colors[ansi[0]])
-            elif int(ansi[0]) > 39 and int(ansi[0]) < 48:
-                color = "\x0399,{0}".format(x16colors[ansi[0]])
-            elif ansi[0][-1] == "c":
-                color = " " * int(ansi[0][:-1])
-            else:
-                color = ""
-        else:
-            color = ""
-        if color != self.old_color:
-            self.old_color = color
-            return color
-        else:
-            return ""
-
-    def ansi2irc(self, output):
-        output = output.replace("\x1b(B\x1b[m", "\x1b[0m")
-        output = output.replace("\x1b\x1b", "\x1b")
-        output = re.sub(
-            "\x1B\[[0-?]*[ -/]*[@-~]", lambda m: self.process_ansi(m.group(0)), output
+    def upload_image(self, data, title):
+        """
+        Uploads PNG data to Imgur and returns its link.
+        """
+        client_id = self.registryValue("imgurAPI")
+        headers = {"Authorization": "Client-ID {0}".format(client_id)}
+        response = requests.post(
+            self.upload_url,
+            headers=headers,
+            data={"type": "file", "title": title},
+            files={"image": ("tldr.png", data, "image/png")},
+            timeout=self.registryValue("uploadTimeout") or None,
         )
-        output = re.sub("\x0399,(\d\d)\x03(\d\d)", "\x03\g<2>,\g<1>", output)
-        output = output.replace("\x0F\x03", "\x03")
-        return output
+        response.raise_for_status()
+        return response.json()["data"]["link"]
 
     def png(self, irc, msg, args, optlist, url):
         """[--bg] [--fg] <url>
@@ -438,54 +299,53 @@ class TextArt(callbacks.Plugin):
             fg = 0
         if url.startswith("https://paste.ee/p/"):
             url = re.sub("https://paste.ee/p/", "https://paste.ee/r/", url)
-        ua = random.choice(self.agents)
-        header = {"User-Agent": ua}
-        try:
-            r = requests.get(url, stream=True, headers=header, timeout=10)
-            r.raise_for_status()
-        except (
-            requests.exceptions.RequestException,
-            requests.exceptions.HTTPError,
-        ) as e:
-            log.debug("TextArt: error retrieving data for png: {0}".format(e))
-            return
-        if "text/plain" in r.headers["content-type"] or url.startswith(
-            "https://paste.ee/r/"
-        ):
-            try:
-                file = r.content.decode()
-            except:
-                file = r.content.decode("cp437")
-        else:
-            irc.reply("Invalid file type.", private=False, notice=False)
+        content = self.fetch(
+            irc,
+            "png",
+            url,
+            lambda type: "text/plain" in type or url.startswith("https://paste.ee/r/"),
+            self.registryValue("maxFileSize"),
+        )
+        if content is None:
             return
+        try:
+            file = content.decode()
+        except UnicodeDecodeError:
+            file = content.decode("cp437")
         file = re.sub("(\x03(\d+).*)\x03,", "\g<1>\x03\g<2>,", file).replace(
             "\r\n", "\n"
         )
-        im = self.renderImage(file, 18, bg, fg)
-        path = os.path.dirname(os.path.abspath(__file__))
-        filepath = "{0}/tmp/tldr.png".format(path)
-        im.save(filepath, "PNG")
-        CLIENT_ID = self.registryValue("imgurAPI")
-        imgur = pyimgur.Imgur(CLIENT_ID)
-        uploaded_image = imgur.upload_image(filepath, title=url)
-        irc.reply(uploaded_image.link, noLengthCheck=True, private=False, notice=False)
+        try:
+            data = self.convert(irc2png, file, 18, bg, fg)
+        except ValueError as e:
+            irc.reply("Error: {0}.".format(e))
+            return
+        except MemoryError:
+            irc.reply("Error: not enough memory to render the file.")
+            return
+        except WorkerError as e:
+            irc.reply("Error: conversion failed, {0}.".format(e))
+            return
+        try:
+            link = self.upload_image(data, url)
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            log.debug("TextArt: error uploading png: {0}".format(e))
+            irc.reply(
+                "Error. Did you set a valid Imgur API Client ID?",
+                private=False,
+                notice=False,
+            )
+            return
+        irc.reply(link, noLengthCheck=True, private=False, notice=False)
 
     png = wrap(png, [getopts({"bg": "int", "fg": "int"}), "text"])
 
-    async def reply(self, irc, output, channel, delay):
-        self.stopped.setdefault(channel, None)
-        for line in output:
-            if self.stopped[channel]:
-                return
-            if not line.strip():
-                line = "\xa0"
-            irc.sendMsg(ircmsgs.privmsg(channel, line))
-            await asyncio.sleep(delay)
+    def reply(self, irc, output, channel, delay, then=None):
+        self.scroller.add(irc, channel, output, delay, then)
 
     def artii(self, irc, msg, args, channel, optlist, text):
         """[<channel>] [--font <font>] [--color <color1,color2>] [<text>]
-        Text to ASCII figlet fonts using the artii API
+        Text to ASCII figlet fonts. Split words with | to render them one by one
         """
         if not channel:
             channel = msg.args[0]
@@ -501,16 +361,10 @@ class TextArt(callbacks.Plugin):
         elif len(text.split("|")) > self.registryValue("maxWords", msg.channel):
             return
         optlist = dict(optlist)
-        font = None
-        words = []
         if "delay" in optlist and ircdb.checkCapability(msg.prefix, "admin"):
             delay = optlist.get("delay")
         else:
             delay = self.registryValue("delay", msg.args[0])
-        if text:
-            text = text.strip()
-            if "|" in text:
-                words = text.split("|")
         if "color" in optlist:
             color = optlist.get("color")
             if "," in color:
@@ -524,98 +378,19 @@ class TextArt(callbacks.Plugin):
             color1 = None
             color2 = None
         if "font" in optlist:
-            font = optlist.get("font")
-            if words:
-                for word in words:
-                    if word.strip():
-                        try:
-                            data = requests.get(
-                                "https://artii.herokuapp.com/make?text={0}&font={1}"
-                                .format(word.strip(), font),
-                                timeout=10,
-                            )
-                            data.raise_for_status()
-                        except (
-                            requests.exceptions.RequestException,
-                            requests.exceptions.HTTPError,
-                        ) as e:
-                            log.debug(
-                                "TextArt: error retrieving data for artii: {0}".format(
-                                    e
-                                )
-                            )
-                            return
-                        output = []
-                        for line in data.content.decode().splitlines():
-                            line = ircutils.mircColor(line, color1, color2)
-                            output.append(line)
-                        asyncio.run(self.reply(irc, output, channel, delay))
-            else:
-                try:
-                    data = requests.get(
-                        "https://artii.herokuapp.com/make?text={0}&font={1}".format(
-                            text, font
-                        ),
-                        timeout=10,
-                    )
-                    data.raise_for_status()
-                except (
-                    requests.exceptions.RequestException,
-                    requests.exceptions.HTTPError,
-                ) as e:
-                    log.debug("TextArt: error retrieving data for artii: {0}".format(e))
-                    return
-                output = []
-                for line in data.content.decode().splitlines():
-                    line = ircutils.mircColor(line, color1, color2)
-                    output.append(line)
-                asyncio.run(self.reply(irc, output, channel, delay))
-        elif "font" not in optlist:
-            if words:
-                for word in words:
-                    if word.strip():
-                        try:
-                            data = requests.get(
-                                "https://artii.herokuapp.com/make?text={0}&font=univers"
-                                .format(word.strip()),
-                                timeout=10,
-                            )
-                            data.raise_for_status()
-                        except (
-                            requests.exceptions.RequestException,
-                            requests.exceptions.HTTPError,
-                        ) as e:
-                            log.debug(
-                                "TextArt: error retrieving data for artii: {0}".format(
-                                    e
-                                )
-                            )
-                            return
-                        output = []
-                        for line in data.content.decode().splitlines():
-                            line = ircutils.mircColor(line, color1, color2)
-                            output.append(line)
-                        asyncio.run(self.reply(irc, output, channel, delay))
-            else:
-                try:
-                    data = requests.get(
-                        "https://artii.herokuapp.com/make?text={0}&font=univers".format(
-                            text
-                        ),
-                        timeout=10,
-                    )
-                    data.raise_for_status()
-                except (
-                    requests.exceptions.RequestException,
-                    requests.exceptions.HTTPError,
-                ) as e:
-                    log.debug("TextArt: error retrieving data for artii: {0}".format(e))
-                    return
+            font = self.get_font("figlet", optlist.get("font"))
+        else:
+            font = self.get_font("figlet", "univers", "standard")
+        if not font:
+            irc.reply("Error: font not found. See fontlist.")
+            return
+        for word in text.strip().split("|"):
+            if word.strip():
                 output = []
-                for line in data.content.decode().splitlines():
+                for line in font.render(word.strip()):
                     line = ircutils.mircColor(line, color1, color2)
                     output.append(line)
-                asyncio.run(self.reply(irc, output, channel, delay))
+                self.reply(irc, output, channel, delay)
 
     artii = wrap(
         artii,
@@ -628,21 +403,13 @@ class TextArt(callbacks.Plugin):
 
     def fontlist(self, irc, msg, args):
         """
-        Get list of artii figlet fonts.
+        Get list of figlet fonts.
         """
-        try:
-            fontlist = requests.get(
-                "https://artii.herokuapp.com/fonts_list", timeout=10
-            )
-            fontlist.raise_for_status()
-        except (
-            requests.exceptions.RequestException,
-            requests.exceptions.HTTPError,
-        ) as e:
-            log.debug("textArt: error retrieving data for fontlist: {0}".format(e))
+        fonts = self.font_cache.list(self.get_font_directories(), "figlet")
+        if not fonts:
+            irc.reply("Error: no figlet fonts found. See config fontDirectories.")
             return
-        response = sorted(fontlist.content.decode().split("\n"))
-        irc.reply(str(response).replace("'", "").replace("[", "").replace("]", ""))
+        irc.reply(", ".join(fonts))
 
     fontlist = wrap(fontlist)
 
@@ -674,13 +441,13 @@ class TextArt(callbacks.Plugin):
         optlist = dict(optlist)
         gscale = "\xa0"
         if "16" in optlist:
-            self.colors = 16
+            colors = 16
         elif "83" in optlist:
-            self.colors = 83
+            colors = 83
         elif "99" in optlist:
-            self.colors = 99
+            colors = 99
         else:
-            self.colors = self.registryValue("colors", msg.args[0])
+            colors = self.registryValue("colors", msg.args[0])
         if "fast" in optlist:
             speed = "fast"
         elif "slow" in optlist:
@@ -746,318 +513,80 @@ class TextArt(callbacks.Plugin):
             cols = self.registryValue("asciiWidth", msg.args[0])
         else:
             cols = self.registryValue("blockWidth", msg.args[0])
-        if "s" in optlist:
-            s = float(optlist.get("s"))
-        ua = random.choice(self.agents)
-        header = {"User-Agent": ua}
         image_formats = ("image/png", "image/jpeg", "image/jpg", "image/gif")
-        try:
-            r = requests.get(url, stream=True, headers=header, timeout=10)
-            r.raise_for_status()
-        except (
-            requests.exceptions.RequestException,
-            requests.exceptions.HTTPError,
-        ) as e:
-            log.debug("TextArt: error retrieving data for img: {0}".format(e))
-            return
-        if r.headers["content-type"] in image_formats and r.status_code == 200:
-            r.raw.decode_content = True
-            image = Image.open(r.raw)
-        else:
-            irc.reply("Error: Invalid file type.", private=False, notice=False)
+        data = self.fetch(
+            irc,
+            "img",
+            url,
+            lambda type: type in image_formats,
+            self.registryValue("maxImageSize"),
+        )
+        if data is None:
             return
-        # open image and convert to grayscale
-        start_time = time.time()
-        self.source_colors = 0
-        if image.mode == "RGBA":
-            if bg == 99:
-                newbg = 1
-            else:
-                newbg = bg
-            image = Image.alpha_composite(
-                Image.new("RGBA", image.size, rgbColors[newbg] + (255,)), image
-            )
-        if image.mode != "RGB":
-            image = image.convert("RGB")
-        try:
-            os.remove(filename)
-        except:
-            pass
-        # store dimensions
-        W, H = image.size[0], image.size[1]
-        # compute width of tile
-        w = W / cols
-        # compute tile height based on aspect ratio and scale
-        if type == "1/2":
-            scale = 1.0
-        else:
-            scale = 0.5
-        h = w / scale
-        # compute number of rows
-        rows = int(H / h)
         if "resize" in optlist:
             resize = optlist.get("resize")
         else:
             resize = self.registryValue("resize", msg.args[0])
-        if type != "no-color":
-            image2 = image.resize((cols, rows), resize)
-            if "s" in optlist:
-                image2 = ImageEnhance.Color(image2).enhance(s)
-            if quantize:
-                image2 = image2.quantize(dither=None)
-                image2 = image2.convert("RGB")
-            colormap = np.array(image2)
-            self.labmatches = {}
-            if not self.registryValue("cacheColors"):
-                self.matches = {}
-        # ascii image is a list of character strings
-        aimg = []
-        if type == "1/2":
-            k = 0
-            for j in range(0, rows - 1, 2):
-                # append an empty string
-                aimg.append("")
-                old_color1 = "99"
-                old_color2 = "99"
-                old_char = None
-                for i in range(cols):
-                    color1 = "%02d" % self.getColor(colormap[j][i].tolist(), speed)
-                    color2 = "%02d" % self.getColor(colormap[j + 1][i].tolist(), speed)
-                    if color1 == color2:
-                        gsval = " "
-                    else:
-                        gsval = "▀"
-                    if color1 == old_color1 and color2 == old_color2:
-                        aimg[k] += gsval
-                        old_char = gsval
-                    elif gsval == " " and color1 == old_color2:
-                        aimg[k] += " "
-                        old_char = gsval
-                    elif gsval == " " and color1 == old_color1 and old_char == "█":
-                        aimg[k] = aimg[k][:-1]
-                        aimg[k] += "\x0301,{0}  ".format(color1)
-                        old_color1 = "01"
-                        old_color2 = color1
-                        old_char = gsval
-                    elif gsval == " " and color1 == old_color1 and old_char == "^█":
-                        aimg[k] = aimg[k][:-4]
-                        aimg[k] += "\x0301,{0}  ".format(color1)
-                        old_color1 = "01"
-                        old_color2 = color1
-                        old_char = gsval
-                    elif (
-                        gsval == " "
-                        and color1 == old_color1
-                        and old_char == "^^▀"
-                        and "tops" not in optlist
-                    ):
-                        aimg[k] = aimg[k][:-7]
-                        aimg[k] += "\x03{0},{1}▄ ".format(old_color2, color1)
-                        old_color1 = old_color2
-                        old_color2 = color1
-                        old_char = gsval
-                    elif (
-                        gsval == " "
-                        and color1 == old_color1
-                        and old_char != "█"
-                        and "tops" not in optlist
-                    ):
-                        aimg[k] += "█"
-                        old_char = "█"
-                    elif gsval == " " and "tops" not in optlist:
-                        aimg[k] += "\x03{0}█".format(color1)
-                        old_color1 = color1
-                        old_char = "^█"
-                    elif (
-                        gsval != " "
-                        and color1 == old_color1
-                        and old_char == "^█"
-                        and "tops" not in optlist
-                    ):
-                        aimg[k] = aimg[k][:-4]
-                        aimg[k] += "\x03{0},{1} ▄".format(color2, color1)
-                        old_color1 = color2
-                        old_color2 = color1
-                        old_char = "▄"
-                    elif gsval != " " and color2 == old_color1 and old_char == "^█":
-                        aimg[k] = aimg[k][:-4]
-                        aimg[k] += "\x03{0},{1} ▀".format(color1, color2)
-                        old_color1 = color1
-                        old_color2 = color2
-                        old_char = gsval
-                    elif (
-                        gsval != " "
-                        and color1 == old_color2
-                        and color2 == old_color1
-                        and old_char == "^^▀"
-                        and "tops" not in optlist
-                    ):
-                        aimg[k] = aimg[k][:-7]
-                        aimg[k] += "\x03{0},{1}▄▀".format(color1, color2)
-                        old_color1 = color1
-                        old_color2 = color2
-                        old_char = gsval
-                    elif (
-                        gsval != " "
-                        and color1 == old_color1
-                        and color2 != old_color2
-                        and old_char == "^^▀"
-                        and "tops" not in optlist
-                    ):
-                        aimg[k] = aimg[k][:-7]
-                        aimg[k] += "\x03{0},{1}▄\x03{2}▄".format(
-                            old_color2, color1, color2
-                        )
-                        old_color1 = color2
-                        old_color2 = color1
-                        old_char = "▄"
-                    elif (
-                        gsval != " "
-                        and color1 == old_color1
-                        and color2 != old_color2
-                        and old_char == "^▀"
-                        and "tops" not in optlist
-                    ):
-                        aimg[k] = aimg[k][:-4]
-                        aimg[k] += "\x03{0},{1}▄\x03{2}▄".format(
-                            old_color2, color1, color2
-                        )
-                        old_color1 = color2
-                        old_color2 = color1
-                        old_char = "▄"
-                    elif (
-                        gsval != " "
-                        and color1 == old_color2
-                        and color2 == old_color1
-                        and "tops" not in optlist
-                    ):
-                        aimg[k] += "▄"
-                        old_char = "▄"
-                    elif (
-                        gsval != " " and color1 == old_color2 and "tops" not in optlist
-                    ):
-                        aimg[k] += "\x03{0}▄".format(color2)
-                        old_color1 = color2
-                        old_char = "▄"
-                    elif color1 != old_color1 and color2 == old_color2:
-                        aimg[k] += "\x03{0}{1}".format(color1, gsval)
-                        old_color1 = color1
-                        if gsval == " ":
-                            old_char = gsval
-                        else:
-                            old_char = "^▀"
-                    else:
-                        aimg[k] += "\x03{0},{1}{2}".format(color1, color2, gsval)
-                        old_color1 = color1
-                        old_color2 = color2
-                        if gsval == " ":
-                            old_char = gsval
-                        else:
-                            old_char = "^^▀"
-                if "tops" in optlist:
-                    aimg[k] = re.sub("\x03\d\d,(\d\d\s+\x03)", "\x0301,\g<1>", aimg[k])
-                    aimg[k] = re.sub("\x03\d\d,(\d\d\s+$)", "\x0301,\g<1>", aimg[k])
-                    aimg[k] = re.sub("\x03\d\d,(\d\d\s\x03)", "\x0301,\g<1>", aimg[k])
-                aimg[k] = re.sub(
-                    "\x0301,(\d\d)(\s+)\x03(\d\d)([^,])",
-                    "\x03\g<3>,\g<1>\g<2>\g<4>",
-                    aimg[k],
-                )
-                for i in range(0, 98):
-                    i = "%02d" % i
-                    aimg[k] = aimg[k].replace("{0}".format(i), "{0}".format(int(i)))
-                k += 1
-        else:
-            if "chars" not in optlist and gscale != "\xa0":
-                image = image.resize((cols, rows), resize)
-                image = image.convert("L")
-                lumamap = np.array(image)
-            # generate list of dimensions
-            char = 0
-            for j in range(rows):
-                # append an empty string
-                aimg.append("")
-                old_color = None
-                for i in range(cols):
-                    if "chars" not in optlist and gscale != "\xa0":
-                        # get average luminance
-                        avg = int(np.average(lumamap[j][i]))
-                        # look up ascii char
-                        gsval = gscale[int((avg * (len(gscale) - 1)) / 255)]
-                    elif "chars" in optlist and gscale != "\xa0":
-                        if char < len(gscale):
-                            gsval = gscale[char]
-                            char += 1
-                        else:
-                            char = 0
-                            gsval = gscale[char]
-                            char += 1
-                    else:
-                        gsval = "\xa0"
-                    # get color value
-                    if type != "no-color" and gscale != "\xa0" and i == 0:
-                        color = self.getColor(colormap[j][i].tolist(), speed)
-                        old_color = color
-                        if bg != 99:
-                            color = "{0},{1}".format(color, "{:02d}".format(int(bg)))
-                        if gsval != "\xa0":
-                            aimg[j] += "\x03{0}{1}".format(color, gsval)
-                        else:
-                            aimg[j] += "\x030,{0} ".format(int(color))
-                    elif type == "no-color" and i == 0:
-                        if bg != 99 and fg != 99:
-                            aimg[j] += "\x03{0},{1}{2}".format(
-                                "{:02d}".format(int(fg)),
-                                "{:02d}".format(int(bg)),
-                                gsval,
-                            )
-                        elif fg != 99:
-                            aimg[j] += "\x03{0}{1}".format(
-                                "{:02d}".format(int(fg)), gsval
-                            )
-                        elif bg != 99:
-                            aimg[j] += "\x03{0},{1}{2}".format(
-                                "{:02d}".format(int(fg)),
-                                "{:02d}".format(int(bg)),
-                                gsval,
-                            )
-                    elif type != "no-color" and gsval != " ":
-                        color = self.getColor(colormap[j][i].tolist(), speed)
-                        if color != old_color:
-                            old_color = color
-                            # append ascii char to string
-                            if gsval != "\xa0":
-                                if gsval.isdigit():
-                                    color = "{:02d}".format(int(color))
-                                    aimg[j] += "\x03{0}{1}".format(color, gsval)
-                                else:
-                                    aimg[j] += "\x03{0}{1}".format(int(color), gsval)
-                            else:
-                                aimg[j] += "\x030,{0} ".format(int(color))
-                        else:
-                            aimg[j] += "{0}".format(gsval)
-                    else:
-                        aimg[j] += "{0}".format(gsval)
-        output = aimg
-        self.stopped[channel] = False
-        end_time = time.time()
-        asyncio.run(self.reply(irc, output, channel, delay))
-        if self.registryValue("pasteEnable", msg.args[0]):
-            paste = ""
-            for line in output:
-                if not line.strip():
-                    line = "\xa0"
-                paste += line + "\n"
-        if self.registryValue("showStats", msg.args[0]):
-            longest = len(max(output, key=len).encode("utf-8"))
-            render_time = "{0:.2f}".format(end_time - start_time)
-            irc.reply(
-                "[Source Colors: {0}, Render Time: {1} seconds, Longest Line: {2}"
-                " bytes]".format(self.source_colors, render_time, longest),
-                prefixNick=False,
+        bits = self.registryValue("colorTableBits")
+        if bits:
+            get_palette(colors).start_build(speed, bits, self.get_data_directory())
+        start_time = time.time()
+        try:
+            output, source_colors = self.convert(
+                image2irc,
+                data,
+                type,
+                gscale,
+                cols,
+                colors=colors,
+                speed=speed,
+                quantize=quantize,
+                bg=bg,
+                fg=fg,
+                saturation=float(optlist["s"]) if "s" in optlist else None,
+                resize=resize,
+                chars="chars" in optlist,
+                tops="tops" in optlist,
+                cache=self.registryValue("cacheColors"),
+                bits=bits,
+                directory=self.get_data_directory(),
+                max_bytes=self.get_max_bytes(irc, channel),
             )
-        if self.registryValue("pasteEnable", msg.args[0]):
-            irc.reply(self.doPaste(url, paste), private=False, notice=False, to=channel)
+        except UnidentifiedImageError:
+            irc.reply("Error: unrecognized image format.")
+            return
+        except Image.DecompressionBombError:
+            irc.reply("Error: image is too large.")
+            return
+        except MemoryError:
+            irc.reply("Error: not enough memory to convert the image.")
+            return
+        except WorkerError as e:
+            irc.reply("Error: conversion failed, {0}.".format(e))
+            return
+        end_time = time.time()
+
+        def then():
+            if self.registryValue("pasteEnable", msg.args[0]):
+                paste = ""
+                for line in output:
+                    if not line.strip():
+                        line = "\xa0"
+                    paste += line + "\n"
+            if self.registryValue("showStats", msg.args[0]):
+                longest = len(max(output, key=len).encode("utf-8"))
+                render_time = "{0:.2f}".format(end_time - start_time)
+                irc.reply(
+                    "[Source Colors: {0}, Render Time: {1} seconds, Longest Line: {2}"
+                    " bytes]".format(source_colors, render_time, longest),
+                    prefixNick=False,
+                )
+            if self.registryValue("pasteEnable", msg.args[0]):
+                irc.reply(
+                    self.doPaste(url, paste), private=False, notice=False, to=channel
+                )
+
+        self.reply(irc, output, channel, delay, then)
 
     img = wrap(
         img,
@@ -1104,7 +633,6 @@ class TextArt(callbacks.Plugin):
         if not irc.isChannel(channel):
             channel = msg.nick
         optlist = dict(optlist)
-        self.stopped[channel] = False
         if "delay" in optlist and ircdb.checkCapability(msg.prefix, "admin"):
             delay = optlist.get("delay")
         else:
@@ -1116,30 +644,26 @@ class TextArt(callbacks.Plugin):
         ua = random.choice(self.agents)
         header = {"User-Agent": ua}
         try:
-            r = requests.get(url, headers=header, stream=True, timeout=10)
-            r.raise_for_status()
+            download = self.download(url, header)
         except (
             requests.exceptions.RequestException,
             requests.exceptions.HTTPError,
         ) as e:
             log.debug("TextArt: error retrieving data for scroll: {0}".format(e))
             return
-        if "text/plain" in r.headers["content-type"]:
-            try:
-                file = r.content.decode().replace("\r\n", "\n")
-            except:
-                file = r.text.replace("\r\n", "\n")
-        else:
+        if "text/plain" not in download.content_type:
+            download.close()
             irc.reply("Invalid file type.", private=False, notice=False)
             return
-        output = file.splitlines()
-        asyncio.run(self.reply(irc, output, channel, delay))
+        output = download.lines(self.registryValue("maxLines", channel))
+        self.reply(irc, output, channel, delay)
 
     scroll = wrap(scroll, [optional("channel"), getopts({"delay": "float"}), "text"])
 
     def a2m(self, irc, msg, args, channel, optlist, url):
         """[<channel>] [--delay] [--l] [--r] [--n] [--p] [--t] [--w] <url>
-        Convert ANSI files to IRC formatted text. https://github.com/tat3r/a2m
+        Convert ANSI files to IRC formatted text. --l, --r, --n, --p and --t
+        use https://github.com/tat3r/a2m
         """
         if not channel:
             channel = msg.args[0]
@@ -1173,60 +697,60 @@ class TextArt(callbacks.Plugin):
             delay = optlist.get("delay")
         else:
             delay = self.registryValue("delay", msg.args[0])
-        ua = random.choice(self.agents)
-        header = {"User-Agent": ua}
-        try:
-            r = requests.get(url, stream=True, headers=header, timeout=10)
-            r.raise_for_status()
-        except (
-            requests.exceptions.RequestException,
-            requests.exceptions.HTTPError,
-        ) as e:
-            log.debug("TextArt: error retrieving data for a2m: {0}".format(e))
+        content = self.fetch(
+            irc,
+            "a2m",
+            url,
+            lambda type: "text/plain" in type or "application/octet-stream" in type,
+            self.registryValue("maxFileSize"),
+        )
+        if content is None:
             return
-        try:
-            if (
-                "text/plain" in r.headers["content-type"]
-                or "application/octet-stream" in r.headers["content-type"]
-                and int(r.headers["content-length"]) < 1000000
-            ):
-                path = os.path.dirname(os.path.abspath(__file__))
-                filepath = "{0}/tmp".format(path)
-                filename = "{0}/{1}".format(filepath, url.split("/")[-1])
-                open(filename, "wb").write(r.content.replace(b";5;", b";"))
-                try:
-                    output = pexpect.run(
-                        "a2m {0} {1}".format(opts.strip(), str(filename))
-                    )
-                    try:
-                        os.remove(filename)
-                    except:
-                        pass
-                except:
-                    irc.reply(
-                        "Error. Have you installed A2M? https://github.com/tat3r/a2m",
-                        private=False,
-                        notice=False,
-                    )
-                    return
-            else:
-                irc.reply("Invalid file type.")
+        max_lines = self.registryValue("maxLines", channel)
+        if set(optlist) & {"l", "r", "n", "p", "t"}:
+            try:
+                output = self.run_tool(
+                    ["a2m"] + opts.split(), content.replace(b";5;", b";")
+                )
+            except OSError:
+                irc.reply(
+                    "Error. Have you installed A2M? https://github.com/tat3r/a2m",
+                    private=False,
+                    notice=False,
+                )
                 return
-        except:
-            irc.reply("Invalid file type.")
-            return
-        self.stopped[channel] = False
-        output = re.sub("(\x03(\d+).*)\x03,", "\g<1>\x03\g<2>,", output.decode())
+            except ToolError as e:
+                irc.reply(
+                    "Error: a2m failed, {0}.".format(e), private=False, notice=False
+                )
+                return
+            output = re.sub(
+                "(\x03(\d+).*)\x03,", "\g<1>\x03\g<2>,", output.decode(errors="replace")
+            )
+        else:
+            try:
+                output = content.decode()
+            except UnicodeDecodeError:
+                output = content.decode("cp437")
+            colors = self.registryValue("colors", msg.args[0])
+            output = ansi2irc(output, colors, optlist.get("w", 80), max_lines)
         output = output.splitlines()
-        asyncio.run(self.reply(irc, output, channel, delay))
-        if self.registryValue("pasteEnable", msg.args[0]):
-            paste = ""
-            for line in output:
-                if not line.strip():
-                    line = "\xa0"
-                paste += line + "\n"
-        if self.registryValue("pasteEnable", msg.args[0]):
-            irc.reply(self.doPaste(url, paste), private=False, notice=False, to=channel)
+        if max_lines:
+            output = output[:max_lines]
+
+        def then():
+            if self.registryValue("pasteEnable", msg.args[0]):
+                paste = ""
+                for line in output:
+                    if not line.strip():
+                        line = "\xa0"
+                    paste += line + "\n"
+            if self.registryValue("pasteEnable", msg.args[0]):
+                irc.reply(
+                    self.doPaste(url, paste), private=False, notice=False, to=channel
+                )
+
+        self.reply(irc, output, channel, delay, then)
 
     a2m = wrap(
         a2m,
@@ -1288,58 +812,50 @@ class TextArt(callbacks.Plugin):
             delay = optlist.get("delay")
         else:
             delay = self.registryValue("delay", msg.args[0])
-        path = os.path.dirname(os.path.abspath(__file__))
-        filepath = "{0}/tmp".format(path)
-        filename = "{0}/{1}".format(filepath, url.split("/")[-1])
-        ua = random.choice(self.agents)
-        header = {"User-Agent": ua}
         image_formats = ("image/png", "image/jpeg", "image/jpg", "image/gif")
+        content = self.fetch(
+            irc,
+            "p2u",
+            url,
+            lambda type: type in image_formats,
+            self.registryValue("maxImageSize"),
+        )
+        if content is None:
+            return
         try:
-            r = requests.get(url, stream=True, headers=header, timeout=10)
-            r.raise_for_status()
-        except (
-            requests.exceptions.RequestException,
-            requests.exceptions.HTTPError,
-        ) as e:
-            log.debug("TextArt: error retrieving data for p2u: {0}".format(e))
+            output = self.run_tool(
+                ["p2u", "-f", "m"] + opts.split(), content, seek=True
+            )
+        except OSError:
+            irc.reply(
+                "Error. Have you installed p2u? https://git.trollforge.org/p2u",
+                private=False,
+                notice=False,
+            )
             return
-        if r.headers["content-type"] in image_formats and r.status_code == 200:
-            with open("{0}".format(filename), "wb") as f:
-                f.write(r.content)
-            try:
-                output = pexpect.run(
-                    "p2u -f m {0} {1}".format(opts.strip(), str(filename))
-                )
-                try:
-                    os.remove(filename)
-                except:
-                    pass
-            except:
-                irc.reply(
-                    "Error. Have you installed p2u? https://git.trollforge.org/p2u",
-                    private=False,
-                    notice=False,
-                )
-                return
-        else:
-            irc.reply("Invalid file type.", private=False, notice=False)
+        except ToolError as e:
+            irc.reply("Error: p2u failed, {0}.".format(e), private=False, notice=False)
             return
-        self.stopped[channel] = False
         output = output.decode().splitlines()
         output = [re.sub("^\x03 ", " ", line) for line in output]
-        asyncio.run(self.reply(irc, output, channel, delay))
-        if self.registryValue("pasteEnable", msg.args[0]):
-            paste = ""
-            for line in output:
-                if not line.strip():
-                    line = "\xa0"
-                paste += line + "\n"
-        if self.registryValue("pasteEnable", msg.args[0]):
-            irc.reply(self.doPaste(url, paste), private=False, notice=False, to=channel)
-        else:
-            irc.reply(
-                "Unexpected file type or link format", private=False, notice=False
-            )
+
+        def then():
+            if self.registryValue("pasteEnable", msg.args[0]):
+                paste = ""
+                for line in output:
+                    if not line.strip():
+                        line = "\xa0"
+                    paste += line + "\n"
+            if self.registryValue("pasteEnable", msg.args[0]):
+                irc.reply(
+                    self.doPaste(url, paste), private=False, notice=False, to=channel
+                )
+            else:
+                irc.reply(
+                    "Unexpected file type or link format", private=False, notice=False
+                )
+
+        self.reply(irc, output, channel, delay, then)
 
     p2u = wrap(
         p2u,
@@ -1361,12 +877,12 @@ class TextArt(callbacks.Plugin):
     )
 
     def tdf(self, irc, msg, args, channel, optlist, text):
-        """[<channel>] [--f] [--j] [--w] [--e] [--r] [--i][--delay] <text>
+        """[<channel>] [--f] [--j] [--w] [--e] [--r] [--i] [--delay] <text>
         Text to TheDraw ANSI Fonts. http://www.roysac.com/thedrawfonts-tdf.html
         --f [font] Specify font file used.
         --j l|r|c  Justify left, right, or center.  Default is left.
         --w n      Set screen width.  Default is 80.
-        --c a|m    Color format ANSI or mirc.  Default is ANSI.
+        --e u      Encode as Unicode, the only encoding supported.
         --i        Print font details.
         --r        Use random font.
         """
@@ -1382,58 +898,46 @@ class TextArt(callbacks.Plugin):
         if len(text.split(" ")) > self.registryValue("maxWords", msg.channel):
             return
         optlist = dict(optlist)
-        opts = ""
-        if "f" in optlist:
-            f = optlist.get("f")
-            opts += "-f {0} ".format(f.lower())
-        else:
-            opts += "-r "
-        if "j" in optlist:
-            j = optlist.get("j")
-            opts += "-j {0} ".format(j)
-        if "w" in optlist:
-            w = optlist.get("w")
-            opts += "-w {0} ".format(w)
-        else:
-            opts += "-w 80 "
-        if "e" in optlist:
-            e = optlist.get("e")
-            opts += "-e {0} ".format(e)
-        if "r" in optlist:
-            opts += "-r "
         if "delay" in optlist and ircdb.checkCapability(msg.prefix, "admin"):
             delay = optlist.get("delay")
         else:
             delay = self.registryValue("delay", msg.args[0])
-        if "i" in optlist:
-            opts += "-i "
-        try:
-            output = pexpect.run(
-                "tdfiglet -c m {0} {1}".format(opts.strip(), r"{}".format(text))
-            )
-        except:
+        if optlist.get("e", "u").lower() not in ("u", "unicode"):
             irc.reply(
-                "Error. Have you installed tdfiglet? https://github.com/tat3r/tdfiglet",
+                "Error: only Unicode output (--e u) is supported.",
                 private=False,
                 notice=False,
             )
             return
-        self.stopped[channel] = False
-        output = output.decode().replace("\r\r\n", "\r\n")
-        output = re.sub("\x03\x03\s*", "\x0F ", output)
-        output = re.sub("\x0F\s*\x03$", "", output)
-        output = output.splitlines()
-        asyncio.run(self.reply(irc, output, channel, delay))
-        if self.registryValue("pasteEnable", msg.args[0]):
-            paste = ""
-            for line in output:
-                if not line.strip():
-                    line = "\xa0"
-                paste += line + "\n"
-        if self.registryValue("pasteEnable", msg.args[0]):
-            irc.reply(
-                self.doPaste(text, paste), private=False, notice=False, to=channel
-            )
+        if "f" in optlist and "r" not in optlist:
+            font = self.get_font("tdf", optlist.get("f"))
+        else:
+            fonts = self.font_cache.list(self.get_font_directories(), "tdf")
+            font = self.get_font("tdf", random.choice(fonts)) if fonts else None
+        if not font:
+            irc.reply("Error: font not found. See fonts.", private=False, notice=False)
+            return
+        try:
+            output = font.render(text, optlist.get("w", 80), optlist.get("j", "l"))
+        except ValueError as e:
+            irc.reply("Error: {0}".format(e), private=False, notice=False)
+            return
+        if "i" in optlist:
+            output.insert(0, font.get_info())
+
+        def then():
+            if self.registryValue("pasteEnable", msg.args[0]):
+                paste = ""
+                for line in output:
+                    if not line.strip():
+                        line = "\xa0"
+                    paste += line + "\n"
+            if self.registryValue("pasteEnable", msg.args[0]):
+                irc.reply(
+                    self.doPaste(text, paste), private=False, notice=False, to=channel
+                )
+
+        self.reply(irc, output, channel, delay, then)
 
     tdf = wrap(
         tdf,
@@ -1470,56 +974,65 @@ class TextArt(callbacks.Plugin):
         if len(text.split(" ")) > self.registryValue("maxWords", msg.channel):
             return
         optlist = dict(optlist)
-        opts = ""
         if "f" in optlist:
-            f = optlist.get("f")
-            opts += "-f {0} ".format(f)
-        if "F" in optlist:
-            filter = optlist.get("F")
-            if "," in filter:
-                filter = filter.split(",")
-                for i in range(len(filter)):
-                    opts += "-F {0} ".format(filter[i])
-            else:
-                opts += "-F {0} ".format(filter)
+            font = self.get_font("figlet", optlist.get("f"))
+        else:
+            font = self.get_font("figlet", "mono12", "standard")
+        if not font:
+            irc.reply(
+                "Error: font not found. See fonts --toilet.",
+                private=False,
+                notice=False,
+            )
+            return
+        filters = [name.strip() for name in optlist.get("F", "").split(",")]
+        filters = [name for name in filters if name]
+        for name in filters:
+            if name not in FILTERS:
+                irc.reply(
+                    "Error: unknown filter {0}. Filters: {1}".format(
+                        name, ", ".join(FILTERS)
+                    ),
+                    private=False,
+                    notice=False,
+                )
+                return
         if "w" in optlist:
-            w = optlist.get("w")
-            opts += "-w {0} ".format(w)
+            width = optlist.get("w")
         elif "W" in optlist:
-            opts += "-W "
+            width = 80
         else:
-            opts += "-w 100 "
+            width = 100
+        layout = None
         if "s" in optlist:
-            opts += "-s "
+            layout = None
         elif "k" in optlist:
-            opts += "-k "
+            layout = SM_KERN
         elif "o" in optlist:
-            opts += "-o "
+            layout = SM_SMUSH
         elif "S" in optlist:
-            opts += "-S "
+            layout = (font.layout & 63) | SM_SMUSH
+        elif "W" in optlist:
+            layout = 0
         if "delay" in optlist and ircdb.checkCapability(msg.prefix, "admin"):
             delay = optlist.get("delay")
         else:
             delay = self.registryValue("delay", msg.args[0])
-        try:
-            output = pexpect.run("toilet --irc {0} {1}".format(opts.strip(), text))
-        except:
-            irc.reply("Error. Have you installed toilet?", private=False, notice=False)
-            return
-        self.stopped[channel] = False
-        output = output.decode().replace("\r\r\n", "\r\n")
-        output = output.splitlines()
-        asyncio.run(self.reply(irc, output, channel, delay))
-        if self.registryValue("pasteEnable", msg.args[0]):
-            paste = ""
-            for line in output:
-                if not line.strip():
-                    line = "\xa0"
-                paste += line + "\n"
-        if self.registryValue("pasteEnable", msg.args[0]):
-            irc.reply(
-                self.doPaste(text, paste), private=False, notice=False, to=channel
-            )
+        output = apply_filters(font.render(text, width, layout), filters)
+
+        def then():
+            if self.registryValue("pasteEnable", msg.args[0]):
+                paste = ""
+                for line in output:
+                    if not line.strip():
+                        line = "\xa0"
+                    paste += line + "\n"
+            if self.registryValue("pasteEnable", msg.args[0]):
+                irc.reply(
+                    self.doPaste(text, paste), private=False, notice=False, to=channel
+                )
+
+        self.reply(irc, output, channel, delay, then)
 
     toilet = wrap(
         toilet,
@@ -1547,29 +1060,16 @@ class TextArt(callbacks.Plugin):
         List figlets. Default list are tdf fonts. --toilet for toilet fonts
         """
         optlist = dict(optlist)
-        if "toilet" in optlist:
-            try:
-                reply = ", ".join(sorted(os.listdir("/usr/share/figlet")))
-                irc.reply(reply, prefixNick=False)
-            except:
-                irc.reply("Sorry, unable to access font directory /usr/share/figlet")
+        directories = self.get_font_directories()
+        figlet = self.font_cache.list(directories, "figlet")
+        tdf = self.font_cache.list(directories, "tdf")
+        if tdf and "toilet" not in optlist:
+            irc.reply("http://www.roysac.com/thedrawfonts-tdf.html", prefixNick=False)
+            irc.reply(", ".join(tdf), prefixNick=False)
+        elif figlet:
+            irc.reply(", ".join(figlet), prefixNick=False)
         else:
-            try:
-                reply = ", ".join(
-                    sorted(os.listdir("/usr/local/share/tdfiglet/fonts/"))
-                )
-                irc.reply(
-                    "http://www.roysac.com/thedrawfonts-tdf.html", prefixNick=False
-                )
-                irc.reply(reply, prefixNick=False)
-            except FileNotFoundError:
-                reply = ", ".join(sorted(os.listdir("/usr/share/figlet")))
-                irc.reply(reply, prefixNick=False)
-            except:
-                irc.reply(
-                    "Sorry, unable to access font directories"
-                    " /usr/local/share/tdfiglet/fonts/ or /usr/share/figlet"
-                )
+            irc.reply("Sorry, no fonts found in {0}".format(", ".join(directories)))
 
     fonts = wrap(fonts, [getopts({"toilet": ""})])
 
@@ -1598,31 +1098,36 @@ class TextArt(callbacks.Plugin):
         else:
             delay = self.registryValue("delay", msg.args[0])
         if "16" in optlist:
-            self.colors = 16
+            colors = 16
         elif "99" in optlist:
-            self.colors = 99
+            colors = 99
         else:
-            self.colors = self.registryValue("colors", msg.args[0])
+            colors = self.registryValue("colors", msg.args[0])
         file = requests.get("http://wttr.in/{0}".format(location), timeout=10)
         output = file.content.decode()
-        output = self.ansi2irc(output)
+        output = ansi2irc(output, colors)
         output = re.sub("⚡", "☇ ", output)
         output = re.sub("‘‘", "‘ ", output)
         output = re.sub("\n\nFollow.*$", "", output)
-        self.stopped[channel] = False
         output = output.splitlines()
-        output = [line.strip("\x0F") for line in output]
-        asyncio.run(self.reply(irc, output, channel, delay))
-        if self.registryValue("pasteEnable", msg.args[0]):
-            paste = ""
-            for line in output:
-                if not line.strip():
-                    line = "\xa0"
-                paste += line + "\n"
-        if self.registryValue("pasteEnable", msg.args[0]):
-            irc.reply(
-                self.doPaste(location, paste), private=False, notice=False, to=channel
-            )
+        output = [line.strip("\x0f") for line in output]
+
+        def then():
+            if self.registryValue("pasteEnable", msg.args[0]):
+                paste = ""
+                for line in output:
+                    if not line.strip():
+                        line = "\xa0"
+                    paste += line + "\n"
+            if self.registryValue("pasteEnable", msg.args[0]):
+                irc.reply(
+                    self.doPaste(location, paste),
+                    private=False,
+                    notice=False,
+                    to=channel,
+                )
+
+        self.reply(irc, output, channel, delay, then)
 
     wttr = wrap(
         wttr,
@@ -1653,11 +1158,11 @@ class TextArt(callbacks.Plugin):
         else:
             delay = self.registryValue("delay", msg.args[0])
         if "16" in optlist:
-            self.colors = 16
+            colors = 16
         elif "99" in optlist:
-            self.colors = 99
+            colors = 99
         else:
-            self.colors = self.registryValue("colors", msg.args[0])
+            colors = self.registryValue("colors", msg.args[0])
         if "sub" in optlist:
             sub = optlist.get("sub")
         else:
@@ -1666,23 +1171,24 @@ class TextArt(callbacks.Plugin):
             coin = ""
         file = requests.get("http://{0}.rate.sx/{1}".format(sub, coin), timeout=10)
         output = file.content.decode()
-        output = self.ansi2irc(output)
-        output = output.replace("\x1b(B", "")
+        output = ansi2irc(output, colors)
         output = re.sub(r"\n\x0307NEW FEATURE:.*\n.*", "", output).strip()
         output = output.splitlines()
-        output = [line.strip("\x0F") for line in output]
-        self.stopped[channel] = False
-        asyncio.run(self.reply(irc, output, channel, delay))
-        if self.registryValue("pasteEnable", msg.args[0]):
-            paste = ""
-            for line in output:
-                if not line.strip():
-                    line = "\xa0"
-                paste += line + "\n"
-        if self.registryValue("pasteEnable", msg.args[0]):
-            irc.reply(
-                self.doPaste(coin, paste), private=False, notice=False, to=channel
-            )
+        output = [line.strip("\x0f") for line in output]
+
+        def then():
+            if self.registryValue("pasteEnable", msg.args[0]):
+                paste = ""
+                for line in output:
+                    if not line.strip():
+                        line = "\xa0"
+                    paste += line + "\n"
+            if self.registryValue("pasteEnable", msg.args[0]):
+                irc.reply(
+                    self.doPaste(coin, paste), private=False, notice=False, to=channel
+                )
+
+        self.reply(irc, output, channel, delay, then)
 
     rate = wrap(
         rate,
@@ -1718,12 +1224,20 @@ class TextArt(callbacks.Plugin):
             delay = optlist.get("delay")
         else:
             delay = self.registryValue("delay", msg.args[0])
-        self.stopped[channel] = False
-        data = requests.get("http://www.asciiartfarts.com/fortune.txt", timeout=10)
-        fortunes = data.content.decode().split("%\n")
-        fortune = random.randrange(0, len(fortunes))
-        output = fortunes[fortune].splitlines()
-        asyncio.run(self.reply(irc, output, channel, delay))
+        try:
+            path = Download(
+                "http://www.asciiartfarts.com/fortune.txt",
+                cache=self.fortune_cache,
+                lifetime=self.registryValue("cacheLifetime"),
+            ).save()
+        except requests.exceptions.RequestException as e:
+            log.debug("TextArt: error retrieving data for fortune: {0}".format(e))
+            return
+        with open(path, "rb") as f:
+            start, stop = random.choice(self.get_fortunes(f))
+            f.seek(start)
+            output = f.read(stop - start).decode().splitlines()
+        self.reply(irc, output, channel, delay)
 
     fortune = wrap(fortune, [optional("channel"), getopts({"delay": "float"})])
 
@@ -1743,7 +1257,6 @@ class TextArt(callbacks.Plugin):
             delay = optlist.get("delay")
         else:
             delay = self.registryValue("delay", msg.args[0])
-        self.stopped[channel] = False
         ua = random.choice(self.agents)
         header = {"User-Agent": ua}
         data = requests.get(
@@ -1757,14 +1270,13 @@ class TextArt(callbacks.Plugin):
         if not url:
             irc.reply("Error: No results found for {0}".format(search))
             return
-        data = requests.get(url.get("href"), headers=header, timeout=10)
         try:
-            output = data.content.decode()
-        except:
-            output = data.text
-        output = output.splitlines()
-        asyncio.run(self.reply(irc, output, channel, delay))
-        irc.reply(url.get("href"))
+            download = self.download(url.get("href"), header)
+        except requests.exceptions.RequestException as e:
+            log.debug("TextArt: error retrieving data for mircart: {0}".format(e))
+            return
+        output = download.lines(self.registryValue("maxLines", channel))
+        self.reply(irc, output, channel, delay, lambda: irc.reply(url.get("href")))
 
     mircart = wrap(mircart, [optional("channel"), getopts({"delay": "float"}), "text"])
 
@@ -1775,10 +1287,8 @@ class TextArt(callbacks.Plugin):
         channel = msg.args[0]
         if not irc.isChannel(channel):
             channel = msg.nick
-        self.stopped.setdefault(channel, None)
-        if not self.stopped[channel]:
+        if self.scroller.stop(channel):
             irc.reply("Stopping.")
-        self.stopped[channel] = True
 
     cq = wrap(cq)
 
@@ -1819,7 +1329,7 @@ class TextArt(callbacks.Plugin):
         output.append(
             "\x031,8888\x031,8989\x031,9090\x031,9191\x031,9292\x031,9393\x031,9494\x031,9595\x031,9696\x031,9797\x031,9898\x031,9999",
         )
-        asyncio.run(self.reply(irc, output, channel, delay))
+        self.reply(irc, output, channel, delay)
 
     codes = wrap(codes, [getopts({"delay": "float"})])
 
@@ -0,0 +1,279 @@
+###
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+quantize: vectorized matching of image colors to the IRC palette.
+"""
+
+import os
+import tempfile
+import threading
+
+import numpy as np
+from .colors import colors16, colors83, colors99
+
+# Pixels matched per batch, which bounds the size of the distance matrix
+BATCH_SIZE = 4096
+
+RGB_TO_XYZ = np.array(
+    [
+        [0.4124, 0.3576, 0.1805],
+        [0.2126, 0.7152, 0.0722],
+        [0.0193, 0.1192, 0.9505],
+    ]
+)
+# Observer= 2°, Illuminant= D65
+REFERENCE_WHITE = np.array([95.047, 100.0, 108.883])
+
+
+def rgb2lab(rgb):
+    """
+    Converts an array of RGB colors, with the channels on the last axis, to
+    CIE L*a*b*. Results are rounded like the palette keys in colors.py.
+    """
+    rgb = np.asarray(rgb, dtype=np.float64) / 255
+    rgb = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92) * 100
+    xyz = np.round(rgb @ RGB_TO_XYZ.T, 4) / REFERENCE_WHITE
+    xyz = np.where(xyz > 0.008856, xyz ** (1 / 3), 7.787 * xyz + 16 / 116)
+    x, y, z = xyz[..., 0], xyz[..., 1], xyz[..., 2]
+    return np.round(np.stack((116 * y - 16, 500 * (x - y), 200 * (y - z)), -1), 4)
+
+
+def cie76(lab1, lab2):
+    """
+    Euclidean color difference between broadcastable arrays of Lab colors.
+    """
+    return np.sqrt(((lab1 - lab2) ** 2).sum(-1))
+
+
+def ciede2000(lab1, lab2):
+    """
+    CIEDE2000 color difference between broadcastable arrays of Lab colors.
+    https://peteroupc.github.io/colorgen.html
+    """
+    l1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    l2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+    dl = l2 - l1
+    hl = l1 + dl * 0.5
+    sqb1 = b1 * b1
+    sqb2 = b2 * b2
+    c1 = np.sqrt(a1 * a1 + sqb1)
+    c2 = np.sqrt(a2 * a2 + sqb2)
+    hc7 = ((c1 + c2) * 0.5) ** 7
+    trc = np.sqrt(hc7 / (hc7 + 6103515625))
+    t2 = 1.5 - trc * 0.5
+    ap1 = a1 * t2
+    ap2 = a2 * t2
+    c1 = np.sqrt(ap1 * ap1 + sqb1)
+    c2 = np.sqrt(ap2 * ap2 + sqb2)
+    dc = c2 - c1
+    hc = c1 + dc * 0.5
+    hc7 = hc**7
+    trc = np.sqrt(hc7 / (hc7 + 6103515625))
+    h1 = np.arctan2(b1, ap1)
+    h1 = np.where(h1 < 0, h1 + np.pi * 2, h1)
+    h2 = np.arctan2(b2, ap2)
+    h2 = np.where(h2 < 0, h2 + np.pi * 2, h2)
+    hdiff = h2 - h1
+    hh = h1 + h2
+    wrap = np.abs(hdiff) > np.pi
+    hh = np.where(wrap, hh + np.pi * 2, hh)
+    hdiff = np.where(
+        wrap, np.where(h2 <= h1, hdiff + np.pi * 2, hdiff - np.pi * 2), hdiff
+    )
+    hh = hh * 0.5
+    t2 = 1 - 0.17 * np.cos(hh - np.pi / 6) + 0.24 * np.cos(hh * 2)
+    t2 = t2 + 0.32 * np.cos(hh * 3 + np.pi / 30)
+    t2 = t2 - 0.2 * np.cos(hh * 4 - np.pi * 63 / 180)
+    dh = 2 * np.sqrt(c1 * c2) * np.sin(hdiff * 0.5)
+    sqhl = (hl - 50) * (hl - 50)
+    fl = dl / (1 + (0.015 * sqhl / np.sqrt(20 + sqhl)))
+    fc = dc / (hc * 0.045 + 1)
+    fh = dh / (t2 * hc * 0.015 + 1)
+    dt = 30 * np.exp(-((36 * hh - 55 * np.pi) ** 2) / (25 * np.pi * np.pi))
+    r = -2 * trc * np.sin(2 * dt * np.pi / 180)
+    de = np.sqrt(fl * fl + fc * fc + fh * fh + r * fc * fh)
+    return 1.43 * de**0.70
+
+
+def load_table(filename, bits):
+    """
+    Memory-maps a lookup table saved by Palette.build_table, or returns None
+    if it is missing or does not have the expected shape.
+    """
+    try:
+        table = np.load(filename, mmap_mode="r")
+    except (OSError, ValueError):
+        return
+    size = 1 << bits
+    if table.shape != (size, size, size) or table.dtype != np.uint8:
+        return
+    return table
+
+
+class Palette:
+    """
+    IRC colors keyed by their Lab value, as in colors.py. Colors matched
+    while caching is enabled are remembered by their packed RGB value.
+    """
+
+    def __init__(self, name, colors):
+        self.name = name
+        self.lab = np.array(list(colors.keys()))
+        self.codes = np.array(list(colors.values()))
+        self.matches = {"fast": {}, "slow": {}}
+        self.tables = {}
+        self.tables_lock = threading.Lock()
+        self.building = set()
+
+    def match(self, colormap, speed="slow", cache=False, bits=0, directory=None):
+        """
+        Returns an array of the closest IRC color of every pixel of colormap,
+        which has the RGB channels on its last axis, and the number of colors
+        that were not cached. With bits, colors are looked up in the table
+        for that many bits per channel kept in directory once it is built.
+        """
+        speed = "fast" if speed == "fast" else "slow"
+        if bits:
+            bits = min(bits, 8)
+            table = self.get_table(speed, bits, directory)
+            if table is not None:
+                colormap = np.asarray(colormap, dtype=np.uint8) >> (8 - bits)
+                codes = table[colormap[..., 0], colormap[..., 1], colormap[..., 2]]
+                return codes.astype(int), 0
+        colormap = np.asarray(colormap, dtype=np.uint32)
+        packed = colormap[..., 0] << 16 | colormap[..., 1] << 8 | colormap[..., 2]
+        unique, inverse = np.unique(packed.ravel(), return_inverse=True)
+        matches = self.matches[speed] if cache else {}
+        missing = np.array([color not in matches for color in unique.tolist()])
+        new_colors = unique[missing] if len(unique) else unique
+        rgb = np.stack((new_colors >> 16, new_colors >> 8 & 255, new_colors & 255), -1)
+        matches.update(zip(new_colors.tolist(), self.nearest(rgb, speed).tolist()))
+        codes = np.array([matches[color] for color in unique.tolist()], dtype=int)
+        return codes[inverse].reshape(packed.shape), len(new_colors)
+
+    def nearest(self, rgb, speed):
+        """
+        Returns the IRC codes closest to an array of RGB colors.
+        """
+        codes = np.empty(len(rgb), dtype=self.codes.dtype)
+        for start in range(0, len(rgb), BATCH_SIZE):
+            lab = rgb2lab(rgb[start : start + BATCH_SIZE])[:, np.newaxis]
+            if speed == "fast":
+                distances = cie76(self.lab, lab)
+            else:
+                distances = ciede2000(self.lab, lab)
+            codes[start : start + BATCH_SIZE] = self.codes[distances.argmin(1)]
+        return codes
+
+    def get_filename(self, speed, bits, directory):
+        """
+        Returns the path of the lookup table for speed and bits in directory.
+        """
+        return os.path.join(directory, "%s-%s-%sbit.npy" % (self.name, speed, bits))
+
+    def get_table(self, speed, bits, directory):
+        """
+        Returns the lookup table of this palette for speed and bits per
+        channel from directory, or None if it has not been built yet.
+        """
+        with self.tables_lock:
+            table = self.tables.get((speed, bits))
+            if table is None:
+                table = load_table(self.get_filename(speed, bits, directory), bits)
+                if table is not None:
+                    self.tables[(speed, bits)] = table
+            return table
+
+    def start_build(self, speed, bits, directory):
+        """
+        Builds the lookup table for speed and bits per channel in a
+        background thread unless it exists or is being built already.
+        """
+        speed = "fast" if speed == "fast" else "slow"
+        bits = min(bits, 8)
+        if self.get_table(speed, bits, directory) is not None:
+            return
+        with self.tables_lock:
+            if (speed, bits) in self.building:
+                return
+            self.building.add((speed, bits))
+
+        def build():
+            try:
+                self.build_table(speed, bits, directory)
+            finally:
+                with self.tables_lock:
+                    self.building.discard((speed, bits))
+
+        threading.Thread(
+            target=build, name="TextArt %s table" % self.name, daemon=True
+        ).start()
+
+    def build_table(self, speed, bits, directory):
+        """
+        Saves the closest IRC color of the center of every cell of the RGB
+        cube quantized to bits per channel, indexed by the quantized red,
+        green and blue values.
+        """
+        size = 1 << bits
+        levels = np.arange(size) << (8 - bits) | (1 << (8 - bits) >> 1)
+        green, blue = np.meshgrid(levels, levels, indexing="ij")
+        filename = self.get_filename(speed, bits, directory)
+        fd, temp_filename = tempfile.mkstemp(
+            ".tmp", os.path.basename(filename), directory
+        )
+        try:
+            os.close(fd)
+            table = np.lib.format.open_memmap(
+                temp_filename, mode="w+", dtype=np.uint8, shape=(size, size, size)
+            )
+            for red in range(size):
+                rgb = np.stack((np.full_like(green, levels[red]), green, blue), -1)
+                table[red] = self.nearest(rgb.reshape(-1, 3), speed).reshape(size, size)
+            table.flush()
+            del table
+            os.replace(temp_filename, filename)
+        except BaseException:
+            os.unlink(temp_filename)
+            raise
+
+
+palettes = {
+    16: Palette("colors16", colors16),
+    83: Palette("colors83", colors83),
+    99: Palette("colors99", colors99),
+}
+
+
+def get_palette(colors):
+    """
+    Returns the palette for 16, 83 or 99 colors, defaulting to 83.
+    """
+    return palettes.get(colors, palettes[83])
@@ -0,0 +1,153 @@
+###
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+scroller: sends text art to channels line by line without holding a thread
+for the whole scroll.
+"""
+
+import asyncio
+import collections
+import threading
+
+import supybot.ircmsgs as ircmsgs
+import supybot.log as log
+
+
+class Scroller:
+    """
+    Scrolls lines to channels from a single background event loop. Every
+    channel has its own queue, so several channels scroll at the same time
+    while the lines of a command wait for those of the commands before it.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.queues = {}
+        self.tasks = {}
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="TextArt scroller", daemon=True
+        )
+        self.thread.start()
+
+    def add(self, irc, channel, lines, delay, then=None):
+        """
+        Queues lines to be sent to channel delay seconds apart. lines is a list,
+        or an iterator that is read from worker threads so it may block, e.g.
+        on a download. then is called without arguments in a worker thread
+        once they are sent or stopped, e.g. to reply with a paste link. Can be
+        called from any thread.
+        """
+        if isinstance(lines, (list, tuple)):
+            lines = list(lines)
+        self.loop.call_soon_threadsafe(self._add, irc, channel, lines, delay, then)
+
+    def stop(self, channel):
+        """
+        Drops the lines queued for channel at once, and returns whether it was
+        scrolling.
+        """
+        scrolling = channel in self.tasks
+        self.loop.call_soon_threadsafe(self._stop, channel)
+        return scrolling
+
+    def close(self):
+        """
+        Drops all queued lines and stops the event loop.
+        """
+        if self.loop.is_closed():
+            return
+        future = asyncio.run_coroutine_threadsafe(self._close(), self.loop)
+        future.result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def _add(self, irc, channel, lines, delay, then):
+        queue = self.queues.setdefault(channel, collections.deque())
+        queue.append((irc, lines, delay, then))
+        if channel not in self.tasks:
+            self.tasks[channel] = self.loop.create_task(self._scroll(channel, queue))
+
+    def _stop(self, channel):
+        task = self.tasks.pop(channel, None)
+        queue = self.queues.pop(channel, ())
+        if task:
+            task.cancel()
+        for irc, lines, delay, then in queue:
+            if then:
+                self._finish(then)
+
+    async def _close(self):
+        tasks = list(self.tasks.values())
+        for channel in list(self.tasks):
+            self._stop(channel)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _scroll(self, channel, queue):
+        try:
+            while queue:
+                irc, lines, delay, then = queue[0]
+                async for line in self._iterate(lines):
+                    if not line.strip():
+                        line = "\xa0"
+                    irc.sendMsg(ircmsgs.privmsg(channel, line))
+                    await asyncio.sleep(delay)
+                queue.popleft()
+                if then:
+                    # Errors are logged by _log_exception
+                    await asyncio.wait([self._finish(then)])
+        finally:
+            if self.tasks.get(channel) is asyncio.current_task():
+                del self.tasks[channel]
+                del self.queues[channel]
+
+    async def _iterate(self, lines):
+        if isinstance(lines, list):
+            for line in lines:
+                yield line
+            return
+        while True:
+            try:
+                line = await self.loop.run_in_executor(None, next, lines, None)
+            except Exception:
+                log.exception("TextArt: error while reading lines to scroll")
+                return
+            if line is None:
+                return
+            yield line
+
+    def _finish(self, then):
+        future = self.loop.run_in_executor(None, then)
+        future.add_done_callback(self._log_exception)
+        return future
+
+    def _log_exception(self, future):
+        if not future.cancelled() and future.exception():
+            log.error("TextArt: error after scroll", exc_info=future.exception())
@@ -0,0 +1,751 @@
+###
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+import http.server
+import io
+import json
+import math
+import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+from supybot.test import *
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from . import fetch, plugin, workers
+from .ansi import MAX_COLUMNS, ansi2irc
+from .colors import colors16, colors83, colors99, rgbColors
+
+from .convert import CELL_HEIGHT, CELL_WIDTH, FONT, image2irc, irc2png
+from .encoder import encode_line, get_half_block_cells
+from .fonts import FigletFont, apply_filters, read_tdf
+from .plugin import FONT_DIRECTORY
+from .quantize import cie76, ciede2000, get_palette, rgb2lab
+from .scroller import Scroller
+
+# Lines of half blocks written by the string building img code this plugin
+# used before the encoder, for fixed rows of colors and fixed images
+# ANSI text and its IRC text with 83 colors
+ANSI_LINES = [
+    ("\x1b[31mred\x1b[0m plain", "\x0305red\x03 plain"),
+    ("\x1b[1;34mbright\x1b[44m on blue", "\x0312bright\x0312,02 on blue"),
+    ("\x1b[44m  \x1b[0m\n", "\x0399,02  "),
+    ("\x1b[38;5;196mx\x1b[48;5;232my", "\x0352x\x0352,88y"),
+    ("\x1b[4munder\x1b[24m \x1b[7mrev", "\x1funder\x1f \x16rev"),
+    ("ab\x1b[3Ccd\r\nef", "ab   cd\nef"),
+    ("a\tb", "a       b"),
+    ("x\x1b[3;2Hy", "x\n\n y"),
+    ("\x1b[31m12\x1b[5Cx", "\x030512\x03     \x0305x"),
+]
+# Text rendered with the standard FIGlet font by figlet
+FIGLET_LINES = {
+    "TextArt": [
+        " _____         _      _         _",
+        "|_   _|____  _| |_   / \\   _ __| |_",
+        "  | |/ _ \\ \\/ / __| / _ \\ | '__| __|",
+        "  | |  __/>  <| |_ / ___ \\| |  | |_",
+        "  |_|\\___/_/\\_\\\\__/_/   \\_\\_|   \\__|",
+        "",
+    ],
+    "Hi": [" _   _ _", "| | | (_)", "| |_| | |", "|  _  | |", "|_| |_|_|", "\xa0"],
+    "Hello world": [
+        " _   _      _ _",
+        "| | | | ___| | | ___",
+        "| |_| |/ _ \\ | |/ _ \\",
+        "|  _  |  __/ | | (_) |",
+        "|_| |_|\\___|_|_|\\___/",
+        "",
+        "                    _     _",
+        "__      _____  _ __| | __| |",
+        "\\ \\ /\\ / / _ \\| '__| |/ _` |",
+        " \\ V  V / (_) | |  | | (_| |",
+        "  \\_/\\_/ \\___/|_|  |_|\\__,_|",
+        "",
+    ],
+}
+OLD_HALF_BLOCK_LINES = [
+    (
+        [15, 15, 23, 23, 15, 15, 23, 15, 15, 15, 15, 23],
+        [15, 23, 15, 23, 23, 23, 23, 23, 15, 23, 15, 23],
+        False,
+        "\x0323,15 ▄▀█▄▄█▄ ▄ █",
+    ),
+    (
+        [15, 15, 23, 23, 15, 15, 23, 15, 15, 15, 15, 23],
+        [15, 23, 15, 23, 23, 23, 23, 23, 15, 23, 15, 23],
+        True,
+        "\x031,15 \x0315,23▀\x0323,15▀\x0315,23 ▀▀ ▀\x031,15 \x0315,23▀\x031,15"
+        " \x031,23 ",
+    ),
+    (
+        [91, 38, 38, 91, 33, 38, 33, 38, 33, 33, 33, 38],
+        [38, 33, 33, 38, 33, 91, 38, 38, 33, 33, 91, 38],
+        False,
+        "\x0391,38▀\x0333▄▄\x0391▀\x0333█\x0391▄\x0333▀ \x0391,33  ▄\x0338█",
+    ),
+    (
+        [91, 38, 38, 91, 33, 38, 33, 38, 33, 33, 33, 38],
+        [38, 33, 33, 38, 33, 91, 38, 38, 33, 33, 91, 38],
+        True,
+        "\x0391,38▀\x0338,33▀▀\x0391,38▀\x031,33 \x0338,91▀\x0333,38▀ \x031,33 "
+        " \x0333,91▀\x031,38 ",
+    ),
+]
+OLD_IMAGE_LINES = {
+    (99, "slow", False): [
+        "\x031,40  \x0312,49▀ \x0351,40  █\x0363█",
+        "\x0372,47▀\x0335▀\x031,40  \x036,51▀ \x031,40  ",
+        "\x031,40  \x0334,45▀\x0314▀\x031,40  \x0341,65▀\x037▀",
+        "\x0345,57▀▀\x031,40  \x0343,68▀\x0342,55▀\x031,40  ",
+    ],
+    (16, "fast", False): [
+        "\x034,5▀ \x0312,2▀\x036▄\x036,5  █▀",
+        "\x0314,2 ▄\x031,5  \x036,14▀▀\x031,5  ",
+        "\x031,5  \x0314,10▀▀\x031,5  \x031,7  ",
+        "\x0310,3▀▀\x031,5  \x038,3 ▄\x031,5  ",
+    ],
+    (83, "slow", True): [
+        "\x031,40  \x0360,49▀ \x031,40  \x031,51 \x031,63 ",
+        "\x0372,47▀\x0335▀\x031,40  \x0350,51▀ \x031,40  ",
+        "\x031,40  \x0334,45▀\x0394▀\x031,40  \x0341,65▀\x0353▀",
+        "\x0345,57▀▀\x031,40  \x0343,68▀\x0342,55▀\x031,40  ",
+    ],
+}
+
+
+def old_rgb2lab(rgb):
+    """
+    CIE L*a*b* value of an RGB color, as computed by this plugin one color at
+    a time before it used numpy.
+    """
+    channels = []
+    for value in rgb:
+        value = value / 255
+        if value > 0.04045:
+            value = ((value + 0.055) / 1.055) ** 2.4
+        else:
+            value = value / 12.92
+        channels.append(value * 100)
+    r, g, b = channels
+    xyz = [
+        round(r * 0.4124 + g * 0.3576 + b * 0.1805, 4) / 95.047,
+        round(r * 0.2126 + g * 0.7152 + b * 0.0722, 4) / 100.0,
+        round(r * 0.0193 + g * 0.1192 + b * 0.9505, 4) / 108.883,
+    ]
+    x, y, z = [
+        value ** (1 / 3) if value > 0.008856 else 7.787 * value + 16 / 116
+        for value in xyz
+    ]
+    return [round(116 * y - 16, 4), round(500 * (x - y), 4), round(200 * (y - z), 4)]
+
+
+def old_ciede2000(lab1, lab2):
+    """
+    CIEDE2000 color difference, as computed by this plugin one pair of colors
+    at a time before it used numpy.
+    """
+    dl = lab2[0] - lab1[0]
+    hl = lab1[0] + dl * 0.5
+    sqb1 = lab1[2] * lab1[2]
+    sqb2 = lab2[2] * lab2[2]
+    c1 = math.sqrt(lab1[1] * lab1[1] + sqb1)
+    c2 = math.sqrt(lab2[1] * lab2[1] + sqb2)
+    hc7 = math.pow((c1 + c2) * 0.5, 7)
+    trc = math.sqrt(hc7 / (hc7 + 6103515625))
+    t2 = 1.5 - trc * 0.5
+    ap1 = lab1[1] * t2
+    ap2 = lab2[1] * t2
+    c1 = math.sqrt(ap1 * ap1 + sqb1)
+    c2 = math.sqrt(ap2 * ap2 + sqb2)
+    dc = c2 - c1
+    hc = c1 + dc * 0.5
+    hc7 = math.pow(hc, 7)
+    trc = math.sqrt(hc7 / (hc7 + 6103515625))
+    h1 = math.atan2(lab1[2], ap1)
+    if h1 < 0:
+        h1 = h1 + math.pi * 2
+    h2 = math.atan2(lab2[2], ap2)
+    if h2 < 0:
+        h2 = h2 + math.pi * 2
+    hdiff = h2 - h1
+    hh = h1 + h2
+    if abs(hdiff) > math.pi:
+        hh = hh + math.pi * 2
+        if h2 <= h1:
+            hdiff = hdiff + math.pi * 2
+        else:
+            hdiff = hdiff - math.pi * 2
+    hh = hh * 0.5
+    t2 = 1 - 0.17 * math.cos(hh - math.pi / 6) + 0.24 * math.cos(hh * 2)
+    t2 = t2 + 0.32 * math.cos(hh * 3 + math.pi / 30)
+    t2 = t2 - 0.2 * math.cos(hh * 4 - math.pi * 63 / 180)
+    dh = 2 * math.sqrt(c1 * c2) * math.sin(hdiff * 0.5)
+    sqhl = (hl - 50) * (hl - 50)
+    fl = dl / (1 + (0.015 * sqhl / math.sqrt(20 + sqhl)))
+    fc = dc / (hc * 0.045 + 1)
+    fh = dh / (t2 * hc * 0.015 + 1)
+    dt = 30 * math.exp(-math.pow(36 * hh - 55 * math.pi, 2) / (25 * math.pi * math.pi))
+    r = -2 * trc * math.sin(2 * dt * math.pi / 180)
+    de = math.sqrt(fl * fl + fc * fc + fh * fh + r * fc * fh)
+    return 1.43 * de**0.70
+
+
+def old_get_color(rgb, colors, speed):
+    """
+    The IRC color of colors, a dictionary from colors.py, closest to an RGB
+    color, as found by this plugin before it used numpy.
+    """
+    lab = old_rgb2lab(rgb)
+    if speed == "fast":
+        distance = lambda color: math.dist(color, lab)
+    else:
+        distance = lambda color: old_ciede2000(color, lab)
+    return colors[min(colors, key=distance)]
+
+
+def get_tdf(name, type, glyphs):
+    """
+    Returns a TheDraw font file with one font of type (1 for block, 2 for
+    color) drawing the characters of glyphs, a dictionary from characters to
+    (byte, attribute) pairs, as 3x2 blocks.
+    """
+    data = b""
+    offsets = [0xFFFF] * 94
+    for char, (byte, attribute) in glyphs.items():
+        offsets[ord(char) - 33] = len(data)
+        row = (bytes((byte, attribute)) if type == 2 else bytes((byte,))) * 3
+        data += bytes((3, 2)) + row + b"\r" + row + b"\x00"
+    header = b"\x55\xaa\x00\xff" + bytes((len(name),)) + name.ljust(16, b"\x00")
+    header += struct.pack("<BBH", type, 1, len(data))
+    header += struct.pack("<94H", *offsets)
+    return b"\x13TheDraw FONTS file\x1a" + header + data
+
+
+def get_rgb_cube(step):
+    """
+    Returns the RGB colors whose channels are multiples of step.
+    """
+    levels = range(0, 256, step)
+    return np.array([(r, g, b) for r in levels for g in levels for b in levels])
+
+
+class FakeIrc:
+    def __init__(self):
+        self.sent = []
+        self.replies = []
+
+    def sendMsg(self, msg):
+        self.sent.append((msg.args[0], msg.args[1]))
+
+    def reply(self, s, **kwargs):
+        self.replies.append(s)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves canned (status, headers, body) responses from the routes dict,
+    answering 304 when the request's validators match, and records the
+    headers of GET requests and the body of POST requests.
+    """
+
+    routes = {}
+    requests = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.requests.append((self.path, body))
+        self.respond(*self.routes.get(self.path, (404, {}, b"")))
+
+    def do_GET(self):
+        self.requests.append((self.path, dict(self.headers)))
+        status, headers, body = self.routes.get(self.path, (404, {}, b""))
+        etag = self.headers.get("If-None-Match")
+        modified = self.headers.get("If-Modified-Since")
+        if (etag and etag == headers.get("ETag")) or (
+            modified and modified == headers.get("Last-Modified")
+        ):
+            status, body = 304, b""
+        self.respond(status, headers, body)
+
+    def respond(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_pixels(line):
+    """
+    Returns the (top, bottom) colors of every cell of a line of half blocks.
+    """
+    pixels = []
+    fg = bg = None
+    for code, char in re.findall(r"\x03(\d{1,2}(?:,\d{1,2})?)|(.)", line):
+        if code:
+            colors = [int(color) for color in code.split(",")]
+            fg, bg = colors[0], colors[-1] if len(colors) > 1 else bg
+        elif char == " ":
+            pixels.append((bg, bg))
+        elif char == "█":
+            pixels.append((fg, fg))
+        elif char == "▀":
+            pixels.append((fg, bg))
+        elif char == "▄":
+            pixels.append((bg, fg))
+    return pixels
+
+
+def get_image():
+    """
+    Returns a 16x16 PNG image of gradients checkered with a flat color.
+    """
+    image = Image.new("RGB", (16, 16))
+    for x in range(16):
+        for y in range(16):
+            if (x // 4 + y // 4) % 2:
+                image.putpixel((x, y), (x * 16, y * 16, 255 - x * 8 - y * 8))
+            else:
+                image.putpixel((x, y), (200, 30, 30))
+    data = io.BytesIO()
+    image.save(data, "PNG")
+    return data.getvalue()
+
+
+class TextArtTestCase(PluginTestCase):
+    plugins = ("TextArt",)
+
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.base_url = "http://127.0.0.1:%s" % self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        StubHandler.requests = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        PluginTestCase.tearDown(self)
+
+    def assertSameArt(self, line, old_line):
+        self.assertEqual(get_pixels(line), get_pixels(old_line))
+        self.assertLessEqual(len(line.encode()), len(old_line.encode()))
+
+    def testHalfBlockEncoder(self):
+        for top, bottom, tops, old_line in OLD_HALF_BLOCK_LINES:
+            cells = get_half_block_cells(top, bottom, tops)
+            self.assertSameArt(encode_line(cells), old_line)
+        cells = get_half_block_cells([4, 4, 4, 4], [4, 4, 4, 4])
+        self.assertEqual(encode_line(cells), "\x031,4    ")
+        self.assertEqual(encode_line(cells, max_bytes=6), "\x031,4  ")
+        self.assertEqual(encode_line([]), "")
+
+    def testHalfBlockImage(self):
+        data = get_image()
+        for (colors, speed, tops), old_lines in OLD_IMAGE_LINES.items():
+            lines, source_colors = image2irc(
+                data, cols=8, colors=colors, speed=speed, tops=tops
+            )
+            self.assertEqual(len(lines), len(old_lines))
+            for line, old_line in zip(lines, old_lines):
+                self.assertSameArt(line, old_line)
+
+    def testScroller(self):
+        irc = FakeIrc()
+        done = []
+        finished = threading.Event()
+        scroller = Scroller()
+        try:
+            scroller.add(irc, "#a", ["a1", "", "a2"], 0.01, lambda: done.append("a"))
+            scroller.add(irc, "#a", iter(["b1", "b2"]), 0.01, lambda: done.append("b"))
+            scroller.add(irc, "#b", ["c1", "c2"], 0.01, finished.set)
+            scroller.add(irc, "#a", [], 0, finished.set)
+            self.assertTrue(finished.wait(5))
+            time.sleep(0.1)
+            self.assertEqual(
+                [line for channel, line in irc.sent if channel == "#a"],
+                ["a1", "\xa0", "a2", "b1", "b2"],
+            )
+            self.assertEqual(
+                [line for channel, line in irc.sent if channel == "#b"], ["c1", "c2"]
+            )
+            # Channels scroll at the same time
+            self.assertLess(irc.sent.index(("#b", "c1")), irc.sent.index(("#a", "a2")))
+            self.assertEqual(done, ["a", "b"])
+
+            irc.sent.clear()
+            finished.clear()
+            lines = ["line %s" % i for i in range(100)]
+            scroller.add(irc, "#a", lines, 0.01, finished.set)
+            scroller.add(irc, "#a", lines, 0.01, lambda: done.append("c"))
+            time.sleep(0.1)
+            self.assertTrue(scroller.stop("#a"))
+            self.assertTrue(finished.wait(5))
+            time.sleep(0.1)
+            sent = len(irc.sent)
+            self.assertLess(sent, 100)
+            self.assertEqual(irc.sent, [("#a", line) for line in lines[:sent]])
+            self.assertEqual(done, ["a", "b", "c"])
+            self.assertFalse(scroller.stop("#a"))
+        finally:
+            scroller.close()
+
+    def testColorDifference(self):
+        rgb = get_rgb_cube(51)
+        lab = rgb2lab(rgb)
+        self.assertEqual(lab.tolist(), [old_rgb2lab(color) for color in rgb.tolist()])
+        palette = np.array(list(colors99))
+        slow = ciede2000(palette, lab[:, np.newaxis])
+        fast = cie76(palette, lab[:, np.newaxis])
+        for i, color in enumerate(lab.tolist()):
+            for j, irc_color in enumerate(palette.tolist()):
+                self.assertAlmostEqual(slow[i, j], old_ciede2000(irc_color, color))
+                self.assertAlmostEqual(fast[i, j], math.dist(irc_color, color))
+
+    def testPaletteMatch(self):
+        rgb = get_rgb_cube(51)
+        for size, colors in ((16, colors16), (83, colors83), (99, colors99)):
+            palette = get_palette(size)
+            for speed in ("slow", "fast"):
+                codes, source_colors = palette.match(rgb.reshape(6, 36, 3), speed)
+                self.assertEqual(codes.shape, (6, 36))
+                self.assertEqual(source_colors, len(rgb))
+                self.assertEqual(
+                    codes.ravel().tolist(),
+                    [old_get_color(color, colors, speed) for color in rgb.tolist()],
+                )
+
+    def testColorTable(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        palette = get_palette(16)
+        rgb = get_rgb_cube(17).reshape(16, 16, 16, 3)
+        # Colors are matched one by one until the table is built
+        codes, source_colors = palette.match(rgb, "fast", bits=4, directory=directory)
+        self.assertEqual(source_colors, 16**3)
+        self.assertEqual(os.listdir(directory), [])
+        palette.start_build("fast", 4, directory)
+        for _ in range(100):
+            if not palette.building:
+                break
+            time.sleep(0.1)
+        self.assertEqual(os.listdir(directory), ["colors16-fast-4bit.npy"])
+        table_codes, source_colors = palette.match(
+            rgb, "fast", bits=4, directory=directory
+        )
+        self.assertEqual(source_colors, 0)
+        # Each color is in its own cell and is given the color of its center
+        centers = (rgb >> 4 << 4) | 8
+        self.assertEqual(
+            table_codes.tolist(), palette.match(centers, "fast")[0].tolist()
+        )
+        self.assertGreater((table_codes == codes).mean(), 0.9)
+
+    def testAnsi(self):
+        for text, irc_text in ANSI_LINES:
+            self.assertEqual(ansi2irc(text), irc_text)
+        self.assertEqual(
+            ansi2irc("\x1b[38;5;196mx\x1b[48;5;232my", 16), "\x0304x\x0304,01y"
+        )
+        self.assertEqual(ansi2irc("\x1b[38;2;255;0;0mt", 99), "\x0304t")
+        self.assertEqual(ansi2irc("abcdef", width=4), "abcd\nef")
+        self.assertEqual(ansi2irc("1\n2\n3\n4", max_rows=2), "1\n2")
+        # The cursor cannot leave the screen, however far it is moved
+        self.assertEqual(ansi2irc("a\x1b[2000000Bb"), "a")
+        self.assertEqual(ansi2irc("a\x1b[2000000C\x1b[2000000Db"), "b")
+        self.assertEqual(
+            ansi2irc("a\x1b[2000000Cb"), "a" + " " * (MAX_COLUMNS - 2) + "b"
+        )
+        self.assertEqual(ansi2irc("\x1b[2000000;2000000Hx"), "")
+
+    def testFonts(self):
+        with open(os.path.join(FONT_DIRECTORY, "standard.flf"), "rb") as f:
+            font = FigletFont("standard", f.read())
+        self.assertEqual(font.render("TextArt"), FIGLET_LINES["TextArt"])
+        self.assertEqual(font.render("Hello world", 30), FIGLET_LINES["Hello world"])
+        self.assertEqual(
+            apply_filters(font.render("Hi"), ["crop", "border"]),
+            [
+                "+---------+",
+                "| _   _ _ |",
+                "|| | | (_)|",
+                "|| |_| | ||",
+                "||  _  | ||",
+                "||_| |_|_||",
+                "+---------+",
+            ],
+        )
+        (font,) = read_tdf("test", get_tdf(b"TEST", 2, {"A": (0xDB, 0x1C)}))
+        self.assertEqual(font.get_info(), "TEST: color font, spacing 1, 1 characters")
+        self.assertEqual(font.render("A a"), ["\x0304,02███\x03     \x0304,02███"] * 2)
+        self.assertEqual(font.render("A", 5, "r"), ["  \x0304,02███"] * 2)
+        (font,) = read_tdf("test", get_tdf(b"TEST", 1, {"B": (0xB1, 0)}))
+        self.assertEqual(font.render("BB"), ["▒▒▒ ▒▒▒"] * 2)
+        self.assertRaises(ValueError, read_tdf, "test", b"not a font")
+
+    def testFontCommands(self):
+        # Only the fonts shipped with the plugin
+        with conf.supybot.plugins.TextArt.fontDirectories.context([]):
+            self.assertResponse("fontlist", "standard")
+            self.assertResponse(
+                "tdf --e a A", "Error: only Unicode output (--e u) is supported."
+            )
+            self.assertResponse("tdf A", "Error: font not found. See fonts.")
+            with conf.supybot.plugins.TextArt.delay.context(0):
+                self.feedMsg("artii Hi")
+                lines = []
+                for _ in range(100):
+                    msg = self.irc.takeMsg()
+                    if msg:
+                        lines.append(msg.args[1])
+                    if len(lines) == 6:
+                        break
+                    time.sleep(0.01)
+        self.assertEqual(lines, FIGLET_LINES["Hi"])
+
+    def testIrc2Png(self):
+        # Bold and reverse are not drawn, and 99 is the default color
+        text = "\x02A\x0304,02B\x16C\x0f D\n\x0303,99E"
+        image = np.array(Image.open(io.BytesIO(irc2png(text, 18, 1, 0))))
+        self.assertEqual(image.shape, (2 * CELL_HEIGHT, 5 * CELL_WIDTH, 3))
+        cells = {
+            (0, 0): ("A", 0, 1),
+            (0, 1): ("B", 4, 2),
+            (0, 2): ("C", 4, 2),
+            (0, 3): (" ", 0, 1),
+            (0, 4): ("D", 0, 1),
+            (1, 0): ("E", 3, 1),
+            (1, 1): (" ", 0, 1),
+            (1, 4): (" ", 0, 1),
+        }
+        font = ImageFont.truetype(FONT, 18)
+        for (y, x), (char, fg, bg) in cells.items():
+            cell = image[
+                y * CELL_HEIGHT : (y + 1) * CELL_HEIGHT,
+                x * CELL_WIDTH : (x + 1) * CELL_WIDTH,
+            ]
+            self.assertEqual(tuple(cell[0, 0]), rgbColors[bg])
+            if char != " ":
+                self.assertTrue((cell == rgbColors[fg]).all(-1).any())
+            # Same pixels as drawing the character with PIL
+            old = Image.new("RGB", (CELL_WIDTH, CELL_HEIGHT), rgbColors[bg])
+            ImageDraw.Draw(old).text((0, 0), char, font=font, fill=rgbColors[fg])
+            np.testing.assert_array_equal(cell, np.array(old))
+        self.assertRaises(ValueError, irc2png, "A", 18, 100, 0)
+
+    def testFetch(self):
+        cb = self.irc.getCallback("TextArt")
+        StubHandler.routes = {
+            "/file": (200, {"Content-Type": "text/plain"}, b"one\ntwo\n"),
+        }
+        url = self.base_url + "/file"
+        irc = FakeIrc()
+        text = lambda type: "text/plain" in type
+        self.assertEqual(cb.fetch(irc, "test", url, text, 0), b"one\ntwo\n")
+        self.assertIsNone(cb.fetch(irc, "test", url, lambda type: False, 0))
+        self.assertIsNone(cb.fetch(irc, "test", url, text, 4))
+        self.assertIsNone(cb.fetch(irc, "test", self.base_url + "/missing", text, 0))
+        self.assertEqual(
+            irc.replies, ["Invalid file type.", "Error: file is larger than 4 bytes."]
+        )
+
+    def testRunTool(self):
+        cb = self.irc.getCallback("TextArt")
+        self.assertEqual(cb.run_tool(["cat"], b"art"), b"art")
+        self.assertEqual(cb.run_tool(["cat"], b"art", seek=True), b"art")
+        with self.assertRaisesRegex(plugin.ToolError, "^bad input$"):
+            cb.run_tool(["sh", "-c", "echo bad input >&2; exit 1"], b"")
+        with self.assertRaisesRegex(plugin.ToolError, "^exit status 2$"):
+            cb.run_tool(["sh", "-c", "exit 2"], b"")
+        with conf.supybot.plugins.TextArt.workerTimeout.context(1):
+            with self.assertRaisesRegex(plugin.ToolError, "timed out"):
+                cb.run_tool(["sleep", "5"], b"")
+        self.assertRaises(OSError, cb.run_tool, ["TextArt-missing-tool"], b"")
+
+    def testPngUpload(self):
+        cb = self.irc.getCallback("TextArt")
+        cb.upload_url = self.base_url + "/upload"
+        link = "https://i.imgur.com/art.png"
+        StubHandler.routes = {
+            "/art.txt": (200, {"Content-Type": "text/plain"}, b"\x0304,02B"),
+            "/upload": (200, {}, json.dumps({"data": {"link": link}}).encode()),
+        }
+        with conf.supybot.plugins.TextArt.imgurAPI.context("id"):
+            self.assertResponse("png %s/art.txt" % self.base_url, link)
+            # The PNG is uploaded from memory as rendered
+            (body,) = [body for path, body in StubHandler.requests if path == "/upload"]
+            self.assertIn(irc2png("\x0304,02B", 18, 1, 0), body)
+            StubHandler.routes["/upload"] = (500, {}, b"")
+            self.assertResponse(
+                "png %s/art.txt" % self.base_url,
+                "Error. Did you set a valid Imgur API Client ID?",
+            )
+
+    def testFileCache(self):
+        text = {"Content-Type": "text/plain"}
+        StubHandler.routes = {
+            "/etag": (200, dict(text, ETag='"1"'), b"one\ntwo\nthree\n"),
+            "/modified": (
+                200,
+                dict(text, **{"Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"}),
+                b"one\r\ntwo",
+            ),
+        }
+        directory = tempfile.mkdtemp()
+        try:
+            cache = fetch.FileCache(directory)
+            for path in ("/etag", "/modified"):
+                url = self.base_url + path
+                download = fetch.Download(url, cache=cache)
+                self.assertEqual(download.content_type, "text/plain")
+                self.assertEqual(list(download.lines())[:2], ["one", "two"])
+                self.assertIsNotNone(cache.load(url))
+                # Fresh copies are read from the cache without a request
+                count = len(StubHandler.requests)
+                download = fetch.Download(url, cache=cache, lifetime=60)
+                self.assertIsNone(download.response)
+                with open(download.save(), "rb") as f:
+                    self.assertTrue(f.read().startswith(b"one"))
+                self.assertEqual(len(StubHandler.requests), count)
+                # Stale copies are revalidated, and kept on 304
+                download = fetch.Download(url, cache=cache)
+                self.assertIsNone(download.response)
+                self.assertEqual(download.read()[:3], b"one")
+                self.assertEqual(len(StubHandler.requests), count + 1)
+            headers = [headers for path, headers in StubHandler.requests]
+            self.assertEqual(headers[1]["If-None-Match"], '"1"')
+            self.assertEqual(
+                headers[-1]["If-Modified-Since"], "Mon, 01 Jan 2024 00:00:00 GMT"
+            )
+            # A changed file replaces the cached copy
+            StubHandler.routes["/etag"] = (200, dict(text, ETag='"2"'), b"four\n")
+            download = fetch.Download(self.base_url + "/etag", cache=cache)
+            self.assertIsNotNone(download.response)
+            self.assertEqual(list(download.lines()), ["four"])
+            download = fetch.Download(self.base_url + "/etag", cache=cache, lifetime=60)
+            self.assertEqual(list(download.lines()), ["four"])
+            # Truncated downloads are not cached
+            url = self.base_url + "/etag"
+            StubHandler.routes["/etag"] = (200, dict(text, ETag='"3"'), b"five\n")
+            download = fetch.Download(url, cache=cache, max_bytes=2)
+            self.assertEqual(list(download.lines()), ["fi"])
+            download = fetch.Download(url, cache=cache, lifetime=60)
+            self.assertEqual(list(download.lines()), ["four"])
+        finally:
+            shutil.rmtree(directory)
+
+    def testFileSize(self):
+        StubHandler.routes = {
+            "/file": (200, {"Content-Type": "text/plain"}, b"one\ntwo\nthree\n"),
+        }
+        url = self.base_url + "/file"
+        self.assertRaises(fetch.FileTooLarge, fetch.Download(url, max_bytes=4).read)
+        self.assertEqual(fetch.Download(url, max_bytes=14).read(), b"one\ntwo\nthree\n")
+        self.assertEqual(list(fetch.Download(url, max_bytes=6).lines()), ["one", "tw"])
+        self.assertEqual(list(fetch.Download(url).lines(2)), ["one", "two"])
+        with conf.supybot.plugins.TextArt.delay.context(0):
+            with conf.supybot.plugins.TextArt.maxLines.context(2):
+                self.feedMsg("scroll %s" % url)
+                lines = []
+                for _ in range(100):
+                    msg = self.irc.takeMsg()
+                    if msg:
+                        lines.append(msg.args[1])
+                    time.sleep(0.01)
+        self.assertEqual(lines, ["one", "two"])
+
+    def testWorkerPool(self):
+        # workers is reloaded with the plugin, so its classes are looked up on it
+        pool = workers.WorkerPool(1, timeout=1)
+        try:
+            self.assertEqual(pool.run(max, 1, 2), 2)
+            (worker,) = pool.idle
+            # A failed job is passed back and the worker is kept
+            self.assertRaises(ValueError, pool.run, int, "x")
+            self.assertEqual(pool.idle, [worker])
+            # A job that times out kills the worker, and the next job gets a
+            # new one
+            self.assertRaises(workers.WorkerError, pool.run, time.sleep, 5)
+            self.assertEqual(pool.idle, [])
+            self.assertFalse(worker.process.is_alive())
+            self.assertEqual(pool.run(max, 3, 4), 4)
+            self.assertEqual(len(pool.idle), 1)
+            self.assertIsNot(pool.idle[0], worker)
+        finally:
+            pool.close()
+        self.assertRaises(workers.WorkerError, pool.run, max, 1, 2)
+
+    def testWorkerMemory(self):
+        if not workers.resource or not workers.get_memory():
+            return
+        pool = workers.WorkerPool(1, memory=64 * 1024 * 1024)
+        try:
+            self.assertRaises(MemoryError, pool.run, bytearray, 1 << 30)
+            self.assertEqual(len(pool.run(bytearray, 1024)), 1024)
+        finally:
+            pool.close()
+
+    def testWorkerPoolConfig(self):
+        cb = self.irc.getCallback("TextArt")
+        with conf.supybot.plugins.TextArt.workers.context(0):
+            self.assertEqual(cb.convert(max, 1, 2), 2)
+            self.assertIsNone(cb.workers)
+        with conf.supybot.plugins.TextArt.workers.context(1):
+            self.assertEqual(cb.convert(max, 1, 2), 2)
+            pool = cb.workers
+            self.assertEqual(pool.size, 1)
+            cb.convert(max, 1, 2)
+            self.assertIs(cb.workers, pool)
+            with conf.supybot.plugins.TextArt.workerMemory.context(256):
+                cb.convert(max, 1, 2)
+                self.assertTrue(pool.closed)
+                self.assertEqual(cb.workers.memory, 256 * 1024 * 1024)
+        with conf.supybot.plugins.TextArt.workers.context(2):
+            pool = cb.workers
+            cb.convert(max, 1, 2)
+            self.assertTrue(pool.closed)
+            self.assertEqual(cb.workers.size, 2)
+        with conf.supybot.plugins.TextArt.workers.context(0):
+            cb.convert(max, 1, 2)
+            self.assertIsNone(cb.workers)
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
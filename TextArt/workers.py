@@ -0,0 +1,223 @@
+###
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+workers: a small pool of processes for CPU heavy conversions, so they run in
+parallel and a stuck or oversized job cannot take the bot down.
+"""
+
+import importlib
+import multiprocessing
+import os
+import runpy
+import signal
+import sys
+import threading
+import types
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class WorkerError(Exception):
+    pass
+
+
+def get_memory():
+    """
+    Returns the virtual memory size of this process in bytes, or None if it
+    is unknown.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def work(connection, memory, preload=()):
+    """
+    Runs jobs received on connection and sends back their results. The
+    modules in preload are imported first, then the worker is limited to
+    allocating memory bytes on top of its size.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for name in ("SIGTERM", "SIGHUP", "SIGUSR1"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), signal.SIG_DFL)
+    for module in preload:
+        importlib.import_module(module)
+    size = get_memory()
+    if memory and size and resource:
+        limit = size + memory
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    while True:
+        try:
+            job = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if job is None:
+            return
+        function, args, kwargs = job
+        try:
+            result = (True, function(*args, **kwargs))
+        except Exception as e:
+            result = (False, e)
+        try:
+            connection.send(result)
+        except Exception as e:
+            connection.send((False, WorkerError(repr(e))))
+
+
+def bootstrap(package, directory, *args):
+    """
+    Registers the plugin's package in a new worker, which cannot import it by
+    name since Limnoria loads plugins from its own directories, so that jobs
+    and their results can be unpickled, then runs work from it.
+    """
+    if package not in sys.modules:
+        module = types.ModuleType(package)
+        module.__path__ = [directory]
+        sys.modules[package] = module
+    importlib.import_module(package + ".workers").work(*args)
+
+
+class Worker:
+    def __init__(self, context, memory, preload=()):
+        self.connection, child = context.Pipe()
+        # Workers are started from a fork server rather than forked from the
+        # bot, whose other threads may hold locks, so this module is run by
+        # path to register the plugin's package there first
+        package, _, _ = __name__.rpartition(".")
+        self.process = context.Process(
+            target=runpy.run_path,
+            args=(__file__,),
+            kwargs={
+                "init_globals": {
+                    "args": (package, os.path.dirname(__file__), child, memory, preload)
+                },
+                "run_name": "__worker__",
+            },
+            name="TextArt worker",
+            daemon=True,
+        )
+        self.process.start()
+        child.close()
+
+    def run(self, timeout, function, *args, **kwargs):
+        """
+        Returns the result of function in this worker. Raises WorkerError if
+        it takes longer than timeout seconds or the worker dies.
+        """
+        try:
+            self.connection.send((function, args, kwargs))
+            if not self.connection.poll(timeout or None):
+                raise WorkerError("timed out after {0} seconds".format(timeout))
+            ok, result = self.connection.recv()
+        except (EOFError, OSError):
+            raise WorkerError("worker exited") from None
+        if not ok:
+            raise result
+        return result
+
+    def close(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.connection.close()
+        self.process.join(1)
+
+    def kill(self):
+        self.process.kill()
+        self.connection.close()
+        self.process.join(1)
+
+
+class WorkerPool:
+    """
+    Runs functions in up to size worker processes, each job with a timeout
+    in seconds and workers limited to memory bytes on top of their own size
+    once the modules in preload are imported (0 for no limits). Workers are
+    started when needed and reused; one that times out or fails is killed and
+    replaced by the next job. Functions and their arguments and results are
+    pickled, so they must be module level functions of this package taking
+    and returning plain values.
+    """
+
+    def __init__(self, size, timeout=60, memory=0, preload=()):
+        self.context = multiprocessing.get_context("forkserver")
+        self.size = size
+        self.timeout = timeout
+        self.memory = memory
+        self.preload = tuple(preload)
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.closed = False
+
+    def run(self, function, *args, **kwargs):
+        with self.slots:
+            with self.lock:
+                if self.closed:
+                    raise WorkerError("worker pool closed")
+                worker = self.idle.pop() if self.idle else None
+            if worker is None:
+                worker = Worker(self.context, self.memory, self.preload)
+            try:
+                result = worker.run(self.timeout, function, *args, **kwargs)
+            except WorkerError:
+                worker.kill()
+                raise
+            except Exception:
+                # The job failed, but the worker can take the next one
+                self.release(worker)
+                raise
+            self.release(worker)
+            return result
+
+    def release(self, worker):
+        with self.lock:
+            if not self.closed:
+                self.idle.append(worker)
+                return
+        worker.close()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            workers, self.idle = self.idle, []
+        for worker in workers:
+            worker.close()
+
+
+if __name__ == "__worker__":
+    bootstrap(*args)